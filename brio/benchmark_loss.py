@@ -0,0 +1,84 @@
+"""
+Ranking loss benchmark: the fused RankingLoss against the per-offset MarginRankingLoss loop it replaced.
+
+For every number of candidates, loss and gradients are first checked against the loop in
+float64, then forward+backward is timed for both.
+
+python brio/benchmark_loss.py --num_candidates 16 32 --batch_size 16 --device cpu
+"""
+import os
+import sys
+import time
+import argparse
+import torch
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from brio.loss import RankingLoss
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_candidates', type=int, nargs='+', default=[16,32])
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--repeats', type=int, default=100)
+    parser.add_argument('--margin', type=float, default=0.001)
+    parser.add_argument('--gold_margin', type=float, default=0)
+    parser.add_argument('--gold_weight', type=float, default=1)
+    return parser.parse_args()
+
+def loop_ranking_loss(score,summary_score,margin,gold_margin,gold_weight):
+    ## RankingLoss.__call__ before the fused version
+    ones = torch.ones_like(score)
+    loss_func = torch.nn.MarginRankingLoss(0.0)
+    TotalLoss = loss_func(score, score, ones)
+    n = score.size(1)
+    for i in range(1, n):
+        pos_score = score[:, :-i]
+        neg_score = score[:, i:]
+        pos_score = pos_score.contiguous().view(-1)
+        neg_score = neg_score.contiguous().view(-1)
+        ones = torch.ones_like(pos_score)
+        loss_func = torch.nn.MarginRankingLoss(margin * i)
+        loss = loss_func(pos_score, neg_score, ones)
+        TotalLoss += loss
+    pos_score = summary_score.unsqueeze(-1).expand_as(score)
+    neg_score = score
+    pos_score = pos_score.contiguous().view(-1)
+    neg_score = neg_score.contiguous().view(-1)
+    ones = torch.ones_like(pos_score)
+    loss_func = torch.nn.MarginRankingLoss(gold_margin)
+    TotalLoss += gold_weight * loss_func(pos_score, neg_score, ones)
+    return TotalLoss
+
+def forward_backward(loss_fn,score,summary_score):
+    score = score.detach().requires_grad_()
+    summary_score = summary_score.detach().requires_grad_()
+    loss = loss_fn(score,summary_score)
+    loss.backward()
+    return loss.detach(),score.grad,summary_score.grad
+
+def timeit(loss_fn,score,summary_score,repeats):
+    for _ in range(10):
+        forward_backward(loss_fn,score,summary_score)
+    if score.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        forward_backward(loss_fn,score,summary_score)
+    if score.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+if __name__ == '__main__':
+    args = parse_args()
+    torch.manual_seed(0)
+    fused = RankingLoss(margin=args.margin,gold_margin=args.gold_margin,gold_weight=args.gold_weight)
+    loop = lambda score,summary_score:loop_ranking_loss(score,summary_score,args.margin,args.gold_margin,args.gold_weight)
+    for n in args.num_candidates:
+        score = torch.randn(args.batch_size,n,dtype=torch.float64,device=args.device) * 0.01
+        summary_score = torch.randn(args.batch_size,dtype=torch.float64,device=args.device) * 0.01
+        for x,y in zip(forward_backward(fused,score,summary_score),forward_backward(loop,score,summary_score)):
+            assert torch.allclose(x,y,rtol=1e-12,atol=1e-15),(n,(x-y).abs().max().item())
+        score,summary_score = score.float(),summary_score.float()
+        loop_time = timeit(loop,score,summary_score,args.repeats)
+        fused_time = timeit(fused,score,summary_score,args.repeats)
+        print(f"{n:>4} candidates  loop {loop_time*1000:7.3f}ms  fused {fused_time*1000:7.3f}ms  speedup {loop_time/fused_time:5.2f}x")
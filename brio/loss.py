@@ -1,9 +1,24 @@
 from dataclasses import dataclass
 import torch
 
+def pairwise_margin_ranking_loss(score,margin):
+    """
+    sum over i in range(1,n) of MarginRankingLoss(margin*i)(score[:,:-i],score[:,i:],ones),
+    computed on the full [bs,n,n] difference matrix at once:
+    pair (p,q) with q>p costs max(0,score[q]-score[p]+margin*(q-p)), averaged within its offset q-p
+    """
+    bs,n = score.shape
+    idx = torch.arange(n,device=score.device)
+    offset = idx[None,:] - idx[:,None]
+    ## every offset i is a mean over its bs*(n-i) pairs, the lower triangle does not count
+    count = (bs * (n - offset).clamp_min(1)).to(score.dtype)
+    weight = torch.where(offset > 0,1 / count,torch.zeros_like(count))
+    diff = score[:,None,:] - score[:,:,None] + margin * offset.to(score.dtype)
+    return (diff.clamp_min(0) * weight).sum()
+
 @dataclass
 class RankingLoss:
-    
+
     margin: float = 0
     gold_margin: float = 0
     gold_weight: float=1
@@ -11,29 +26,13 @@ class RankingLoss:
     no_cand:bool=False
 
     def __call__(self, score,summary_score):
-        ones = torch.ones_like(score)
-        loss_func = torch.nn.MarginRankingLoss(0.0)
-        TotalLoss = loss_func(score, score, ones)
+        TotalLoss = score.new_zeros(())
         # candidate loss
-        n = score.size(1)
         if not self.no_cand:
-            for i in range(1, n):
-                pos_score = score[:, :-i]
-                neg_score = score[:, i:]
-                pos_score = pos_score.contiguous().view(-1)
-                neg_score = neg_score.contiguous().view(-1)
-                ones = torch.ones_like(pos_score)
-                loss_func = torch.nn.MarginRankingLoss(self.margin * i)
-                loss = loss_func(pos_score, neg_score, ones)
-                TotalLoss += loss
+            TotalLoss = TotalLoss + pairwise_margin_ranking_loss(score,self.margin)
         if self.no_gold:
             return TotalLoss
         # gold summary loss
-        pos_score = summary_score.unsqueeze(-1).expand_as(score)
-        neg_score = score
-        pos_score = pos_score.contiguous().view(-1)
-        neg_score = neg_score.contiguous().view(-1)
-        ones = torch.ones_like(pos_score)
-        loss_func = torch.nn.MarginRankingLoss(self.gold_margin)
-        TotalLoss += self.gold_weight * loss_func(pos_score, neg_score, ones)
-        return TotalLoss
\ No newline at end of file
+        gold_loss = (score - summary_score.unsqueeze(-1) + self.gold_margin).clamp_min(0).mean()
+        TotalLoss = TotalLoss + self.gold_weight * gold_loss
+        return TotalLoss
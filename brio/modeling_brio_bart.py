@@ -1,8 +1,16 @@
 from transformers.models.bart.modeling_bart import *
+from summarization.grouped_attention import (
+    GroupedBartAttention,
+    use_grouped_cross_attention,
+)
 
 
 class BrioBartModel(BartModel):
-    
+
+    def __init__(self, config: BartConfig):
+        super().__init__(config)
+        use_grouped_cross_attention(self.decoder, GroupedBartAttention)
+
     def forward(
         self,
         input_ids=None,
@@ -55,13 +63,10 @@ class BrioBartModel(BartModel):
             )
 
         if self.training:
-            cand_num = decoder_input_ids.size(1)
-            encoder_hidden_states = encoder_outputs[0]
-            encoder_hidden_states = torch.repeat_interleave(encoder_hidden_states, cand_num, dim=0)
-            attention_mask = torch.repeat_interleave(attention_mask, cand_num, dim=0)
+            ## [bs,cand_num,seq_len] -> [bs*cand_num,seq_len]
+            ## the encoder output stays [bs,...], the grouped cross-attention shares it across the candidates
             decoder_input_ids = decoder_input_ids.view(-1, decoder_input_ids.size(-1))
-        else:
-            encoder_hidden_states = encoder_outputs[0]
+        encoder_hidden_states = encoder_outputs[0]
 
         decoder_outputs = self.decoder(
             input_ids=decoder_input_ids,
@@ -17,8 +17,7 @@ class BrioDualEncoderPegasusForConditionalGeneration(PegasusForConditionalGenera
 
 
 class BrioDualEncoderPegasusModel(DualEncoderPegasusModel):
-    
-    
+
     def forward(
         self,
         input_ids: Optional[torch.Tensor] = None,
@@ -61,22 +60,11 @@ class BrioDualEncoderPegasusModel(DualEncoderPegasusModel):
             )
         
         if self.training:
-            cand_num = decoder_input_ids.size(1)
-
-            ## src
-            encoder_hidden_states = encoder_outputs.src_last_hidden_state
-            encoder_hidden_states = torch.repeat_interleave(encoder_hidden_states, cand_num, dim=0)
-            attention_mask = torch.repeat_interleave(attention_mask, cand_num, dim=0)
-
-            ## memory
-            memory_hidden_states = encoder_outputs.memory_last_hidden_state
-            memory_hidden_states = torch.repeat_interleave(memory_hidden_states, cand_num, dim=0)
-            memory_attention_mask = torch.repeat_interleave(memory_attention_mask, cand_num, dim=0)
-
+            ## [bs,cand_num,seq_len] -> [bs*cand_num,seq_len]
+            ## src and memory states stay [bs,...], the grouped cross-attention shares them across the candidates
             decoder_input_ids = decoder_input_ids.view(-1, decoder_input_ids.size(-1))
-        else:
-            encoder_hidden_states = encoder_outputs.src_last_hidden_state
-            memory_hidden_states = encoder_outputs.memory_last_hidden_state
+        encoder_hidden_states = encoder_outputs.src_last_hidden_state
+        memory_hidden_states = encoder_outputs.memory_last_hidden_state
 
 
         decoder_outputs = self.decoder(
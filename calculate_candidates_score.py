@@ -4,8 +4,9 @@ from utils.metrics_utils import (
     get_rouge_score,
     get_nltk_bleu_score,
     get_sentence_bleu,
+    get_candidates_rouge_scores,
 )
-from utils.utils import run_pool
+from utils.utils import run_pool,split_list
 import argparse
 
 
@@ -16,6 +17,12 @@ parser.add_argument("--output_path",default=None)
 parser.add_argument("--metrics",default=None,required=True,choices=['r1r2','r1r2rl','b1b2','bleu'])
 parser.add_argument("--num_workers",default=15,type=int)
 
+## rouge metrics are scored in batch, every reference is tokenized and stemmed once for all of its candidates
+RougeMetrics = {
+    "r1r2":(['rouge1','rouge2'],lambda r1,r2:0 if r1+r2 == 0 else 2*r1*r2/(r1+r2)),
+    "r1r2rl":(['rouge1','rouge2','rougeLsum'],lambda r1,r2,rl:(r1+r2+rl)/3),
+}
+
 def r1r2(hyp,ref):
     r1,r2,rl = get_rouge_score([hyp],[ref])
     if r1+r2 == 0:
@@ -42,16 +49,22 @@ if __name__ == '__main__':
     refs = [x['summary'] for x in get_jsonl(args.refs_path)]
     assert len(candidates)%len(refs)==0,(len(candidates),len(refs))
     multiple = int(len(candidates)/len(refs))
-    refs = [[x]*multiple for x in refs]
-    refs = [x for y in refs for x in y]
 
-    def cal_score(hyp_ref):
-        hyp = hyp_ref[0]
-        ref = hyp_ref[1]
-        score = eval(args.metrics)(hyp,ref)
-        return score
+    if args.metrics in RougeMetrics:
+        rouge_types,combine = RougeMetrics[args.metrics]
+        scores = get_candidates_rouge_scores(split_list(candidates,multiple),refs,rouge_types,num_workers=args.num_workers,verbose=True)
+        scores = [combine(*x) for y in scores for x in y]
+    else:
+        refs = [[x]*multiple for x in refs]
+        refs = [x for y in refs for x in y]
+
+        def cal_score(hyp_ref):
+            hyp = hyp_ref[0]
+            ref = hyp_ref[1]
+            score = eval(args.metrics)(hyp,ref)
+            return score
 
-    scores = run_pool(list(zip(candidates,refs)),cal_score,num_works=args.num_workers,verbose=True)
+        scores = run_pool(list(zip(candidates,refs)),cal_score,num_works=args.num_workers,verbose=True)
 
     if args.output_path is None:
         _split = os.path.basename(args.candidates_path).split(".")[0]
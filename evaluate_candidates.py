@@ -6,7 +6,7 @@ from utils.metrics_utils import (
     get_distinct_score,
     get_rouge_score,
     get_bleu_score,
-    
+    get_candidates_rouge_scores,
 )
 
 parser = argparse.ArgumentParser()
@@ -52,15 +52,17 @@ def evaluate_candidates(candidates,refs,metrics):
     print("***"*30)
 
     ## best and worst
+    if metrics == 'r1':
+        r1_scores = get_candidates_rouge_scores(candidates,refs,['rouge1'])
     best = []
     worst = []
     for idx in range(len(refs)):
         _candidates = candidates[idx]
         ref = refs[idx]
         scores = []
-        for candidate in _candidates:
+        for candidate_idx,candidate in enumerate(_candidates):
             if metrics == 'r1':
-                score = get_rouge_score([candidate],[ref])[0]
+                score = r1_scores[idx][candidate_idx][0]
             elif metrics == 'bleu':
                 score = get_bleu_score([candidate],[ref])
             elif metrics == 'b1':
@@ -34,6 +34,22 @@ from utils.optim_utils import (
 )
 from utils.ddp_utils import (
     UnevenSequentialDistributedSampler,
+    LengthBucketBatchSampler,
+    OutputShards,
+    restore_order,
+    wait_for_everyone,
+    broadcast_from_main,
+)
+from utils.memory_utils import (
+    load_memory,
+)
+from utils.cache_utils import (
+    EncoderStateCache,
+)
+from utils.data_utils import (
+    JsonlFile,
+    tokenize,
+    estimate_lengths,
 )
 from summarization import (
     DualEncoderPegasusForConditionalGeneration,
@@ -51,25 +67,70 @@ class MemoryDataset(torch.utils.data.Dataset):
         self,
         data,
         memory=None,
+        group_by_source=False,
         ):
         super().__init__()
+        self.multiple = 1
         if memory is not None:
             if len(data) != len(memory):
                 assert len(memory)%len(data)==0,(len(data),len(memory))
-                multiple = int(len(memory)/len(data))
-                data = [[x]*multiple for x in data]
-                data = [x for y in data for x in y]
-            assert len(data)==len(memory),(len(data),len(memory))
-            for idx in range(len(data)):
-                data[idx]['memory']=memory[idx]
-        
+                self.multiple = int(len(memory)/len(data))
+        ## the i-th source is shared by memory[i*multiple:(i+1)*multiple], attached per item
         self.data = data
+        self.memory = memory
+        ## one item per source, with the list of all of its memories
+        self.group_by_source = group_by_source and memory is not None
     
     def __getitem__(self,index):
-        return self.data[index]
+        ## sample_id: index of the source in data, index: of the item, to restore the output order
+        if self.memory is None:
+            return {**self.data[index],'sample_id':index,'index':index}
+        if self.group_by_source:
+            return {**self.data[index],'sample_id':index,'index':index,'memory':[self.memory[index*self.multiple+i] for i in range(self.multiple)]}
+        return {**self.data[index//self.multiple],'sample_id':index//self.multiple,'index':index,'memory':self.memory[index]}
+
+    def get_lengths(self,max_src_len=None,max_trg_len=None):
+        """
+        estimated source+memory tokens of every item, all memories of a source in group_by_source mode
+        """
+        lengths = estimate_lengths(self.data,max_src_len)
+        if self.memory is None:
+            return lengths
+        memory_lengths = estimate_lengths(self.memory,max_trg_len)
+        if self.group_by_source:
+            return lengths + memory_lengths.reshape(-1,self.multiple).sum(-1)
+        return lengths.repeat(self.multiple) + memory_lengths
 
     def __len__(self,):
-        return len(self.data)
+        if self.group_by_source:
+            return len(self.data)
+        return len(self.data)*self.multiple
+
+def grouped_collate_fct(samples,toker,max_src_len,max_trg_len,src='document',trg='summary'):
+    """
+    samples: one source with the list of its memories each (separate memory encoding)
+    the sources are tokenized once per group, memories and refs once per (source,memory) pair,
+    in the order of the flat memory file
+    """
+    memory = [m for d in samples for m in d['memory']]
+    refs = [d[trg] for d in samples for _ in d['memory']]
+    tokenized_src = tokenize([d[src] for d in samples],toker,max_src_len)
+    tokenized_memory = tokenize(memory,toker,max_trg_len)
+    return {
+        "input_ids":tokenized_src['input_ids'],
+        "attention_mask":tokenized_src['attention_mask'],
+        "memory_input_ids":tokenized_memory['input_ids'],
+        "memory_attention_mask":tokenized_memory['attention_mask'],
+        "refs":refs,
+        "sample_ids":[d['sample_id'] for d in samples],
+        "indices":[d['index'] for d in samples],
+    }
+
+def add_sample_ids(samples,collate_fct):
+    batch = collate_fct(samples)
+    batch['sample_ids'] = [d['sample_id'] for d in samples]
+    batch['indices'] = [d['index'] for d in samples]
+    return batch
 
 class Generator(ConditionalGenerator):
     @staticmethod
@@ -86,6 +147,10 @@ class Generator(ConditionalGenerator):
         parser.add_argument('--trg', )
         parser.add_argument('--train_max_src_len',type=int)
         parser.add_argument('--train_max_trg_len',type=int)
+        parser.add_argument('--group_by_source',action='store_true',help='batch all memories of a source together and encode the source once')
+        parser.add_argument('--encoder_cache_dir',help='keep the source encoder states here and reuse them in later runs with the same model and data')
+        parser.add_argument('--stream_dir',help='commit the hypotheses of every batch to per-rank shards here, a restarted run skips what is committed; output_path is merged from the shards at the end')
+        parser.add_argument('--eval_max_tokens',type=int,help='sort the samples by source+memory length and batch them under this budget of padded tokens, outputs keep the data order')
         ## model
         parser.add_argument('--pretrained_model_path',)
         ## generation
@@ -101,8 +166,11 @@ class Generator(ConditionalGenerator):
         parser.add_argument('--top_p',type=float)
         parser.add_argument('--temperature',type=float)
         parser.add_argument('--do_sample',type=bool)
+        parser.add_argument('--lookup_decoding',action='store_true',help='greedy decoding that drafts tokens from the memory and verifies them in one forward pass, same output as greedy')
+        parser.add_argument('--num_draft_tokens',type=int,default=10)
         ## training_parameters
         parser.add_argument('--per_device_eval_batch_size',type=int)
+        parser.add_argument('--gather_dir',help='shared directory to collect the eval outputs of all ranks through files instead of the process group')
         parser.add_argument('--eval_metrics',default='rouge1')
         parser.add_argument('--logging_steps',type=int)
         parser.add_argument('--seed',type=int)
@@ -129,16 +197,85 @@ class Generator(ConditionalGenerator):
 
     def test_step(self, batch, batch_idx):
         hyps = self.generate(batch)
-        return hyps,batch['refs']
+        if self.output_shards is not None:
+            ## every item owns an equal, contiguous share of the batch's hyps
+            size = len(hyps)//len(batch['indices'])
+            self.output_shards.write(batch['indices'],[hyps[idx*size:(idx+1)*size] for idx in range(len(batch['indices']))])
+            return None
+        return hyps,batch['refs'],batch['indices']
     
     def on_test_start(self) -> None:
         self.print(self.hparams)
+        self.encoder_state_cache = None
+        if self.hparams.get('encoder_cache_dir') is not None:
+            assert self.hparams.memory_encoding == 'separate','only the dual encoder keeps the source states apart from the memory'
+            self.encoder_state_cache = EncoderStateCache(
+                os.path.join(self.hparams.encoder_cache_dir,self.encoder_fingerprint()),
+                rank = self.global_rank,
+            )
+
+    def encoder_fingerprint(self):
+        """
+        the cached source states are only valid for the same encoder weights, tokenization and data file
+        """
+        import hashlib
+        h = hashlib.sha1()
+        h.update(self.model.config.to_json_string().encode())
+        for name,param in self.model.get_encoder().state_dict().items():
+            h.update(f"{name}:{tuple(param.shape)}:{param.double().sum().item():.10e}:{param.double().abs().sum().item():.10e}".encode())
+        stat = os.stat(self.hparams.data_path)
+        h.update(f"{os.path.abspath(self.hparams.data_path)}:{stat.st_size}:{stat.st_mtime}".encode())
+        h.update(f"{self.src_toker.name_or_path}:{len(self.src_toker)}:{self.hparams.src}:{self.hparams.train_max_src_len}".encode())
+        return h.hexdigest()[:16]
+
+    def get_encoder_outputs(self,batch):
+        if self.encoder_state_cache is None or 'memory_input_ids' not in batch.keys():
+            return super().get_encoder_outputs(batch)
+        encoder = self.model.get_encoder()
+        attention_mask = batch['attention_mask']
+        lengths = attention_mask.sum(-1).tolist()
+        states = [self.encoder_state_cache.get(x) for x in batch['sample_ids']]
+
+        ## only the sources that were never encoded go through the encoder
+        missing = [idx for idx,x in enumerate(states) if x is None]
+        if missing:
+            index = torch.tensor(missing,device=self.device)
+            src_last_hidden_state = encoder(
+                input_ids=batch['input_ids'].index_select(0,index),
+                attention_mask=attention_mask.index_select(0,index),
+                return_dict=True,
+            ).src_last_hidden_state
+            for idx,x in zip(missing,src_last_hidden_state):
+                states[idx] = x[:lengths[idx]].detach().half().cpu().numpy()
+                self.encoder_state_cache.put(batch['sample_ids'][idx],states[idx])
+
+        dtype = encoder.embed_tokens.weight.dtype
+        src_last_hidden_state = torch.zeros((len(states),attention_mask.shape[1],states[0].shape[-1]),dtype=dtype,device=self.device)
+        for idx,x in enumerate(states):
+            assert len(x) == lengths[idx],(len(x),lengths[idx])
+            src_last_hidden_state[idx,:len(x)] = torch.from_numpy(x).to(self.device,dtype)
+        return encoder(
+            attention_mask=attention_mask,
+            memory_input_ids=batch['memory_input_ids'],
+            memory_attention_mask=batch['memory_attention_mask'],
+            src_last_hidden_state=src_last_hidden_state,
+            return_dict=True,
+        )
 
     def test_epoch_end(self,outputs):
-        hyps,refs = self.merge(outputs)
-        hyps = [x for y in hyps for x in y]
-        refs = [x for y in refs for x in y]
-        if len(hyps) == len(refs):
+        if self.encoder_state_cache is not None:
+            self.encoder_state_cache.flush()
+        if self.output_shards is not None:
+            ## nothing was kept in memory, rank 0 merges the shards once everyone is done (see __main__)
+            self.output_shards.close()
+            wait_for_everyone()
+            return
+        hyps,refs,indices = self.merge(outputs)
+        ## batches may come in any order (length-sorted, several ranks)
+        hyps = restore_order(hyps,indices)
+        refs = restore_order(refs,indices)
+        ## decided on the main process, eval_generation has every rank wait for its metrics
+        if broadcast_from_main(len(hyps) == len(refs)):
             self.eval_generation(hyps,refs,stage='test')
         if self.trainer.is_global_zero:
             if self.hparams.output_path is not None:
@@ -146,27 +283,72 @@ class Generator(ConditionalGenerator):
                 with open(self.hparams.output_path,'w') as f:
                     for h in hyps:
                         f.write(h.replace("\n"," ")+"\n")
+
+    def merge_output_shards(self):
+        os.makedirs(os.path.dirname(self.hparams.output_path),exist_ok=True)
+        self.output_shards.merge(
+            self.hparams.output_path,
+            num_items = len(self.test_dataset),
+            to_lines = lambda hyps:[h.replace("\n"," ") for h in hyps],
+        )
+        self.print(f"{len(self.test_dataset)} samples merged from {self.hparams.stream_dir} into {self.hparams.output_path}")
     
     def setup(self,stage):
         if stage == 'test':
-            data = [json.loads(x) for x in open(self.hparams.data_path).readlines()]
+            data = JsonlFile(self.hparams.data_path)
             self.test_data_cnt = len(data)
         memory = None
         if self.hparams.memory_path is not None:
-            mem_path = os.path.join(self.hparams.memory_path)
-            memory = [x.strip() for x in open(mem_path).readlines()]
+            memory = load_memory(self.hparams.memory_path)
+        group_by_source = self.hparams.get('group_by_source',False)
+        if group_by_source:
+            assert self.hparams.memory_encoding == 'separate','group_by_source shares the source encoder states, it needs memory_encoding separate'
         self.test_dataset = MemoryDataset(
             data = data,
             memory=memory,
+            group_by_source=group_by_source,
         )
+        self.output_shards = None
+        if self.hparams.get('stream_dir') is not None:
+            assert self.hparams.output_path is not None,'the shards are merged into output_path'
+            self.output_shards = OutputShards(self.hparams.stream_dir,rank=self.global_rank)
+            ## every rank has to see the same committed items before anyone writes
+            wait_for_everyone()
+            self.print(f"{len(self.output_shards.done)}/{len(self.test_dataset)} samples already committed in {self.hparams.stream_dir}")
 
     def test_dataloader(self):
+        indices = None
+        if self.output_shards is not None:
+            indices = [idx for idx in range(len(self.test_dataset)) if idx not in self.output_shards.done]
         if self.trainer.num_devices > 1:
-            sampler = UnevenSequentialDistributedSampler(self.test_dataset)
+            sampler = UnevenSequentialDistributedSampler(self.test_dataset,indices=indices)
+        elif indices is not None:
+            sampler = indices
         else:
             sampler = torch.utils.data.SequentialSampler(self.test_dataset)
-        return torch.utils.data.DataLoader(self.test_dataset, batch_size=self.hparams.per_device_eval_batch_size,
-                                           shuffle=False,collate_fn=self.collate_fct,
+        batch_size,collate_fn = self.hparams.per_device_eval_batch_size,partial(add_sample_ids,collate_fct=self.collate_fct)
+        if self.test_dataset.group_by_source:
+            ## per_device_eval_batch_size still counts (source,memory) pairs
+            batch_size = max(1,batch_size//self.test_dataset.multiple)
+            collate_fn = partial(grouped_collate_fct,toker=self.src_toker,
+                                 max_src_len=self.hparams.train_max_src_len,max_trg_len=self.hparams.train_max_trg_len,
+                                 src=self.hparams.src,trg=self.hparams.trg)
+        if self.hparams.get('eval_max_tokens') is not None:
+            ## one bucket, no shuffle: the indices of this rank sorted by length, so that beam
+            ## search pads to similar lengths; batch_size still caps the number of items
+            batch_sampler = LengthBucketBatchSampler(
+                lengths = self.test_dataset.get_lengths(self.hparams.train_max_src_len,self.hparams.train_max_trg_len),
+                max_tokens = self.hparams.eval_max_tokens,
+                max_batch_size = batch_size,
+                sampler = sampler,
+                shuffle = False,
+                bucket_size = len(self.test_dataset),
+            )
+            return torch.utils.data.DataLoader(self.test_dataset, batch_sampler=batch_sampler,
+                                               collate_fn=collate_fn,
+                                               num_workers=8, pin_memory=True)
+        return torch.utils.data.DataLoader(self.test_dataset, batch_size=batch_size,
+                                           shuffle=False,collate_fn=collate_fn,
                                            num_workers=8, pin_memory=True,sampler=sampler)
     
 if __name__ == "__main__":
@@ -188,4 +370,6 @@ if __name__ == "__main__":
         strategy = strategy,
         replace_sampler_ddp=False,
     )
-    trainer.test(model)
\ No newline at end of file
+    trainer.test(model)
+    if model.output_shards is not None and trainer.is_global_zero:
+        model.merge_output_shards()
\ No newline at end of file
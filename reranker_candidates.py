@@ -36,26 +36,55 @@ from utils.metrics_utils import (
     get_nltk_bleu_score,
     get_distinct_score,
 )
+from utils.data_utils import (
+    JsonlFile,
+    CandidateFile,
+    estimate_lengths,
+)
 from utils.ddp_utils import (
     UnevenSequentialDistributedSampler,
+    LengthBucketBatchSampler,
+    restore_order,
+    gather_to_main,
+    broadcast_from_main,
+)
+from brio.loss import (
+    RankingLoss,
 )
 
 class MemoryDataset(torch.utils.data.Dataset):
 
-    def __init__(self,data,memory=None,):
+    def __init__(self,data,memory=None,candidates=None):
         super().__init__()
         self.data = data
         if memory is not None:
             assert len(data)==len(memory),(len(data),len(memory))
-            for idx in range(len(data)):
-                self.data[idx]['memory']=memory[idx]
+        ## attached per item, nothing is decoded before it is used
+        self.memory = memory
+        self.candidates = candidates
     
     def __getitem__(self,index):
-        return self.data[index]
+        ## index: to restore the output order
+        d = {**self.data[index],'index':index}
+        if self.memory is not None:
+            d['memory'] = self.memory[index]
+        if self.candidates is not None:
+            d['candidates'] = self.candidates[index]
+        return d
 
     def __len__(self,):
         return len(self.data)
 
+    def get_lengths(self,max_src_len=None,max_trg_len=None):
+        """
+        estimated tokens of every sample: the source plus all of its candidates
+        """
+        lengths = estimate_lengths(self.data,max_src_len)
+        if self.candidates is not None:
+            candidate_lengths = estimate_lengths(self.candidates.candidates,max_trg_len)
+            lengths = lengths + candidate_lengths.reshape(len(self.data),-1).sum(-1)
+        return lengths
+
 def collate_fct(samples,toker,max_src_len,max_trg_len,src='document',trg='summary',num_candidates=None,is_training=False):
     
     src = [d[src] for d in samples]
@@ -80,6 +109,7 @@ def collate_fct(samples,toker,max_src_len,max_trg_len,src='document',trg='summar
         "candidate_attention_mask":tokenized_candidates['attention_mask'],
         "candidates":candidates,
         "refs":trg,
+        "indices":[d['index'] for d in samples],
     }
 
 class RankingModel(LightningModule):
@@ -98,6 +128,8 @@ class RankingModel(LightningModule):
         parser.add_argument('--max_src_len', type=int)
         parser.add_argument('--pretrained_model_path')
         parser.add_argument('--per_device_eval_batch_size',type=int)
+        parser.add_argument('--gather_dir',help='shared directory to collect the eval outputs of all ranks through files instead of the process group')
+        parser.add_argument('--eval_max_tokens',type=int,help='sort the samples by source+candidates length and batch them under this budget of padded tokens, outputs keep the data order')
         parser.add_argument('--eval_metrics')
         parser.add_argument('--seed',type=int)
         parser.add_argument('--architecture')
@@ -133,29 +165,33 @@ class RankingModel(LightningModule):
             self.model = AutoModel.from_pretrained(self.hparams.pretrained_model_path,num_labels=1)
 
     def eval_generation(self,hyps,refs,stage='valid'):
-        if stage == 'valid':
-            cnt = self.valid_data_cnt
-        elif stage == 'test':
-            cnt = self.test_data_cnt
-        hyps = hyps[:cnt]
-        refs = refs[:cnt]
-        r1,r2,rl = get_rouge_score(hyps,refs)
-        bleu = get_bleu_score(hyps,refs)
-        bleu_1,bleu_2,bleu_3,bleu_4 = get_nltk_bleu_score(hyps,refs)
-        distinct_1,distinct_2 = get_distinct_score(hyps)
-
-        metrics_dict = {
-                stage+"_rouge1":r1,
-                stage+"_rouge2":r2,
-                stage+"_rougeL":rl,
-                stage+"_bleu":bleu,
-                stage+"_bleu1":bleu_1,
-                stage+"_bleu2":bleu_2,
-                stage+"_bleu3":bleu_3,
-                stage+"_bleu4":bleu_4,
-                stage+"_distinct_1":distinct_1,
-                stage+"_distinct_2":distinct_2,
-            }
+        ## hyps and refs are only on the main process (see merge), every rank logs its metrics
+        metrics_dict = None
+        if self.trainer.is_global_zero:
+            if stage == 'valid':
+                cnt = self.valid_data_cnt
+            elif stage == 'test':
+                cnt = self.test_data_cnt
+            hyps = hyps[:cnt]
+            refs = refs[:cnt]
+            r1,r2,rl = get_rouge_score(hyps,refs)
+            bleu = get_bleu_score(hyps,refs)
+            bleu_1,bleu_2,bleu_3,bleu_4 = get_nltk_bleu_score(hyps,refs)
+            distinct_1,distinct_2 = get_distinct_score(hyps)
+
+            metrics_dict = {
+                    stage+"_rouge1":r1,
+                    stage+"_rouge2":r2,
+                    stage+"_rougeL":rl,
+                    stage+"_bleu":bleu,
+                    stage+"_bleu1":bleu_1,
+                    stage+"_bleu2":bleu_2,
+                    stage+"_bleu3":bleu_3,
+                    stage+"_bleu4":bleu_4,
+                    stage+"_distinct_1":distinct_1,
+                    stage+"_distinct_2":distinct_2,
+                }
+        metrics_dict = broadcast_from_main(metrics_dict)
         self.log_dict(metrics_dict)
         self.print(json.dumps(metrics_dict,indent=4))
 
@@ -172,32 +208,13 @@ class RankingModel(LightningModule):
         logits = torch.nn.functional.normalize(logits,dim=1)
         refs_scores = logits[:,0]
         candidates_scores = logits[:,1:]
-        
-        ones = torch.ones_like(candidates_scores)
-        loss_func = torch.nn.MarginRankingLoss(0.0)
-        TotalLoss = loss_func(candidates_scores, candidates_scores, ones)
-        # candidate loss
-        n = candidates_scores.size(1)
-        for i in range(1, n):
-            pos_score = candidates_scores[:, :-i]
-            neg_score = candidates_scores[:, i:]
-            pos_score = pos_score.contiguous().view(-1)
-            neg_score = neg_score.contiguous().view(-1)
-            ones = torch.ones_like(pos_score)
-            loss_func = torch.nn.MarginRankingLoss(self.hparams.margin * i)
-            loss = loss_func(pos_score, neg_score, ones)
-            TotalLoss += loss
-        if self.hparams.no_gold:
-            return TotalLoss
-        # gold summary loss
-        pos_score = refs_scores.unsqueeze(-1).expand_as(candidates_scores)
-        neg_score = candidates_scores
-        pos_score = pos_score.contiguous().view(-1)
-        neg_score = neg_score.contiguous().view(-1)
-        ones = torch.ones_like(pos_score)
-        loss_func = torch.nn.MarginRankingLoss(self.hparams.gold_margin)
-        TotalLoss += self.hparams.gold_weight * loss_func(pos_score, neg_score, ones)
-        return TotalLoss
+        ranking_loss = RankingLoss(
+            margin = self.hparams.margin,
+            gold_margin = self.hparams.gold_margin,
+            gold_weight = self.hparams.gold_weight,
+            no_gold = self.hparams.no_gold,
+        )
+        return ranking_loss(candidates_scores,refs_scores)
 
     def get_logits(self,batch):
         
@@ -255,7 +272,7 @@ class RankingModel(LightningModule):
 
     def test_step(self, batch, batch_idx):
         hyps = self.rank(batch)
-        return hyps,batch['refs']
+        return hyps,batch['refs'],batch['indices']
 
     def rank(self,batch):
         logits = self.get_logits(batch)
@@ -264,12 +281,15 @@ class RankingModel(LightningModule):
         return hyps
 
     def merge(self,outputs):
-
-        if dist.is_initialized():
-            all_rank_outputs = [None for _ in range(dist.get_world_size())]    
-            dist.all_gather_object(all_rank_outputs,outputs)
-            outputs = [x for y in all_rank_outputs for x in y] ## all_rank_output[i]: i-th batch output
+        """
+        the outputs of all ranks on the main process only, the other ranks get empty lists:
+        whatever is computed from them is sent back by broadcast_from_main
+        """
         single_batch_output_cnt = len(outputs[0])
+        all_rank_outputs = gather_to_main(outputs,self.hparams.get('gather_dir'))
+        if all_rank_outputs is None:
+            return [[] for _ in range(single_batch_output_cnt)]
+        outputs = [x for y in all_rank_outputs for x in y] ## all_rank_output[i]: i-th batch output
         ret = [[] for _ in range(single_batch_output_cnt)]
         for idx in range(single_batch_output_cnt):
             for batch in outputs:
@@ -278,9 +298,10 @@ class RankingModel(LightningModule):
 
     def test_epoch_end(self,outputs):
         if self.logger:self.log("v_num",self.logger.version)
-        hyps,refs = self.merge(outputs)
-        hyps = [x for y in hyps for x in y]
-        refs = [x for y in refs for x in y]
+        hyps,refs,indices = self.merge(outputs)
+        ## batches may come in any order (length-sorted, several ranks)
+        hyps = restore_order(hyps,indices)
+        refs = restore_order(refs,indices)
         self.eval_generation(hyps,refs,'test')
 
         if self.trainer.is_global_zero:
@@ -290,26 +311,19 @@ class RankingModel(LightningModule):
     def load_data(self,_split):
 
         data_path = self.hparams.data_path
-        data = [json.loads(x) for x in open(data_path).readlines()]
+        data = JsonlFile(data_path)
         data_cnt = len(data)
         
-        candidate_path = data_path = self.hparams.candidate_path
-        candidates = [x.strip() for x in open(candidate_path).readlines()]
-        num_candidates = int(len(candidates)/len(data))
-        candidates = split_list(candidates,num_candidates)
-        
-        score_path = os.path.join(self.hparams.candidate_dir,_split+".scores")
-        scores = [float(x.strip()) for x in open(score_path).readlines()]
-        scores = split_list(scores,num_candidates)
-
-        assert len(scores) == len(data) == len(candidates)
-        for idx in range(len(data)):
-            data[idx]['candidates'] = [
-                [candidate,score] for candidate,score in zip(candidates[idx],scores[idx])
-            ]
+        candidates = CandidateFile(
+            candidate_path = self.hparams.candidate_path,
+            score_path = os.path.join(self.hparams.candidate_dir,_split+".scores"),
+            num_samples = data_cnt,
+        )
+        assert len(candidates) == len(data)
 
         dataset = MemoryDataset(
             data = data,
+            candidates = candidates,
         )
         return data_cnt,dataset
     
@@ -322,6 +336,19 @@ class RankingModel(LightningModule):
             sampler = UnevenSequentialDistributedSampler(self.test_dataset)
         else:
             sampler = torch.utils.data.SequentialSampler(self.test_dataset)
+        if self.hparams.get('eval_max_tokens') is not None:
+            ## one bucket, no shuffle: the indices of this rank sorted by length
+            batch_sampler = LengthBucketBatchSampler(
+                lengths = self.test_dataset.get_lengths(self.hparams.max_src_len,self.hparams.max_trg_len),
+                max_tokens = self.hparams.eval_max_tokens,
+                max_batch_size = self.hparams.per_device_eval_batch_size,
+                sampler = sampler,
+                shuffle = False,
+                bucket_size = len(self.test_dataset),
+            )
+            return torch.utils.data.DataLoader(self.test_dataset, batch_sampler=batch_sampler,
+                                               collate_fn=self.test_collate_fct,
+                                               num_workers=8, pin_memory=True)
         return torch.utils.data.DataLoader(self.test_dataset, batch_size=self.hparams.per_device_eval_batch_size,
                                            shuffle=False,collate_fn=self.test_collate_fct,
                                            num_workers=8, pin_memory=True,sampler=sampler)
@@ -349,5 +376,7 @@ if __name__ == "__main__":
     trainer = pl.Trainer.from_argparse_args(
         args,
         strategy = strategy,
+        ## the test dataloader brings its own per-rank sampler
+        replace_sampler_ddp = False,
     )
     trainer.test(model)
\ No newline at end of file
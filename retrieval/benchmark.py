@@ -0,0 +1,204 @@
+"""
+Retrieval benchmark: cost and quality of every retrieval backend on the same query sample.
+
+A fixed random sample of a split is searched by each configuration
+    -bm25 backends (inproc, es), each with every --prune_terms setting
+    -dense indexes (flat, ivf, ivfpq) over dense.py's encoded memory bank
+and every configuration reports per-request p50/p95/p99 latency, queries/sec, load time,
+peak RSS and recall@k against the exact reference of its family (unpruned inproc bm25
+for bm25, flat for dense). Each configuration runs in its own spawned process so that
+peak RSS is its own. Results are written as one JSON report.
+
+python benchmark.py --dataset cnndm --backends inproc es dense --prune_terms 0 32 64 --model_path ...
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+sys.path.append("..")
+from utils.data_utils import LineFile
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='cnndm')
+    parser.add_argument('--data_dir', default='/data')
+    parser.add_argument('--query_lang', default='document')
+    parser.add_argument('--split', default='test')
+    parser.add_argument('--num_queries', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--topk', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=1,
+        help='queries per search request, latency is measured per request')
+    parser.add_argument('--warmup', type=int, default=10,
+        help='untimed requests before measuring')
+    parser.add_argument('--backends', nargs='+', default=['inproc'], choices=['inproc','es','dense'])
+    parser.add_argument('--prune_terms', type=int, nargs='+', default=[0],
+        help='query pruning settings for the bm25 backends, 0 for the full query')
+    ## dense
+    parser.add_argument('--dense_indexes', nargs='+', default=['flat','ivf','ivfpq'], choices=['flat','ivf','ivfpq'])
+    parser.add_argument('--model_path', default=None)
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--query_max_len', type=int, default=512)
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--nprobe', type=int, default=16)
+    parser.add_argument('--pq_m', type=int, default=16)
+    parser.add_argument('--pq_refine', type=int, default=4)
+    parser.add_argument('--output_file', default=None,
+        help='defaults to {data_dir}/{dataset}/benchmark.{split}.json')
+    return parser.parse_args()
+
+def sample_queries(path,num_queries,seed):
+    lines = LineFile(path)
+    num_queries = min(num_queries,len(lines))
+    indices = np.sort(np.random.RandomState(seed).choice(len(lines),num_queries,replace=False))
+    return indices,[lines[int(idx)] for idx in indices]
+
+def get_configs(args):
+    configs = []
+    for backend in args.backends:
+        if backend == 'dense':
+            for index in args.dense_indexes:
+                configs.append({"name":f"dense/{index}","backend":"dense","index":index,"reference":"dense/flat"})
+            continue
+        for prune_terms in args.prune_terms:
+            name = backend if prune_terms == 0 else f"{backend}/prune{prune_terms}"
+            configs.append({"name":name,"backend":backend,"prune_terms":prune_terms,"reference":"inproc"})
+    ## references first, every other configuration is compared against them
+    for reference in set(x["reference"] for x in configs):
+        if reference not in [x["name"] for x in configs]:
+            configs.append({"name":"inproc","backend":"inproc","prune_terms":0,"reference":"inproc"} if reference == 'inproc' else
+                           {"name":"dense/flat","backend":"dense","index":"flat","reference":"dense/flat"})
+    return sorted(configs,key=lambda x:x["name"] != x["reference"])
+
+def open_bm25(config,args,data_dir):
+    """
+    return: search_fn(list of query lines) -> list of id lists
+    """
+    from bm25 import InprocBM25,read_queries,parse_query,get_query_pruner,search_es,get_es_client
+    index_file = os.path.join(data_dir,'train.jsonl')
+    output_dir = os.path.join(data_dir,'bm25')
+    engine = None
+    if config["backend"] == 'inproc':
+        index_path = os.path.join(output_dir,'index.bm25')
+        if os.path.exists(index_path):
+            engine = InprocBM25.load(index_path)
+        else:
+            engine = InprocBM25.build(read_queries(index_file,args.query_lang))
+        search = lambda queries:engine.search(queries,args.topk)
+    else:
+        es = get_es_client()
+        search = lambda queries:search_es(es,args.dataset,queries,args.topk,progress_bar=False,batch_size=len(queries))
+
+    pruner = None
+    if config["prune_terms"] > 0:
+        pruner = get_query_pruner(os.path.join(output_dir,'idf.npz'),index_file,args.query_lang,engine)
+
+    def search_fn(lines):
+        queries = [parse_query(line,args.query_lang) for line in lines]
+        if pruner is not None:
+            queries = [pruner.prune(q,config["prune_terms"]) for q in queries]
+        return search(queries)
+    return search_fn
+
+def open_dense(config,args,data_dir):
+    from dense import Encoder,load_index,IVFIndex
+    output_dir = os.path.join(data_dir,'dense')
+    embeddings = np.load(os.path.join(output_dir,'memory.f16.npy'),mmap_mode='r')
+    ## an index dense.py already built is reused
+    index_args = argparse.Namespace(index=config["index"],nlist=args.nlist,pq_m=args.pq_m,skip_encode=True)
+    index = load_index(index_args,embeddings,output_dir)
+    encoder = Encoder(args.model_path,args.device)
+
+    def search_fn(lines):
+        query_embedding = encoder([json.loads(line)[args.query_lang] for line in lines],args.query_max_len)
+        if isinstance(index,IVFIndex):
+            ids = index.search(query_embedding,args.topk,args.nprobe,args.pq_refine)
+        else:
+            ids = index.search(query_embedding,args.topk)
+        return [[int(i) for i in row if i >= 0] for row in ids]
+    return search_fn
+
+def run_config(config,args,lines):
+    """
+    runs in a fresh process: load the backend, then time every request
+    """
+    import resource
+    data_dir = os.path.join(args.data_dir,args.dataset)
+    start = time.perf_counter()
+    search_fn = (open_dense if config["backend"] == 'dense' else open_bm25)(config,args,data_dir)
+    load_time = time.perf_counter() - start
+
+    batches = [lines[idx:idx+args.batch_size] for idx in range(0,len(lines),args.batch_size)]
+    for batch in batches[:args.warmup]:
+        search_fn(batch)
+    ret,latencies = [],[]
+    for batch in batches:
+        start = time.perf_counter()
+        ret.extend(search_fn(batch))
+        latencies.append(time.perf_counter() - start)
+    ## ru_maxrss is in KB on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {"ids":ret,"latencies":latencies,"load_s":load_time,"peak_rss_mb":peak_rss}
+
+def recall_at_k(ret,reference,k):
+    recall = [len(set(x[:k]) & set(y[:k])) / len(y[:k]) for x,y in zip(ret,reference) if y]
+    return float(np.mean(recall)) if recall else 0.0
+
+def summarize(config,output,reference,args):
+    latencies = np.asarray(output["latencies"]) * 1000
+    num_queries = len(output["ids"])
+    return {
+        "name":config["name"],
+        "backend":config["backend"],
+        "prune_terms":config.get("prune_terms"),
+        "index":config.get("index"),
+        "reference":config["reference"],
+        f"recall@{args.topk}":recall_at_k(output["ids"],reference,args.topk),
+        "latency_ms":{
+            "p50":float(np.percentile(latencies,50)),
+            "p95":float(np.percentile(latencies,95)),
+            "p99":float(np.percentile(latencies,99)),
+            "mean":float(latencies.mean()),
+        },
+        "qps":num_queries / max(latencies.sum() / 1000,1e-9),
+        "load_s":output["load_s"],
+        "peak_rss_mb":output["peak_rss_mb"],
+        "missed":sum(1 for x in output["ids"] if len(x) == 0),
+    }
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    data_dir = os.path.join(args.data_dir,args.dataset)
+    indices,lines = sample_queries(os.path.join(data_dir,args.split+'.jsonl'),args.num_queries,args.seed)
+    print(f"{len(lines)} queries sampled from {args.split}")
+
+    ## spawn, not fork: a forked child would start out with the parent's resident pages
+    ctx = multiprocessing.get_context('spawn')
+    outputs,results = {},[]
+    for config in get_configs(args):
+        with ctx.Pool(1) as pool:
+            outputs[config["name"]] = output = pool.apply(run_config,(config,args,lines))
+        result = summarize(config,output,outputs[config["reference"]]["ids"],args)
+        results.append(result)
+        print(f"{result['name']:<20} recall@{args.topk} {result[f'recall@{args.topk}']:.4f}  "
+              f"p50 {result['latency_ms']['p50']:.2f}ms p95 {result['latency_ms']['p95']:.2f}ms p99 {result['latency_ms']['p99']:.2f}ms  "
+              f"{result['qps']:.1f} q/s  {result['peak_rss_mb']:.0f}MB")
+
+    report = {
+        "dataset":args.dataset,
+        "split":args.split,
+        "num_queries":len(lines),
+        "seed":args.seed,
+        "topk":args.topk,
+        "batch_size":args.batch_size,
+        "query_indices":indices.tolist(),
+        "results":results,
+    }
+    output_file = args.output_file if args.output_file is not None else os.path.join(data_dir,f'benchmark.{args.split}.json')
+    with open(output_file,'w') as f:
+        json.dump(report,f,indent=1)
+    print('report written to',output_file)
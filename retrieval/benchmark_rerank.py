@@ -0,0 +1,57 @@
+"""
+Edit-distance rerank benchmark: get_topk_sent_id (one rapidfuzz cdist call over all hits)
+against the per-candidate editdistance loop it replaced.
+
+Random token sequences of every (query tokens, hits) size are ranked both ways, the rankings
+are checked to be identical and the mean time per query is reported.
+
+python benchmark_rerank.py --sizes 600x100 60x100 30x16
+"""
+import sys
+import time
+import argparse
+import numpy as np
+import editdistance
+from bm25 import get_topk_sent_id
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', default=['600x100','60x100','30x16'],
+        help='{query tokens}x{hits}')
+    parser.add_argument('--k', type=int, default=6)
+    parser.add_argument('--vocab_size', type=int, default=2000)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+def loop_unedited_words(src_sent, src_tm_sent):
+    ## get_unedited_words before the batched version
+    edit_distance = editdistance.eval(src_sent.split(), src_tm_sent.split())
+    return 1 - edit_distance / max(len(src_sent), len(src_tm_sent))
+
+def loop_topk_sent_id(src, src_sim, k=6):
+    ## get_topk_sent_id before the batched version
+    scores = list(map(lambda x: -loop_unedited_words(src, x), src_sim))
+    topk = sorted(zip(scores, range(len(scores))), key=lambda x: x[0])[:k]
+    return [it[1] for it in topk]
+
+def random_text(rng,num_tokens,vocab_size):
+    return " ".join(f"w{i}" for i in rng.integers(0,vocab_size,num_tokens))
+
+def timeit(fn,queries,hits,k):
+    start = time.perf_counter()
+    ret = [fn(query,hits,k) for query in queries]
+    return ret,(time.perf_counter()-start)/len(queries)
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    for size in args.sizes:
+        num_tokens,num_hits = map(int,size.split('x'))
+        queries = [random_text(rng,num_tokens,args.vocab_size) for _ in range(args.repeats)]
+        ## hits of similar length, a few of them close to the query
+        hits = [random_text(rng,int(num_tokens*rng.uniform(0.5,1.5))+1,args.vocab_size) for _ in range(num_hits)]
+        loop_ret,loop_time = timeit(loop_topk_sent_id,queries,hits,args.k)
+        batch_ret,batch_time = timeit(get_topk_sent_id,queries,hits,args.k)
+        assert loop_ret == batch_ret,size
+        print(f"{size:>10}  loop {loop_time*1000:8.3f}ms  batched {batch_time*1000:8.3f}ms  speedup {loop_time/batch_time:5.2f}x")
@@ -5,10 +5,14 @@ import os
 import logging
 import json
 import tqdm
-from elasticsearch import Elasticsearch
 import re
+from collections import Counter
+import numpy as np
 import sacrebleu
-import editdistance
+import sys
+sys.path.append("..")
+from utils.metrics_utils import get_batch_edit_distance,get_topk_by_edit_distance
+from utils.memory_utils import ids_to_array
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -19,13 +23,36 @@ def parse_args():
         help='whether to search from a built index')
     parser.add_argument('--index_file', type=str)
     parser.add_argument('--search_file', type=str)
-    parser.add_argument('--output_file', type=str)
+    parser.add_argument('--output_file', type=str,
+        help='.pkl for a list of id lists, .npy for an int32 [N,topk] array padded with -1')
     parser.add_argument('--query_lang', type=str)
     # parser.add_argument('--response_lang', type=str)
     parser.add_argument('--start_index', type=int,default=0)
     parser.add_argument('--end_index', type=int,default=-1)
     parser.add_argument('--index_name', type=str,default='used_once')
     parser.add_argument('--topk', type=int, default=10)
+    parser.add_argument('--backend', type=str, default='es', choices=['es','inproc'],
+        help='es: search a live Elasticsearch; inproc: in-process inverted index, no service needed')
+    parser.add_argument('--index_path', type=str, default=None,
+        help='where the inproc index is saved/loaded, defaults to {index_name}.bm25 (a directory of .npy arrays)')
+    parser.add_argument('--batch_size', type=int, default=16,
+        help='number of queries scored together by the inproc backend')
+    parser.add_argument('--es_bulk_threads', type=int, default=4,
+        help='parallel bulk workers when building the elasticsearch index')
+    parser.add_argument('--es_bulk_size', type=int, default=1000,
+        help='documents per bulk request when building the elasticsearch index')
+    parser.add_argument('--es_batch_size', type=int, default=64,
+        help='queries per elasticsearch _msearch request, 0 for one search request per query')
+    parser.add_argument('--es_concurrency', type=int, default=8,
+        help='_msearch requests kept in flight over a pooled async client, 1 for blocking requests')
+    parser.add_argument('--edit_rerank', type=int, default=None,
+        help='re-score the bm25 topk by edit distance to the indexed text and keep this many, needs --index_file')
+    parser.add_argument('--prune_terms', type=int, default=None,
+        help='rewrite every query to its N highest idf-weighted terms')
+    parser.add_argument('--idf_path', type=str, default=None,
+        help='idf statistics of the index_file used by --prune_terms, defaults to {index_name}.idf.npz')
+    parser.add_argument('--prune_eval', type=int, default=0,
+        help='report recall@topk and latency of the pruned against the full query on the first N queries')
     # parser.add_argument('--allow_hit', action='store_true')
     return parser.parse_args()
 
@@ -36,150 +63,516 @@ def get_unedited_words(src_sent, src_tm_sent):
     # Here first sentence is the edited sentence and the second sentence is the target sentence
     # If src_sent is the first sentence, then insertion and deletion should be reversed.
     """ Dynamic Programming Version of edit distance and finding unedited words."""
-    a = src_sent.split()
-    b = src_tm_sent.split()
-    edit_distance = editdistance.eval(a, b)
+    return float(get_batch_edit_distance(src_sent, [src_tm_sent])[0])
 
-    edit_distance = 1 - edit_distance / max(len(src_sent), len(src_tm_sent))
+def get_topk_sent_id(src, src_sim, k=6):
+    ## all candidates are scored in one batched pass, same ranking as get_unedited_words
+    return get_topk_by_edit_distance(src, src_sim, k)
 
-    return edit_distance
+def edit_rerank(queries, ret, docs, k):
+    """
+    re-score the bm25 hits of each query by edit distance against the indexed text and keep the top k
+    """
+    reranked = []
+    for query,hits in zip(queries,ret):
+        top = get_topk_sent_id(query,[docs[i] for i in hits],k)
+        reranked.append([hits[i] for i in top])
+    return reranked
 
-def get_topk_sent_id(src, src_sim, k=6):
-    scores = list(map(lambda x: -get_unedited_words(src, x), src_sim))
-    topk = sorted(zip(scores, range(len(scores))), key=lambda x: x[0])[:k]
-    ans = [it[1] for it in topk]
-    return ans
+def analyze(text):
+    ## rough equivalent of the ES standard analyzer: unicode word split + lowercase
+    return re.findall(r'\w+', text.lower())
 
-def main(args):
-    logger = logging.getLogger(__name__)
-    logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s - %(message)s',
-            datefmt = '%m/%d/%Y %H:%M:%S', level = logging.INFO)
-    es_logger = logging.getLogger('elasticsearch')
-    es_logger.setLevel(logging.WARNING)
+class InprocBM25:
+    """
+    In-process BM25 with the same scoring as the ES `BM25` similarity (k1=1.2, b=0.75).
+    Postings are stored term-major as CSR arrays:
+        indptr[t]:indptr[t+1] -> (doc_ids, weights) of term t
+    where weights already hold the tf/length-normalization part, so a query only needs
+    idf * query_tf on top. Scoring a batch of queries is a single bincount over the
+    concatenated postings.
+    """
+    def __init__(self,vocab,indptr,doc_ids,weights,idf,num_docs):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.idf = idf
+        self.num_docs = num_docs
 
-    es = Elasticsearch([{u'host': "localhost", u'port': "9200"}])
-    if args.build_index:
-        # queries, responses = [], []
-        queries = []
-        responses  = []
-        with open(args.index_file,'r') as f:
-            for idx,line in enumerate(f.readlines()):
-                line = json.loads(line)
-                queries.append(" ".join(line[args.query_lang].split()[:600]))
-                responses.append(idx)
-                # responses.append(line[args.response_lang])
-        # with open(args.index_file, 'r') as f:
-        #     for line in f.readlines():
-        #         q, r = line.strip().split('\t')
-        #         queries.append(q)
-        #         responses.append(r)
+    @classmethod
+    def build(cls,docs,k1=1.2,b=0.75,total=None):
+        vocab = {}
+        term_ids,doc_ids,tfs,doc_lens = [],[],[],[]
+        for doc_id,doc in enumerate(tqdm.tqdm(docs,total=total)):
+            tokens = analyze(doc)
+            doc_lens.append(len(tokens))
+            for term,tf in Counter(tokens).items():
+                term_ids.append(vocab.setdefault(term,len(vocab)))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+        num_docs = len(doc_lens)
+        term_ids = np.asarray(term_ids,dtype=np.int32)
+        doc_ids = np.asarray(doc_ids,dtype=np.int32)
+        tfs = np.asarray(tfs,dtype=np.float32)
+        doc_lens = np.asarray(doc_lens,dtype=np.float32)
 
-        logger.info('build with elasticsearch')
-        from elasticsearch.helpers import bulk
-        body = {
-            "settings": {
-                "index": {
-                    "analysis": {
-                        "analyzer": "standard"
-                    },
-                    "number_of_shards": "1",
-                    "number_of_replicas": "1",
-                }
-            },
-            "mappings": {
-                "properties": {
-                    "query": {
-                        "type": "text",
-                        "similarity": "BM25",
-                        "analyzer": "standard",
-                    },
-                    "response": {
-                        "type": "text",
-                    }
-                }
-            }
-        }
-        if es.indices.exists(index=args.index_name):
-            es.indices.delete(index=args.index_name)
-        es.indices.create(index=args.index_name, body=body)
+        order = np.argsort(term_ids,kind='stable')
+        term_ids,doc_ids,tfs = term_ids[order],doc_ids[order],tfs[order]
+        df = np.bincount(term_ids,minlength=len(vocab))
+        indptr = np.zeros(len(vocab)+1,dtype=np.int64)
+        np.cumsum(df,out=indptr[1:])
+
+        avgdl = max(doc_lens.mean(),1.0) if num_docs else 1.0
+        norm = k1 * (1 - b + b * doc_lens[doc_ids] / avgdl)
+        weights = (tfs * (k1 + 1) / (tfs + norm)).astype(np.float32)
+        idf = np.log(1 + (num_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        return cls(vocab,indptr,doc_ids,weights,idf,num_docs)
+
+    def save(self,path):
+        """
+        path: a directory holding every CSR array as its own .npy, so load can memory-map them
+        """
+        os.makedirs(path,exist_ok=True)
+        for name in ('indptr','doc_ids','weights','idf'):
+            np.save(os.path.join(path,name+'.npy'),getattr(self,name))
+        with open(os.path.join(path,'vocab.json'),'w') as f:
+            json.dump({'num_docs':int(self.num_docs),'terms':sorted(self.vocab,key=self.vocab.get)},f)
+
+    @classmethod
+    def load(cls,path,mmap_mode=None):
+        """
+        mmap_mode='r' maps the postings instead of reading them, the vocab is always read
+        an index saved as a single .npz (the format before the .npy directory) is still read,
+        but fully into memory since np.load cannot map the arrays of an archive
+        """
+        if not os.path.exists(path) and os.path.isfile(path+'.npz'):
+            path = path+'.npz'
+        if os.path.isfile(path):
+            if mmap_mode is not None:
+                logging.getLogger(__name__).warning(f"{path} is a legacy .npz index, loaded without mmap; save it again to map it")
+            f = np.load(path,allow_pickle=True)
+            vocab = {t:i for i,t in enumerate(f['terms'].tolist())}
+            return cls(vocab,f['indptr'],f['doc_ids'],f['weights'],f['idf'],int(f['num_docs']))
+        with open(os.path.join(path,'vocab.json')) as f:
+            meta = json.load(f)
+        vocab = {t:i for i,t in enumerate(meta['terms'])}
+        indptr,doc_ids,weights,idf = [np.load(os.path.join(path,name+'.npy'),mmap_mode=mmap_mode) for name in ('indptr','doc_ids','weights','idf')]
+        return cls(vocab,indptr,doc_ids,weights,idf,meta['num_docs'])
+
+    def _query_terms(self,query):
+        ## repeated query terms are separate `should` clauses in ES, so they count multiple times
+        counts = Counter(self.vocab[t] for t in analyze(query) if t in self.vocab)
+        return list(counts.items())
+
+    def split(self,num_shards):
+        """
+        partition the index by contiguous doc id ranges
+        every shard keeps the global idf and length normalization, so its scores are the
+        scores of the full index and the merged per-shard topk is the topk of the full index
+        return: list of (first doc id,InprocBM25 over local doc ids)
+        """
+        bounds = np.linspace(0,self.num_docs,num_shards+1).astype(np.int64)
+        term_ids = np.repeat(np.arange(len(self.indptr)-1),np.diff(self.indptr))
+        shards = []
+        for lo,hi in zip(bounds[:-1],bounds[1:]):
+            mask = (self.doc_ids >= lo) & (self.doc_ids < hi)
+            indptr = np.zeros_like(self.indptr)
+            np.cumsum(np.bincount(term_ids[mask],minlength=len(indptr)-1),out=indptr[1:])
+            doc_ids = (self.doc_ids[mask] - lo).astype(np.int32)
+            shards.append((int(lo),InprocBM25(self.vocab,indptr,doc_ids,self.weights[mask],self.idf,int(hi-lo))))
+        return shards
 
-        index = args.index_name
+    def search(self,queries,topk=10,return_scores=False):
+        """
+        queries: list of str, scored together
+        return: list of list of doc ids, best first, only docs matching at least one term (like ES hits)
+            or list of list of (score,doc id) with return_scores
+        """
+        doc_parts,weight_parts = [],[]
+        for q_idx,query in enumerate(queries):
+            for term_id,qtf in self._query_terms(query):
+                start,end = self.indptr[term_id],self.indptr[term_id+1]
+                doc_parts.append(self.doc_ids[start:end].astype(np.int64) + q_idx * self.num_docs)
+                weight_parts.append(self.weights[start:end] * (self.idf[term_id] * qtf))
+        if not doc_parts or self.num_docs == 0:
+            return [[] for _ in queries]
+        scores = np.bincount(
+            np.concatenate(doc_parts),
+            weights=np.concatenate(weight_parts),
+            minlength=len(queries) * self.num_docs,
+        ).reshape(len(queries),self.num_docs)
 
-        actions = []
+        k = min(topk,self.num_docs)
+        top = np.argpartition(-scores,k-1,axis=1)[:,:k]
+        ret = []
+        for q_idx in range(len(queries)):
+            ids = top[q_idx]
+            ## ties broken by doc id, as ES does
+            ids = ids[np.lexsort((ids,-scores[q_idx,ids]))]
+            if return_scores:
+                ret.append([(float(scores[q_idx,i]),int(i)) for i in ids if scores[q_idx,i] > 0])
+            else:
+                ret.append([int(i) for i in ids if scores[q_idx,i] > 0])
+        return ret
+
+class QueryPruner:
+    """
+    Query reduction for long-document queries: every query is rewritten to its num_terms
+    highest-weight terms, weight = idf * query_tf as in the BM25 query side.
+    Corpus statistics are kept as one float32 idf array over the sorted vocabulary.
+    """
+    def __init__(self,vocab,idf):
+        self.vocab = vocab
+        self.idf = idf
+
+    @classmethod
+    def build(cls,docs,total=None):
+        vocab = {}
+        df = []
+        for doc in tqdm.tqdm(docs,total=total):
+            for term in set(analyze(doc)):
+                term_id = vocab.setdefault(term,len(vocab))
+                if term_id == len(df):
+                    df.append(0)
+                df[term_id] += 1
+        df = np.asarray(df,dtype=np.float32)
+        num_docs = len(docs) if total is None else total
+        idf = np.log(1 + (num_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        return cls(vocab,idf)
+
+    @classmethod
+    def from_engine(cls,engine):
+        ## the inproc index already holds the same statistics
+        return cls(engine.vocab,engine.idf)
+
+    def save(self,path):
+        terms = np.array(sorted(self.vocab,key=self.vocab.get),dtype=object)
+        with open(path,'wb') as f:
+            np.savez(f,terms=terms,idf=self.idf)
+
+    @classmethod
+    def load(cls,path):
+        f = np.load(path,allow_pickle=True)
+        return cls({t:i for i,t in enumerate(f['terms'].tolist())},f['idf'])
+
+    def prune(self,query,num_terms):
+        """
+        terms not in the corpus match nothing and are dropped, the kept terms stay in
+        query order with every occurrence, so their relative weights do not change
+        """
+        tokens = [t for t in analyze(query) if t in self.vocab]
+        counts = Counter(tokens)
+        if len(counts) > num_terms:
+            ## ties broken by first occurrence
+            ranked = sorted(counts,key=lambda t:-self.idf[self.vocab[t]] * counts[t])
+            keep = set(ranked[:num_terms])
+            tokens = [t for t in tokens if t in keep]
+        return " ".join(tokens)
+
+def compare_pruning(search_fn,queries,pruner,num_terms,topk):
+    """
+    search_fn: list of queries -> list of id lists
+    return: recall@topk of the pruned queries against the full queries, and the search time of both
+    """
+    import time
+    pruned = [pruner.prune(q,num_terms) for q in queries]
+    start = time.time()
+    full_ret = search_fn(queries)
+    full_time = time.time() - start
+    start = time.time()
+    pruned_ret = search_fn(pruned)
+    pruned_time = time.time() - start
+    recall = [len(set(x[:topk]) & set(y[:topk])) / len(x[:topk]) for x,y in zip(full_ret,pruned_ret) if x]
+    return {
+        "num_queries":len(queries),
+        "num_terms":num_terms,
+        "avg_full_tokens":float(np.mean([len(analyze(q)) for q in queries])) if queries else 0.0,
+        "avg_pruned_tokens":float(np.mean([len(q.split()) for q in pruned])) if queries else 0.0,
+        f"recall@{topk}":float(np.mean(recall)) if recall else 0.0,
+        "full_ms_per_query":1000 * full_time / max(len(queries),1),
+        "pruned_ms_per_query":1000 * pruned_time / max(len(queries),1),
+    }
+
+def get_query_pruner(path,index_file,query_lang,engine=None,rebuild=False):
+    """
+    idf statistics of the indexed corpus, loaded from path or computed once and saved there
+    rebuild: recompute them, e.g. because the index was just rebuilt
+    """
+    if engine is not None:
+        return QueryPruner.from_engine(engine)
+    if os.path.exists(path) and not rebuild:
+        return QueryPruner.load(path)
+    pruner = QueryPruner.build(read_queries(index_file,query_lang))
+    pruner.save(path)
+    return pruner
 
-        for idx, (query, response) in tqdm.tqdm(enumerate(zip(queries, responses)), total=len(queries)):
-            action = {
-                "_index": index,
+def parse_query(line,query_lang):
+    line = json.loads(line)
+    return " ".join(line[query_lang].split()[:600])
+
+def read_queries(path,query_lang,start_index=0,end_index=-1):
+    queries = []
+    with open(path, 'r') as f:
+        for idx,line in enumerate(f):
+            if end_index > 0:
+                if idx >= end_index:break
+                if idx < start_index:continue
+            queries.append(parse_query(line,query_lang))
+    return queries
+
+def iter_es_actions(index_name,index_file,query_lang,start_index=0,end_index=-1):
+    """
+    one bulk action per line of index_file in [start_index,end_index), streamed from disk
+    the response field is always the line number in the whole file
+    """
+    with open(index_file,'r') as f:
+        for idx,line in enumerate(f):
+            if idx < start_index:continue
+            if end_index >= 0 and idx >= end_index:break
+            yield {
+                "_index": index_name,
                 "_source": {
                     # "query": debpe(query),
-                    "query": query,
-                    "response": response
+                    "query": parse_query(line,query_lang),
+                    "response": idx,
+                }
+            }
+
+def build_es_index(es,index_name,index_file,query_lang,thread_count=4,chunk_size=1000,number_of_replicas=1,start_index=0,end_index=-1):
+    """
+    start_index,end_index: only index these lines of index_file, e.g. one partition of a sharded bank
+    documents are streamed and sent by thread_count parallel bulk workers, with refresh and
+    replicas disabled during the load; both are restored before the final refresh
+    """
+    import time
+    from elasticsearch.helpers import parallel_bulk
+    body = {
+        "settings": {
+            "index": {
+                "analysis": {
+                    "analyzer": "standard"
+                },
+                "number_of_shards": "1",
+                ## restored after the load
+                "number_of_replicas": "0",
+                "refresh_interval": "-1",
+            }
+        },
+        "mappings": {
+            "properties": {
+                "query": {
+                    "type": "text",
+                    "similarity": "BM25",
+                    "analyzer": "standard",
+                },
+                "response": {
+                    "type": "text",
                 }
             }
-            actions.append(action)
-            if len(actions) >= 1000:
-                success, _ = bulk(es, actions, raise_on_error=True)
-                actions = []
-        if actions:
-            success, _ = bulk(es, actions, raise_on_error=True)
-        es.indices.refresh(index)
-        info = es.indices.stats(index=index)
-        print('total document indexed', info["indices"][index]["primaries"]["docs"]["count"]) 
+        }
+    }
+    if es.indices.exists(index=index_name):
+        es.indices.delete(index=index_name)
+    es.indices.create(index=index_name, body=body)
+
+    start = time.time()
+    total = sum(1 for _ in open(index_file))
+    total = (total if end_index < 0 else min(end_index,total)) - start_index
+    actions = iter_es_actions(index_name,index_file,query_lang,start_index,end_index)
+    for success, info in tqdm.tqdm(parallel_bulk(es, actions, thread_count=thread_count, chunk_size=chunk_size, raise_on_error=True),total=total):
+        if not success:
+            raise RuntimeError(info)
+    load_time = time.time() - start
+
+    ## refresh_interval None resets it to the default
+    es.indices.put_settings(index=index_name, body={"index": {"number_of_replicas": str(number_of_replicas), "refresh_interval": None}})
+    es.indices.refresh(index=index_name)
+    info = es.indices.stats(index=index_name)
+    count = info["indices"][index_name]["primaries"]["docs"]["count"]
+    print(f"indexed {count} documents in {load_time:.1f}s, {count/max(load_time,1e-6):.0f} docs/sec")
+    return count
+
+def search_es(es,index_name,queries,topk=10,progress_bar=True,batch_size=None,return_scores=False):
+    """
+    batch_size: None sends one search per query, otherwise batch_size queries per _msearch
+    return_scores: (score,id) pairs instead of ids, _msearch only
+    """
+    if batch_size is not None:
+        filter_path = MSEARCH_FILTER_PATH + (["responses.hits.hits._score"] if return_scores else [])
+        ret = []
+        for idx in tqdm.tqdm(range(0,len(queries),batch_size),disable=not progress_bar):
+            batch = queries[idx:idx+batch_size]
+            ret.extend(parse_msearch(es.msearch(body=msearch_body(batch,topk),index=index_name,filter_path=filter_path),len(batch),return_scores))
+        return ret
+    assert not return_scores,'return_scores needs batch_size'
+
+    query_body = {
+            "query": {
+            "match":{
+                 "query": None
+             }
+            },
+            "size": topk
+    }
+
+    ret = []
+    for idx,query in enumerate(tqdm.tqdm(queries,disable=not progress_bar)):
+        # query_body["query"]["match"]["query"] = debpe(query)
+        query_body["query"]["match"]["query"] = query
+        es_result = es.search(index=index_name, body=query_body)
+        ret_q = [item["_source"]["query"] for item in es_result["hits"]["hits"]]
+        ret_r = [item["_source"]["response"] for item in es_result["hits"]["hits"]]
+        
+        
+        if len(ret_q) == 0 or len(ret_r) == 0:
+            ret.append([])
+            continue
+        ret.append(ret_r)
+    return ret
+
+## only the row ids (and errors) come back over the wire, not the indexed text
+MSEARCH_FILTER_PATH = ["responses.hits.hits._source.response","responses.error"]
+
+def msearch_body(queries,topk):
+    body = []
+    for query in queries:
+        body.append({})
+        body.append({"query":{"match":{"query":query}},"size":topk,"_source":["response"]})
+    return body
+
+def parse_msearch(es_result,num_queries,return_scores=False):
+    responses = es_result.get("responses",[])
+    assert len(responses) == num_queries,(len(responses),num_queries)
+    ret = []
+    for response in responses:
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        hits = response.get("hits",{}).get("hits",[])
+        if return_scores:
+            ret.append([(item["_score"],item["_source"]["response"]) for item in hits])
+        else:
+            ret.append([item["_source"]["response"] for item in hits])
+    return ret
+
+def search_es_async(index_name,queries,topk=10,batch_size=64,concurrency=8,progress_bar=True):
+    """
+    _msearch of batch_size queries, with up to concurrency requests in flight over one pooled async client
+    results keep the order of queries
+    """
+    import asyncio
+
+    async def _search():
+        es = get_es_client(use_async=True,maxsize=concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
+        pbar = tqdm.tqdm(total=len(queries),disable=not progress_bar)
+
+        async def _msearch(batch):
+            async with semaphore:
+                es_result = await es.msearch(body=msearch_body(batch,topk),index=index_name,filter_path=MSEARCH_FILTER_PATH)
+            pbar.update(len(batch))
+            return parse_msearch(es_result,len(batch))
+
+        try:
+            batches = [queries[idx:idx+batch_size] for idx in range(0,len(queries),batch_size)]
+            outputs = await asyncio.gather(*[_msearch(batch) for batch in batches])
+        finally:
+            pbar.close()
+            await es.close()
+        return [x for y in outputs for x in y]
+
+    return asyncio.run(_search())
+
+def dump_ids(ret,path,k):
+    if path.endswith('.npy'):
+        np.save(path,ids_to_array(ret,k))
+    else:
+        pickle.dump(ret,open(path,'wb'))
+
+def get_es_client(use_async=False,maxsize=10):
+    if use_async:
+        ## pip install elasticsearch[async]
+        from elasticsearch import AsyncElasticsearch
+        return AsyncElasticsearch([{u'host': "localhost", u'port': "9200"}],maxsize=maxsize)
+    from elasticsearch import Elasticsearch
+    return Elasticsearch([{u'host': "localhost", u'port': "9200"}])
+
+def main(args):
+    logger = logging.getLogger(__name__)
+    logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+            datefmt = '%m/%d/%Y %H:%M:%S', level = logging.INFO)
+    es_logger = logging.getLogger('elasticsearch')
+    es_logger.setLevel(logging.WARNING)
+
+    if args.backend == 'inproc':
+        main_inproc(args,logger)
+        return
+
+    es = get_es_client()
+    if args.build_index:
+        logger.info('build with elasticsearch')
+        print('total document indexed', build_es_index(es,args.index_name,args.index_file,args.query_lang,args.es_bulk_threads,args.es_bulk_size))
 
     if args.search_index:
-        queries = []
         print(args.search_file,args.start_index,args.end_index)
+        queries = read_queries(args.search_file,args.query_lang,args.start_index,args.end_index)
 
-        with open(args.search_file, 'r') as f:
-            if args.end_index > 0:
-                _t = []
-                idx = 0
-                for x in f:
-                    if idx >= args.start_index and idx < args.end_index:
-                        _t.append(x)
-                    idx += 1
-                # _t = f.readlines()[args.start_index:args.end_index]
+        def search_fn(queries,progress_bar=True):
+            if args.es_batch_size <= 0:
+                return search_es(es,args.index_name,queries,args.topk,progress_bar)
+            elif args.es_concurrency > 1:
+                return search_es_async(args.index_name,queries,args.topk,args.es_batch_size,args.es_concurrency,progress_bar)
             else:
-                _t = f.readlines()
-            for line in _t:
-            # for line in f.readlines():
-                line = json.loads(line)
-                temp_query = line[args.query_lang]
-                temp_query = " ".join(temp_query.split()[:600])
-                # q, r = line.strip().split('\t')
-                queries.append(temp_query)
-                # responses.append()
+                return search_es(es,args.index_name,queries,args.topk,progress_bar,batch_size=args.es_batch_size)
 
         logger.info('search with elasticsearch')
+        ret = search_fn(prune_queries(queries,args,logger,search_fn))
+        if args.edit_rerank is not None:
+            ret = edit_rerank(queries,ret,read_queries(args.index_file,args.query_lang),args.edit_rerank)
+        miss_cnt = sum(1 for x in ret if len(x) == 0)
+        dump_ids(ret,args.output_file,args.edit_rerank or args.topk)
+        print(miss_cnt)
 
-        index = args.index_name
-        query_body = {
-                "query": {
-                "match":{
-                     "query": None
-                 }
-                },
-                "size": args.topk
-        }
+def prune_queries(queries,args,logger,search_fn,engine=None):
+    """
+    queries as searched: pruned to --prune_terms terms when set, optionally reporting what that costs
+    edit_rerank still compares against the full queries
+    """
+    if args.prune_terms is None:
+        return queries
+    idf_path = args.idf_path if args.idf_path is not None else args.index_name+'.idf.npz'
+    pruner = get_query_pruner(idf_path,args.index_file,args.query_lang,engine,rebuild=args.build_index)
+    if args.prune_eval > 0:
+        report = compare_pruning(lambda x:search_fn(x,progress_bar=False),queries[:args.prune_eval],pruner,args.prune_terms,args.topk)
+        logger.info('query pruning: '+json.dumps(report))
+    return [pruner.prune(q,args.prune_terms) for q in queries]
 
-        ret = []
-        miss_cnt = 0
-        # with open(args.output_file,'w') as fo:
-        # for idx,query in enumerate(tqdm.tqdm(queries, total=len(queries))):
-        for idx,query in enumerate(tqdm.tqdm(queries)):
-            # query_body["query"]["match"]["query"] = debpe(query)
-            query_body["query"]["match"]["query"] = query
-            es_result = es.search(index=index, body=query_body)
-            ret_q = [item["_source"]["query"] for item in es_result["hits"]["hits"]]
-            ret_r = [item["_source"]["response"] for item in es_result["hits"]["hits"]]
-            
-            
-            if len(ret_q) == 0 or len(ret_r) == 0:
-                ret.append([])
-                miss_cnt += 1
-                continue
-            ret.append(ret_r)
-        pickle.dump(ret,open(args.output_file,'wb'))
+def main_inproc(args,logger):
+    index_path = args.index_path if args.index_path is not None else args.index_name+'.bm25'
+    if args.build_index:
+        logger.info('build with inproc bm25')
+        engine = InprocBM25.build(read_queries(args.index_file,args.query_lang))
+        engine.save(index_path)
+        print('total document indexed', engine.num_docs)
+
+    if args.search_index:
+        if not args.build_index:
+            engine = InprocBM25.load(index_path)
+        print(args.search_file,args.start_index,args.end_index)
+        queries = read_queries(args.search_file,args.query_lang,args.start_index,args.end_index)
+
+        def search_fn(queries,progress_bar=True):
+            ret = []
+            for idx in tqdm.tqdm(range(0,len(queries),args.batch_size),disable=not progress_bar):
+                ret.extend(engine.search(queries[idx:idx+args.batch_size],args.topk))
+            return ret
+
+        logger.info('search with inproc bm25')
+        ret = search_fn(prune_queries(queries,args,logger,search_fn,engine))
+        if args.edit_rerank is not None:
+            ret = edit_rerank(queries,ret,read_queries(args.index_file,args.query_lang),args.edit_rerank)
+        miss_cnt = sum(1 for x in ret if len(x) == 0)
+        dump_ids(ret,args.output_file,args.edit_rerank or args.topk)
         print(miss_cnt)
 
 if __name__ == "__main__":
@@ -0,0 +1,303 @@
+"""
+Dense memory retrieval with the dual_tower reranker encoder (train_reranker.py --architecture dual_tower).
+
+The memory bank is encoded once into a float16 memory-mapped matrix of L2-normalized
+pooler_output embeddings, so the inner product is the cosine similarity the reranker
+is trained with. Queries are searched either exactly (flat, chunked matrix product)
+or approximately through an inverted file (IVF), optionally with product-quantized
+codes (PQ). The output {split}.ids.npy is the int32 [N,topk] array retrieval2memory.py
+consumes (python retrieval2memory.py --retrieval dense).
+"""
+import os
+import sys
+import argparse
+import numpy as np
+from tqdm import tqdm
+sys.path.append("..")
+from utils.data_utils import JsonlFile
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='cnndm')
+    parser.add_argument('--data_dir', default='/data')
+    parser.add_argument('--model_path', required=True,
+        help='dual_tower reranker saved by train_reranker.py (AutoModel + tokenizer)')
+    parser.add_argument('--query_lang', default='document',
+        help='field of {split}.jsonl used as query')
+    parser.add_argument('--index_key', default='summary',
+        help='field of train.jsonl that is encoded into the memory bank')
+    parser.add_argument('--query_max_len', type=int, default=512)
+    parser.add_argument('--memory_max_len', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--splits', nargs='+', default=['dev','test','train'])
+    parser.add_argument('--topk', type=int, default=10)
+    parser.add_argument('--index', default='flat', choices=['flat','ivf','ivfpq'])
+    parser.add_argument('--nlist', type=int, default=1024,
+        help='number of ivf lists')
+    parser.add_argument('--nprobe', type=int, default=16,
+        help='number of ivf lists searched per query')
+    parser.add_argument('--pq_m', type=int, default=16,
+        help='number of pq sub-quantizers, must divide the hidden size')
+    parser.add_argument('--pq_refine', type=int, default=4,
+        help='re-score the best topk*pq_refine pq hits exactly, 0 to rank by pq codes only')
+    parser.add_argument('--skip_encode', action='store_true',
+        help='reuse already encoded memory embeddings and ivf index')
+    return parser.parse_args()
+
+class Encoder:
+
+    def __init__(self,model_path,device='cuda'):
+        import torch
+        from transformers import AutoTokenizer,AutoModel
+        self.torch = torch
+        self.device = device if torch.cuda.is_available() else 'cpu'
+        self.toker = AutoTokenizer.from_pretrained(model_path)
+        self.model = AutoModel.from_pretrained(model_path).to(self.device).eval()
+        if self.device != 'cpu':
+            self.model.half()
+
+    @property
+    def hidden_size(self):
+        return self.model.config.hidden_size
+
+    def __call__(self,texts,max_length):
+        """
+        texts: list of str
+        return: float32 [len(texts),hidden_size], L2-normalized pooler_output
+        """
+        with self.torch.no_grad():
+            tokenized = self.toker(texts,return_tensors='pt',padding=True,truncation=True,max_length=max_length).to(self.device)
+            embedding = self.model(**tokenized).pooler_output.float()
+            embedding = self.torch.nn.functional.normalize(embedding,dim=-1)
+        return embedding.cpu().numpy()
+
+def iter_batches(texts,batch_size):
+    for idx in range(0,len(texts),batch_size):
+        yield [texts[i] for i in range(idx,min(idx+batch_size,len(texts)))]
+
+def encode_memory(texts,encoder,path,max_length,batch_size):
+    """
+    texts: sequence of str, encoded batch by batch into a float16 [N,hidden_size] .npy, memory-mapped on load
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    embeddings = np.lib.format.open_memmap(tmp_path,mode='w+',dtype=np.float16,shape=(len(texts),encoder.hidden_size))
+    start = 0
+    for batch in tqdm(iter_batches(texts,batch_size),total=(len(texts)+batch_size-1)//batch_size,desc='memory'):
+        embeddings[start:start+len(batch)] = encoder(batch,max_length)
+        start += len(batch)
+    embeddings.flush()
+    del embeddings
+    os.replace(tmp_path,path)
+    return np.load(path,mmap_mode='r')
+
+def merge_topk(ids,scores,new_ids,new_scores,k):
+    """
+    keep the k best of two [q,*] candidate sets, best first, ties by smaller id
+    """
+    ids = np.concatenate([ids,new_ids],axis=1)
+    scores = np.concatenate([scores,new_scores],axis=1)
+    if ids.shape[1] > k:
+        top = np.argpartition(-scores,k-1,axis=1)[:,:k]
+        ids = np.take_along_axis(ids,top,axis=1)
+        scores = np.take_along_axis(scores,top,axis=1)
+    order = np.lexsort((ids,-scores),axis=1)
+    return np.take_along_axis(ids,order,axis=1),np.take_along_axis(scores,order,axis=1)
+
+def kmeans(x,k,niter=10,seed=0,spherical=False):
+    """
+    plain Lloyd's k-means, spherical: assign by inner product and keep unit-norm centroids
+    """
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x,dtype=np.float32)
+    centroids = x[rng.choice(len(x),k,replace=len(x) < k)].copy()
+    for _ in range(niter):
+        assign = assign_centroids(x,centroids,spherical)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums,assign,x)
+        counts = np.bincount(assign,minlength=k)
+        empty = counts == 0
+        ## empty clusters are re-seeded with random points
+        sums[empty] = x[rng.choice(len(x),int(empty.sum()))]
+        counts[empty] = 1
+        centroids = sums / counts[:,None]
+        if spherical:
+            centroids /= np.maximum(np.linalg.norm(centroids,axis=1,keepdims=True),1e-12)
+    return centroids
+
+def assign_centroids(x,centroids,spherical=False,chunk_size=65536):
+    assign = np.empty(len(x),dtype=np.int64)
+    c_norm = (centroids**2).sum(1)
+    for start in range(0,len(x),chunk_size):
+        chunk = np.asarray(x[start:start+chunk_size],dtype=np.float32)
+        if spherical:
+            assign[start:start+len(chunk)] = (chunk @ centroids.T).argmax(1)
+        else:
+            assign[start:start+len(chunk)] = (c_norm[None,:] - 2 * chunk @ centroids.T).argmin(1)
+    return assign
+
+class FlatIndex:
+    """
+    exact inner-product search over the memory-mapped embeddings
+    """
+    def __init__(self,embeddings,chunk_size=65536):
+        self.embeddings = embeddings
+        self.chunk_size = chunk_size
+
+    def search(self,queries,topk):
+        """
+        queries: float32 [q,d], L2-normalized
+        return: ids int64 [q,topk], best first
+        """
+        topk = min(topk,len(self.embeddings))
+        ids = np.zeros((len(queries),0),dtype=np.int64)
+        scores = np.zeros((len(queries),0),dtype=np.float32)
+        for start in range(0,len(self.embeddings),self.chunk_size):
+            chunk = np.asarray(self.embeddings[start:start+self.chunk_size],dtype=np.float32)
+            chunk_scores = queries @ chunk.T
+            k = min(topk,chunk_scores.shape[1])
+            top = np.argpartition(-chunk_scores,k-1,axis=1)[:,:k]
+            ids,scores = merge_topk(ids,scores,top+start,np.take_along_axis(chunk_scores,top,axis=1),topk)
+        return ids
+
+class IVFIndex:
+    """
+    inverted file over spherical k-means cells, searched in the nprobe closest cells:
+        -without pq: exact scores against the float16 embeddings of the probed cells
+        -with pq: asymmetric distance, the query is compared to m uint8 codes per vector,
+         the best topk*refine are re-scored exactly
+    """
+    def __init__(self,centroids,indptr,order,embeddings,codebooks=None,codes=None):
+        self.centroids = centroids
+        self.indptr = indptr
+        self.order = order
+        self.embeddings = embeddings
+        self.codebooks = codebooks
+        self.codes = codes
+
+    @classmethod
+    def build(cls,embeddings,nlist,pq_m=None,train_size=100000,seed=0):
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(len(embeddings),min(train_size,len(embeddings)),replace=False))
+        sample = np.asarray(embeddings[sample],dtype=np.float32)
+        centroids = kmeans(sample,min(nlist,len(sample)),seed=seed,spherical=True)
+        assign = assign_centroids(embeddings,centroids,spherical=True)
+        order = np.argsort(assign,kind='stable')
+        indptr = np.zeros(len(centroids)+1,dtype=np.int64)
+        np.cumsum(np.bincount(assign,minlength=len(centroids)),out=indptr[1:])
+        codebooks = codes = None
+        if pq_m is not None:
+            d = embeddings.shape[1]
+            assert d % pq_m == 0,(d,pq_m)
+            dsub = d // pq_m
+            codebooks = np.stack([
+                kmeans(sample[:,j*dsub:(j+1)*dsub],min(256,len(sample)),seed=seed) for j in range(pq_m)
+            ])
+            codes = np.empty((len(embeddings),pq_m),dtype=np.uint8)
+            for j in range(pq_m):
+                codes[:,j] = assign_centroids(embeddings[:,j*dsub:(j+1)*dsub],codebooks[j])
+        return cls(centroids,indptr,order,embeddings,codebooks,codes)
+
+    def save(self,path):
+        arrays = {'centroids':self.centroids,'indptr':self.indptr,'order':self.order}
+        if self.codes is not None:
+            arrays['codebooks'] = self.codebooks
+            arrays['codes'] = self.codes
+        with open(path,'wb') as f:
+            np.savez(f,**arrays)
+
+    @classmethod
+    def load(cls,path,embeddings):
+        arrays = np.load(path)
+        return cls(
+            arrays['centroids'],arrays['indptr'],arrays['order'],embeddings,
+            arrays['codebooks'] if 'codes' in arrays else None,
+            arrays['codes'] if 'codes' in arrays else None,
+        )
+
+    def search(self,queries,topk,nprobe=16,refine=4):
+        nprobe = min(nprobe,len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T),nprobe-1,axis=1)[:,:nprobe]
+        ret = np.full((len(queries),topk),-1,dtype=np.int64)
+        for idx,query in enumerate(queries):
+            candidates = np.concatenate([self.order[self.indptr[c]:self.indptr[c+1]] for c in probes[idx]])
+            if len(candidates) == 0:
+                continue
+            if self.codes is None:
+                scores = np.asarray(self.embeddings[np.sort(candidates)],dtype=np.float32) @ query
+                candidates = np.sort(candidates)
+            else:
+                m,_,dsub = self.codebooks.shape
+                ## [m,256] inner products of every query sub-vector with its codebook
+                table = np.einsum('mkd,md->mk',self.codebooks,query.reshape(m,dsub))
+                scores = table[np.arange(m),self.codes[candidates]].sum(1)
+                if refine > 0 and len(candidates) > topk * refine:
+                    ## exact re-scoring of the best topk*refine pq hits
+                    keep = np.sort(candidates[np.argpartition(-scores,topk*refine-1)[:topk*refine]])
+                    candidates,scores = keep,np.asarray(self.embeddings[keep],dtype=np.float32) @ query
+            k = min(topk,len(candidates))
+            top = np.argpartition(-scores,k-1)[:k]
+            top = top[np.lexsort((candidates[top],-scores[top]))]
+            ret[idx,:k] = candidates[top]
+        return ret
+
+def load_index(args,embeddings,output_dir):
+    if args.index == 'flat':
+        return FlatIndex(embeddings)
+    index_path = os.path.join(output_dir,f"{args.index}.npz")
+    if args.skip_encode and os.path.exists(index_path):
+        return IVFIndex.load(index_path,embeddings)
+    index = IVFIndex.build(embeddings,args.nlist,pq_m=args.pq_m if args.index == 'ivfpq' else None)
+    index.save(index_path)
+    return index
+
+def search_split(index,encoder,queries,args):
+    ret = np.full((len(queries),args.topk),-1,dtype=np.int32)
+    start = 0
+    for batch in tqdm(iter_batches(queries,args.batch_size),total=(len(queries)+args.batch_size-1)//args.batch_size):
+        query_embedding = encoder(batch,args.query_max_len)
+        if isinstance(index,IVFIndex):
+            ids = index.search(query_embedding,args.topk,args.nprobe,args.pq_refine)
+        else:
+            ids = index.search(query_embedding,args.topk)
+        ret[start:start+len(batch),:ids.shape[1]] = ids
+        start += len(batch)
+    return ret
+
+class FieldView:
+    """
+    lazy list of one field of a JsonlFile
+    """
+    def __init__(self,data,key):
+        self.data = data
+        self.key = key
+
+    def __getitem__(self,index):
+        return self.data[index][self.key]
+
+    def __len__(self):
+        return len(self.data)
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    data_dir = os.path.join(args.data_dir,args.dataset)
+    output_dir = os.path.join(data_dir,'dense')
+    os.makedirs(output_dir,exist_ok=True)
+    encoder = Encoder(args.model_path,args.device)
+
+    ## memory bank, encoded once
+    embedding_path = os.path.join(output_dir,'memory.f16.npy')
+    if args.skip_encode and os.path.exists(embedding_path):
+        embeddings = np.load(embedding_path,mmap_mode='r')
+    else:
+        memory = FieldView(JsonlFile(os.path.join(data_dir,'train.jsonl')),args.index_key)
+        embeddings = encode_memory(memory,encoder,embedding_path,args.memory_max_len,args.batch_size)
+    print('total memory encoded',len(embeddings))
+    index = load_index(args,embeddings,output_dir)
+
+    for _split in args.splits:
+        queries = FieldView(JsonlFile(os.path.join(data_dir,_split+'.jsonl')),args.query_lang)
+        ret = search_split(index,encoder,queries,args)
+        np.save(os.path.join(output_dir,_split+'.ids.npy'),ret)
+        print(f"{_split} done, {len(ret)} queries")
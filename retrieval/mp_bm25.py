@@ -1,66 +1,364 @@
-import time
 import os
-from os import system as shell
+import heapq
+import hashlib
+import argparse
+import traceback
+import multiprocessing
+from itertools import islice
+from collections import deque
+from tqdm import tqdm
+import numpy as np
 
-if __name__ == '__main__':
+from bm25 import (
+    InprocBM25,
+    read_queries,
+    parse_query,
+    build_es_index,
+    get_query_pruner,
+    compare_pruning,
+    search_es,
+    get_es_client,
+    edit_rerank,
+)
+from utils.memory_utils import ids_to_array
+from utils.cache_utils import (
+    ArtifactCache,
+    hash_key,
+    atomic_save,
+)
+
+## per-process search state, set in the parent before forking (inproc) or by the pool initializer (es)
+_engine = None
+_es = None
+_index_name = None
+_docs = None
+_pruner = None
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='cnndm')
+    parser.add_argument('--data_dir', default='/data')
+    parser.add_argument('--query_lang', default='document')
+    parser.add_argument('--backend', default='es', choices=['es','inproc'])
+    parser.add_argument('--splits', nargs='+', default=['dev','test','train'])
+    parser.add_argument('--num_workers', type=int, default=15)
+    parser.add_argument('--shard_size', type=int, default=1000,
+        help='number of queries sent to a worker at a time')
+    parser.add_argument('--batch_size', type=int, default=16,
+        help='number of queries scored together by the inproc backend or sent in one _msearch by the es backend')
+    parser.add_argument('--edit_rerank', type=int, default=None,
+        help='re-score the bm25 topk by edit distance to the indexed text and keep this many')
+    parser.add_argument('--topk', type=int, default=10)
+    parser.add_argument('--bulk_size', type=int, default=1000,
+        help='documents per bulk request when building the es index, sent by num_workers threads')
+    parser.add_argument('--prune_terms', type=int, default=None,
+        help='rewrite every query to its N highest idf-weighted terms')
+    parser.add_argument('--prune_eval', type=int, default=0,
+        help='report recall@topk and latency of the pruned against the full query on the first N queries of every split')
+    parser.add_argument('--index_shards', type=int, default=1,
+        help='split the memory bank into N partitions, each searched by its own worker process, topk merged across shards')
+    parser.add_argument('--skip_build', action='store_true',
+        help='reuse an already built index')
+    parser.add_argument('--no_cache', action='store_true',
+        help='rebuild the index and re-search every split even when their inputs are unchanged')
+    return parser.parse_args()
+
+def _init_es_worker(index_name):
+    global _es,_index_name
+    _es = get_es_client()
+    _index_name = index_name
+
+def _search_shard(shard):
+    queries,topk,batch_size,rerank_k,prune_terms = shard
+    ## rerank still compares against the full queries
+    search_queries = queries if prune_terms is None else [_pruner.prune(q,prune_terms) for q in queries]
+    if _engine is not None:
+        ret = []
+        for idx in range(0,len(search_queries),batch_size):
+            ret.extend(_engine.search(search_queries[idx:idx+batch_size],topk))
+    else:
+        ret = search_es(_es,_index_name,search_queries,topk,progress_bar=False,batch_size=batch_size)
+    if rerank_k is not None:
+        ret = edit_rerank(queries,ret,_docs,rerank_k)
+    return ret
+
+def iter_chunk_lines(path,shard_size):
+    with open(path,'rb') as f:
+        while True:
+            lines = list(islice(f,shard_size))
+            if not lines:
+                break
+            yield lines
+
+def iter_shards(path,query_lang,shard_size):
+    for lines in iter_chunk_lines(path,shard_size):
+        yield [parse_query(line,query_lang) for line in lines]
+
+def search_chunks(pool,chunks,args):
+    ## imap keeps shard order, so results line up with the query file
+    return pool.imap(_search_shard,((queries,args.topk,args.batch_size,args.edit_rerank,args.prune_terms) for queries in chunks))
+
+def search_split(path,args,cache,chunk_key,search_fn):
+    """
+    the query file is searched in chunks of shard_size lines, every chunk result is cached under
+    the hash of its lines and chunk_key, so only chunks whose lines changed are searched again
+    search_fn: iterable of query lists -> their id lists, in order
+    return: int32 [num_queries,k]
+    """
+    k = args.edit_rerank or args.topk
+    chunk_dir = os.path.join(cache.root,'cache',os.path.basename(path))
+    os.makedirs(chunk_dir,exist_ok=True)
+    chunk_paths = [
+        os.path.join(chunk_dir,hash_key(chunk_key,hashlib.sha1(b''.join(lines)).hexdigest())+'.npy')
+        for lines in iter_chunk_lines(path,args.shard_size)
+    ]
+    todo = [idx for idx,chunk_path in enumerate(chunk_paths) if not (cache.enabled and os.path.exists(chunk_path))]
+    print(f"{os.path.basename(path)}: {len(chunk_paths)-len(todo)}/{len(chunk_paths)} chunks cached")
 
-    dataset='cnndm'
-    query_lang='document'
-    ## build index
-    cmd = ""
-    cmd = f"python bm25.py "
-    cmd += f"--build_index "
-    cmd += f"--index_name {dataset} "
-    cmd += f"--query_lang {query_lang} "
-    cmd += f"--index_file /data/{dataset}/train.jsonl "
-    print(cmd)
-    shell(cmd)
-
-    ## search with multi process
-    
-    ## train 
-    os.makedirs(f"/data/{dataset}/bm25",exist_ok=True)
-    total_cnt = 0
-    with open(f"/data/{dataset}/train.jsonl") as f:
-        for line in f:
-            total_cnt += 1
-    num_workers = 15
-    num_samples_per_worker = (total_cnt // num_workers)+1
-    for idx in range(num_workers):
-        cmd = ""
-        cmd += f"python bm25.py "
-        cmd += f"--search_index "
-        cmd += f"--index_name {dataset} "
-        cmd += f"--query_lang {query_lang} "
-        cmd += f"--output_file /data/{dataset}/bm25/train_{idx}.pkl "
-        cmd += f"--search_file /data/{dataset}/train.jsonl "
-        cmd += f"--start_index {idx*num_samples_per_worker} "
-        cmd += f"--end_index {(idx+1)*num_samples_per_worker} "
-        cmd += f"&"
-        # print(cmd)
-        shell(cmd)
-    
-    ## dev
-    cmd = ""
-    cmd += f"python bm25.py "
-    cmd += f"--search_index "
-    cmd += f"--index_name {dataset} "
-    cmd += f"--query_lang {query_lang} "
-    cmd += f"--output_file /data/{dataset}/bm25/dev.pkl "
-    cmd += f"--search_file /data/{dataset}/dev.jsonl "
-    shell(cmd)
-## test
-    cmd = ""
-    cmd += f"python bm25.py "
-    cmd += f"--search_index "
-    cmd += f"--index_name {dataset} "
-    cmd += f"--query_lang {query_lang} "
-    cmd += f"--output_file /data/{dataset}/bm25/test.pkl "
-    cmd += f"--search_file /data/{dataset}/test.jsonl "
-    shell(cmd)
+    todo_set = set(todo)
+    chunks = (queries for idx,queries in enumerate(iter_shards(path,args.query_lang,args.shard_size)) if idx in todo_set)
+    with tqdm(total=len(todo),desc=os.path.basename(path)) as pbar:
+        for idx,ret in zip(todo,search_fn(chunks)):
+            atomic_save(chunk_paths[idx],ids_to_array(ret,k))
+            pbar.update(1)
+
+    ## chunks of lines that are gone
+    keep = set(os.path.basename(x) for x in chunk_paths)
+    for name in os.listdir(chunk_dir):
+        if name not in keep:
+            os.remove(os.path.join(chunk_dir,name))
+    if not chunk_paths:
+        return np.zeros((0,k),dtype=np.int32)
+    return np.concatenate([np.load(x) for x in chunk_paths])
+
+def run_splits(args,data_dir,output_dir,cache,index_key,search_fn,eval_fn):
+    """
+    a split whose query file and settings are unchanged since its ids were written is skipped
+    """
+    chunk_key = hash_key(index_key,args.topk,args.edit_rerank,args.prune_terms)
+    for _split in args.splits:
+        path = os.path.join(data_dir,_split+'.jsonl')
+        output_path = os.path.join(output_dir,_split+'.ids.npy')
+        split_key = hash_key(chunk_key,cache.digest(path))
+        if cache.is_fresh(_split,split_key,[output_path]):
+            print(f"{_split} unchanged, skipped")
+            continue
+        if args.prune_terms is not None and args.prune_eval > 0:
+            queries = next(iter_shards(path,args.query_lang,args.prune_eval),[])
+            print(f"{_split} query pruning", compare_pruning(eval_fn,queries,_pruner,args.prune_terms,args.topk))
+        ret = search_split(path,args,cache,chunk_key,search_fn)
+        atomic_save(output_path,ret)
+        cache.update(_split,split_key)
+        miss_cnt = int((ret[:,0] == -1).sum()) if ret.shape[1] else len(ret)
+        print(f"{_split} done, {len(ret)} queries, {miss_cnt} missed")
+
+def eval_pruning(pool,args):
+    def search_fn(queries):
+        shards = [(queries[idx:idx+args.batch_size],args.topk,args.batch_size,None,None) for idx in range(0,len(queries),args.batch_size)]
+        return [x for y in pool.map(_search_shard,shards) for x in y]
+    return search_fn
+
+def _shard_worker(shard_id,args,output_dir,in_queue,out_queue):
+    """
+    owns one partition of the memory bank, answers (chunk id,queries) with per-query (score,global id) lists
+    """
+    try:
+        if args.backend == 'inproc':
+            offset = int(np.load(os.path.join(output_dir,'index.bm25.shards.npy'))[shard_id])
+            engine = InprocBM25.load(shard_index_path(output_dir,shard_id,args.index_shards),mmap_mode='r')
+            def search_fn(queries):
+                ret = []
+                for idx in range(0,len(queries),args.batch_size):
+                    ret.extend(engine.search(queries[idx:idx+args.batch_size],args.topk,return_scores=True))
+                return [[(score,doc_id+offset) for score,doc_id in x] for x in ret]
+        else:
+            ## response already holds the global id
+            es = get_es_client()
+            index_name = shard_index_name(args.dataset,shard_id,args.index_shards)
+            search_fn = lambda queries:search_es(es,index_name,queries,args.topk,progress_bar=False,batch_size=args.batch_size,return_scores=True)
+    except Exception:
+        out_queue.put((None,shard_id,traceback.format_exc()))
+        return
     while True:
-        if len(os.listdir(f"/data/{dataset}/bm25")) == num_workers+2:
+        task = in_queue.get()
+        if task is None:
             break
+        chunk_id,queries = task
+        try:
+            out_queue.put((chunk_id,shard_id,search_fn(queries)))
+        except Exception:
+            out_queue.put((chunk_id,shard_id,traceback.format_exc()))
+
+def shard_index_path(output_dir,shard_id,num_shards):
+    return os.path.join(output_dir,f'index.bm25.{shard_id}-of-{num_shards}')
+
+def shard_index_name(dataset,shard_id,num_shards):
+    return f'{dataset}_{shard_id}-of-{num_shards}'
+
+def build_shards(args,index_file,output_dir):
+    """
+    contiguous doc id partitions of index_file, one index per shard
+    """
+    if args.backend == 'inproc':
+        ## built once, then partitioned with the global idf so the merged topk equals the unsharded one
+        engine = InprocBM25.build(read_queries(index_file,args.query_lang))
+        for shard_id,(offset,shard) in enumerate(engine.split(args.index_shards)):
+            shard.save(shard_index_path(output_dir,shard_id,args.index_shards))
+        np.save(os.path.join(output_dir,'index.bm25.shards.npy'),np.linspace(0,engine.num_docs,args.index_shards+1).astype(np.int64))
+        return engine.num_docs
+    num_docs = sum(1 for _ in open(index_file))
+    bounds = np.linspace(0,num_docs,args.index_shards+1).astype(np.int64)
+    es = get_es_client()
+    for shard_id in range(args.index_shards):
+        build_es_index(es,shard_index_name(args.dataset,shard_id,args.index_shards),index_file,args.query_lang,
+                       args.num_workers,args.bulk_size,start_index=int(bounds[shard_id]),end_index=int(bounds[shard_id+1]))
+    return num_docs
+
+def merge_topk(shard_rets,topk):
+    """
+    shard_rets: per shard, per query (score,id) lists sorted best first
+    return: per query the topk ids over all shards, ties broken by id
+    """
+    ret = []
+    for hits in zip(*shard_rets):
+        merged = heapq.merge(*hits,key=lambda x:(-x[0],x[1]))
+        ret.append([doc_id for _,doc_id in islice(merged,topk)])
+    return ret
+
+class ShardedSearcher:
+    """
+    scatter-gather over index_shards worker processes: every chunk of queries goes to every shard,
+    the per-shard topk lists are heap-merged in the parent, chunks come back in submission order
+    """
+    def __init__(self,args,output_dir,max_in_flight=4):
+        ctx = multiprocessing.get_context('fork')
+        self.topk = args.topk
+        self.max_in_flight = max_in_flight
+        self.out_queue = ctx.Queue()
+        self.in_queues = [ctx.Queue() for _ in range(args.index_shards)]
+        self.workers = [
+            ctx.Process(target=_shard_worker,args=(shard_id,args,output_dir,in_queue,self.out_queue),daemon=True)
+            for shard_id,in_queue in enumerate(self.in_queues)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def imap(self,chunks):
+        num_shards = len(self.in_queues)
+        chunks = iter(chunks)
+        pending = {}
+        next_id,done_id,exhausted = 0,0,False
+        while True:
+            while not exhausted and next_id - done_id < self.max_in_flight:
+                chunk = next(chunks,None)
+                if chunk is None:
+                    exhausted = True
+                    break
+                for in_queue in self.in_queues:
+                    in_queue.put((next_id,chunk))
+                pending[next_id] = [None] * num_shards
+                next_id += 1
+            if done_id == next_id:
+                return
+            chunk_id,shard_id,ret = self.out_queue.get()
+            if isinstance(ret,str):
+                raise RuntimeError(f"shard {shard_id} failed:\n{ret}")
+            pending[chunk_id][shard_id] = ret
+            while done_id in pending and all(x is not None for x in pending[done_id]):
+                yield merge_topk(pending.pop(done_id),self.topk)
+                done_id += 1
+
+    def search(self,queries):
+        return [x for y in self.imap([queries]) for x in y]
+
+    def close(self):
+        for in_queue in self.in_queues:
+            in_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+def search_chunks_sharded(searcher,chunks,args):
+    """
+    pruning and edit reranking happen in the parent, the shard workers only search
+    """
+    ## full queries of the chunks in flight, imap consumes and returns chunks in the same order
+    in_flight = deque()
+    def iter_search_chunks():
+        for queries in chunks:
+            in_flight.append(queries)
+            yield queries if args.prune_terms is None else [_pruner.prune(q,args.prune_terms) for q in queries]
+    for chunk_ret in searcher.imap(iter_search_chunks()):
+        queries = in_flight.popleft()
+        if args.edit_rerank is not None:
+            chunk_ret = edit_rerank(queries,chunk_ret,_docs,args.edit_rerank)
+        yield chunk_ret
+
+def shards_ready(args,output_dir):
+    if args.backend == 'inproc':
+        return all(os.path.exists(shard_index_path(output_dir,shard_id,args.index_shards)) for shard_id in range(args.index_shards))
+    es = get_es_client()
+    return all(es.indices.exists(index=shard_index_name(args.dataset,shard_id,args.index_shards)) for shard_id in range(args.index_shards))
+
+def main_sharded(args,data_dir,index_file,output_dir,cache,index_key):
+    global _pruner
+    built = not args.skip_build and not (cache.is_fresh('index',index_key) and shards_ready(args,output_dir))
+    if built:
+        print('total document indexed', build_shards(args,index_file,output_dir))
+        cache.update('index',index_key)
+    if args.prune_terms is not None:
+        _pruner = get_query_pruner(os.path.join(output_dir,'idf.npz'),index_file,args.query_lang,rebuild=built)
+    with ShardedSearcher(args,output_dir) as searcher:
+        run_splits(args,data_dir,output_dir,cache,index_key,lambda chunks:search_chunks_sharded(searcher,chunks,args),searcher.search)
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    data_dir = os.path.join(args.data_dir,args.dataset)
+    index_file = os.path.join(data_dir,'train.jsonl')
+    output_dir = os.path.join(data_dir,'bm25')
+    os.makedirs(output_dir,exist_ok=True)
+
+    ## indexed text for edit-distance reranking, inherited by the forked workers
+    if args.edit_rerank is not None:
+        _docs = read_queries(index_file,args.query_lang)
+
+    ## index and every split's ids are keyed by their input content and settings
+    cache = ArtifactCache(output_dir,enabled=not args.no_cache)
+    index_key = hash_key(cache.digest(index_file),args.query_lang,args.backend,args.index_shards)
+
+    if args.index_shards > 1:
+        main_sharded(args,data_dir,index_file,output_dir,cache,index_key)
+    else:
+        ## build index
+        if args.backend == 'inproc':
+            index_path = os.path.join(output_dir,'index.bm25')
+            built = not ((args.skip_build or cache.is_fresh('index',index_key)) and os.path.exists(index_path))
+            if built:
+                _engine = InprocBM25.build(read_queries(index_file,args.query_lang))
+                _engine.save(index_path)
+            else:
+                _engine = InprocBM25.load(index_path)
+            print('total document indexed', _engine.num_docs)
+            if args.prune_terms is not None:
+                _pruner = get_query_pruner(None,index_file,args.query_lang,_engine)
+            ## forked workers share the loaded postings copy-on-write
+            pool = multiprocessing.get_context('fork').Pool(args.num_workers)
         else:
-            time.sleep(1000)
+            built = not args.skip_build and not (cache.is_fresh('index',index_key) and get_es_client().indices.exists(index=args.dataset))
+            if built:
+                print('total document indexed', build_es_index(get_es_client(),args.dataset,index_file,args.query_lang,args.num_workers,args.bulk_size))
+            if args.prune_terms is not None:
+                _pruner = get_query_pruner(os.path.join(output_dir,'idf.npz'),index_file,args.query_lang,rebuild=built)
+            pool = multiprocessing.get_context('fork').Pool(args.num_workers,initializer=_init_es_worker,initargs=(args.dataset,))
+        if built:
+            cache.update('index',index_key)
 
+        ## search with multi process
+        with pool:
+            run_splits(args,data_dir,output_dir,cache,index_key,lambda chunks:search_chunks(pool,chunks,args),eval_pruning(pool,args))
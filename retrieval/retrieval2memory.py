@@ -1,41 +1,85 @@
 from tqdm import tqdm
 import json
-import pickle,os
+import os,sys
+import argparse
+import numpy as np
+sys.path.append("..")
+from utils.memory_utils import (
+    write_memory_bank,
+    MemoryBank,
+    RetrievedMemory,
+)
+from utils.cache_utils import (
+    ArtifactCache,
+    hash_key,
+    atomic_save,
+)
 
-dataset = 'cnndm'
-memory_key='summary'
-memory_bank = []
-with open(f"/data/{dataset}/train.jsonl") as f:
-    with tqdm(total=1207222) as pbar:
-        for line in f:
-            line = json.loads(line)
-            memory_bank.append(line[memory_key])
-            pbar.update(1)
+parser = argparse.ArgumentParser()
+parser.add_argument('--dataset', default='cnndm')
+parser.add_argument('--data_dir', default='/data')
+parser.add_argument('--memory_key', default='summary')
+parser.add_argument('--retrieval', default='bm25', choices=['bm25','dense'],
+    help='which {split}.ids.npy to read: bm25.py/mp_bm25.py or dense.py output')
+parser.add_argument('--no_txt', action='store_true',
+    help='only write the memory bank and the id arrays, datasets resolve them lazily')
+parser.add_argument('--no_cache', action='store_true',
+    help='rewrite the memory bank and every split even when their inputs are unchanged')
 
-for _split in ['dev','test','train']:
-    if _split == 'train':
-        bm25 = []
-        for i in range(15):
-            p = f"/data/{dataset}/bm25/train_"+str(i)+".pkl"
-            bm25.extend(pickle.load(open(p,'rb')))
-        ## in case of empty list:
-        for i in range(len(bm25)):
-            if len(bm25[i])==0:
-                bm25[i].append(0)
-                bm25[i].append(1)
-        print("sanity_check:",sum([1 for idx,i in enumerate(bm25) if idx==i[0]])/len(bm25))
-        for idx,lst in enumerate(bm25):
-            if idx in lst:
-                lst.remove(idx)
-        print("sanity_check:",sum([1 for idx,i in enumerate(bm25) if idx==i[0]])/len(bm25))
+def iter_memory(path,memory_key):
+    with open(path) as f:
+        for line in tqdm(f):
+            yield json.loads(line)[memory_key]
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    data_dir = os.path.join(args.data_dir,args.dataset)
+    output_dir = os.path.join(data_dir,'memory',args.retrieval)
+    os.makedirs(output_dir,exist_ok=True)
+
+    ## every output is keyed by the content of its inputs, unchanged ones are not rewritten
+    cache = ArtifactCache(output_dir,enabled=not args.no_cache)
+
+    ## memory bank: offsets + one utf-8 blob, streamed from train.jsonl
+    bank_prefix = os.path.join(output_dir,'bank')
+    bank_key = hash_key(cache.digest(os.path.join(data_dir,'train.jsonl')),args.memory_key)
+    if cache.is_fresh('bank',bank_key,[bank_prefix+'.offsets.npy',bank_prefix+'.bin']):
+        print("memory bank unchanged")
     else:
-        with open(f"/data/{dataset}/bm25/"+_split+".pkl",'rb') as f:
-            bm25 = pickle.load(f)    
-    memory = [memory_bank[idx[0]] for idx in bm25]
-    os.makedirs(f"/data/{dataset}/memory/bm25/",exist_ok=True)
-    
-    with open(f"/data/{dataset}/memory/bm25/"+_split+".txt",'w') as f:
-        for m in memory:
-            m = m.replace("\r\n"," ").replace('\n'," ")
-            f.write(m+'\n')
-    print(_split+" done")
\ No newline at end of file
+        print("memory bank size:",write_memory_bank(iter_memory(os.path.join(data_dir,'train.jsonl'),args.memory_key),bank_prefix))
+        cache.update('bank',bank_key)
+    memory_bank = MemoryBank(bank_prefix)
+
+    for _split in ['dev','test','train']:
+        ids_path = os.path.join(data_dir,args.retrieval,_split+'.ids.npy')
+        output_paths = [os.path.join(output_dir,_split+'.ids.npy')] + ([] if args.no_txt else [os.path.join(output_dir,_split+'.txt')])
+        split_key = hash_key(bank_key,cache.digest(ids_path),args.no_txt)
+        if cache.is_fresh(_split,split_key,output_paths):
+            print(_split+" unchanged, skipped")
+            continue
+        bm25 = np.array(np.load(ids_path))
+        ## in case of empty list:
+        empty = bm25[:,0] == -1
+        bm25[empty] = -1
+        bm25[empty,:2] = [0,1][:bm25.shape[1]]
+        if _split == 'train':
+            self_hit = bm25 == np.arange(len(bm25))[:,None]
+            print("sanity_check:",self_hit[:,0].mean())
+            ## drop the query itself and shift the remaining hits left
+            order = np.argsort(self_hit,axis=1,kind='stable')
+            bm25 = np.take_along_axis(bm25,order,axis=1)
+            bm25[np.take_along_axis(self_hit,order,axis=1)] = -1
+            ## only the query itself was retrieved (or k == 1): fall back like an empty list does,
+            ## to entry 0, or 1 for query 0, so that every row keeps a memory in the first column
+            no_hit = np.flatnonzero(bm25[:,0] == -1)
+            bm25[no_hit,0] = (no_hit == 0).astype(bm25.dtype)
+            print("sanity_check:",(bm25[:,0] == np.arange(len(bm25))).mean())
+        atomic_save(os.path.join(output_dir,_split+'.ids.npy'),bm25.astype(np.int32))
+
+        if not args.no_txt:
+            memory = RetrievedMemory(bm25,memory_bank)
+            with open(os.path.join(output_dir,_split+'.txt'),'w') as f:
+                for idx in range(len(memory)):
+                    f.write(memory[idx]+'\n')
+        cache.update(_split,split_key)
+        print(_split+" done")
@@ -1,4 +1,5 @@
 from .generate import generate
+from .lookup_decoding import lookup_generate
 from .dualencoder_pegasus import (
     DualEncoderPegasusForConditionalGeneration,
     DualEncoderPegasusModel,
@@ -0,0 +1,124 @@
+"""
+Lookup decoding benchmark: lookup_generate against batched greedy generate() on real source/memory pairs.
+
+Both decode the same batches with the same arguments. The outputs are checked to be identical,
+and the number of decoder forward passes and the wall time of each are reported. Greedy
+generate() takes one forward pass per output position of a batch. Lookup decoding only wins
+where the memory actually overlaps the output (e.g. samsum with its bm25 memory).
+
+python -m summarization.benchmark_lookup \
+    --pretrained_model_path ../results/samsum_dual_bart --memory_encoding separate \
+    --data_path ../data/samsum/test.jsonl --memory_path ../data/samsum/memory/bm25/test.txt \
+    --src document --batch_size 16 --gen_max_len 100 --device cuda
+"""
+import os
+import sys
+import time
+import argparse
+import torch
+from transformers import AutoTokenizer,AutoModelForSeq2SeqLM
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from utils.data_utils import JsonlFile
+from utils.memory_utils import load_memory
+from summarization import (
+    DualEncoderBartForConditionalGeneration,
+    DualEncoderPegasusForConditionalGeneration,
+    lookup_generate,
+)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pretrained_model_path', required=True)
+    parser.add_argument('--memory_encoding', default='separate', choices=['separate','concate'])
+    parser.add_argument('--data_path', required=True)
+    parser.add_argument('--memory_path', required=True, help='{split}.txt or {split}.ids.npy, as load_memory reads it')
+    parser.add_argument('--src', default='document')
+    parser.add_argument('--num_samples', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--max_src_len', type=int, default=512)
+    parser.add_argument('--max_memory_len', type=int, default=100)
+    parser.add_argument('--gen_max_len', type=int, default=100)
+    parser.add_argument('--gen_min_len', type=int, default=None)
+    parser.add_argument('--no_repeat_ngram_size', type=int, default=None)
+    parser.add_argument('--num_draft_tokens', type=int, default=10)
+    parser.add_argument('--device', default='cpu')
+    return parser.parse_args()
+
+def load_model(args):
+    if args.memory_encoding == 'concate':
+        return AutoModelForSeq2SeqLM.from_pretrained(args.pretrained_model_path)
+    if 'pegasus' in args.pretrained_model_path:
+        return DualEncoderPegasusForConditionalGeneration.from_pretrained(args.pretrained_model_path)
+    return DualEncoderBartForConditionalGeneration.from_pretrained(args.pretrained_model_path)
+
+def get_batch(toker,src,memory,args):
+    ## the same inputs the collate_fct of train_generator builds
+    if args.memory_encoding == 'concate':
+        memory = [" <MEMORY_SPLITTER> " + x for x in memory]
+        tokenized_src = toker(src,return_tensors='pt',padding=True,truncation=True,max_length=args.max_src_len-args.max_memory_len-2)
+        tokenized_memory = toker(memory,return_tensors='pt',padding=True,truncation=True,max_length=args.max_memory_len+2)
+        input_ids = torch.cat((tokenized_src['input_ids'],tokenized_memory['input_ids']),dim=1)
+        attention_mask = torch.cat((tokenized_src['attention_mask'],tokenized_memory['attention_mask']),dim=1)
+        batch = {'input_ids':input_ids,'attention_mask':attention_mask,'draft_ids':input_ids,'draft_attention_mask':attention_mask}
+    else:
+        tokenized_src = toker(src,return_tensors='pt',padding=True,truncation=True,max_length=args.max_src_len)
+        tokenized_memory = toker(memory,return_tensors='pt',padding=True,truncation=True,max_length=args.max_memory_len)
+        batch = {
+            'input_ids':tokenized_src['input_ids'],
+            'attention_mask':tokenized_src['attention_mask'],
+            'memory_input_ids':tokenized_memory['input_ids'],
+            'memory_attention_mask':tokenized_memory['attention_mask'],
+            'draft_ids':tokenized_memory['input_ids'],
+            'draft_attention_mask':tokenized_memory['attention_mask'],
+        }
+    return {k:v.to(args.device) for k,v in batch.items()}
+
+def timed(fn):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    ret = fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return ret,time.perf_counter() - start
+
+if __name__ == '__main__':
+    args = parse_args()
+    toker = AutoTokenizer.from_pretrained(args.pretrained_model_path)
+    model = load_model(args).to(args.device).eval()
+    data = JsonlFile(args.data_path)
+    memory = load_memory(args.memory_path)
+    num_samples = min(args.num_samples,len(data))
+    gen_kwargs = dict(
+        max_length=args.gen_max_len+2,
+        min_length=args.gen_min_len+1 if args.gen_min_len is not None else None,
+        no_repeat_ngram_size=args.no_repeat_ngram_size,
+    )
+
+    greedy_time,lookup_time,greedy_forward,lookup_forward,num_tokens = 0,0,0,0,0
+    for step,start in enumerate(range(0,num_samples,args.batch_size)):
+        idx = range(start,min(start+args.batch_size,num_samples))
+        batch = get_batch(toker,[data[i][args.src] for i in idx],[memory[i] for i in idx],args)
+        memory_kwargs = {k:batch[k] for k in ['memory_input_ids','memory_attention_mask'] if k in batch}
+        with torch.no_grad():
+            greedy,t0 = timed(lambda:model.generate(
+                input_ids=batch['input_ids'],attention_mask=batch['attention_mask'],num_beams=1,do_sample=False,
+                **gen_kwargs,**memory_kwargs,
+            ))
+            lookup,t1 = timed(lambda:lookup_generate(
+                model,batch['input_ids'],batch['attention_mask'],batch['draft_ids'],batch['draft_attention_mask'],
+                num_draft_tokens=args.num_draft_tokens,return_dict_in_generate=True,**gen_kwargs,**memory_kwargs,
+            ))
+        assert greedy.shape == lookup['sequences'].shape and bool((greedy == lookup['sequences']).all()),f"outputs differ in batch {step}"
+        ## the first batch only warms up
+        if step == 0 and num_samples > args.batch_size:
+            continue
+        greedy_time += t0
+        lookup_time += t1
+        greedy_forward += greedy.shape[1]-1
+        lookup_forward += lookup['num_forward']
+        num_tokens += int((greedy[:,1:] != model.config.pad_token_id).sum())
+
+    print(f"greedy  {greedy_forward:6d} forward passes  {greedy_time:8.3f}s")
+    print(f"lookup  {lookup_forward:6d} forward passes  {lookup_time:8.3f}s")
+    print(f"{num_tokens} tokens, {greedy_forward/max(lookup_forward,1):.2f}x fewer forward passes, {greedy_time/max(lookup_time,1e-9):.2f}x speedup")
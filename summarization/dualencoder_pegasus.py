@@ -1,4 +1,8 @@
 from transformers.models.pegasus.modeling_pegasus import *
+from .grouped_attention import (
+    GroupedPegasusAttention,
+    use_grouped_cross_attention,
+)
 from dataclasses import dataclass
 from transformers.modeling_outputs import BaseModelOutput
 
@@ -33,30 +37,36 @@ class DualPegasusEncoder(PegasusEncoder):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,        
+        src_last_hidden_state=None,
     ):
-        src_outputs = super().forward(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
+        ## src_last_hidden_state: source states computed before (e.g. cached), only the memory is encoded
+        ## memory_input_ids None: only the source is encoded
+        if src_last_hidden_state is None:
+            src_last_hidden_state = super().forward(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+            ).last_hidden_state
 
-        memory_outputs = super().forward(
-            input_ids=memory_input_ids,
-            attention_mask=memory_attention_mask,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
+        memory_last_hidden_state = None
+        if memory_input_ids is not None:
+            memory_last_hidden_state = super().forward(
+                input_ids=memory_input_ids,
+                attention_mask=memory_attention_mask,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+            ).last_hidden_state
 
         return DualEncoderOutput(
-            src_last_hidden_state = src_outputs.last_hidden_state,
-            memory_last_hidden_state = memory_outputs.last_hidden_state,
+            src_last_hidden_state = src_last_hidden_state,
+            memory_last_hidden_state = memory_last_hidden_state,
         )
 
 
@@ -425,6 +435,8 @@ class DualEncoderPegasusModel(PegasusModel):
 
         self.encoder = DualPegasusEncoder(config, self.shared)
         self.decoder = DualCrossAttnPegasusDecoder(config, self.shared)
+        ## source (and memory) states may be shared by several decoder rows, e.g. memory variants of one source
+        use_grouped_cross_attention(self.decoder, GroupedPegasusAttention)
 
         # Initialize weights and apply final processing
         self.post_init()
@@ -611,6 +623,16 @@ class DualEncoderPegasusForConditionalGeneration(PegasusForConditionalGeneration
         )
     
     
+    def _prepare_input_ids_for_generation(self, bos_token_id, encoder_outputs):
+        ## generate() only takes the batch size from these ids when encoder_outputs are given:
+        ## the decoder runs one row per memory, several per source with grouped cross-attention
+        if encoder_outputs is not None:
+            states = encoder_outputs.memory_last_hidden_state
+            if states is None:
+                states = encoder_outputs.src_last_hidden_state
+            return torch.full((states.shape[0],1),-100,dtype=torch.long,device=self.device)
+        return super()._prepare_input_ids_for_generation(bos_token_id, encoder_outputs)
+
     @staticmethod
     def _expand_inputs_for_generation(
         input_ids: torch.LongTensor,
@@ -631,26 +653,17 @@ class DualEncoderPegasusForConditionalGeneration(PegasusForConditionalGeneration
             token_type_ids = model_kwargs["token_type_ids"]
             model_kwargs["token_type_ids"] = token_type_ids.index_select(0, expanded_return_idx)
 
+        ## source and memory states (and their masks) stay one row per source/memory, the beams
+        ## of a row are contiguous so the grouped cross-attention broadcasts them over the beams
+        ## (and over the memories of a source in group-by-source generation)
         if attention_mask is not None:
-            # print(attention_mask)
-            model_kwargs["attention_mask"] = attention_mask.index_select(0, expanded_return_idx)
-        
+            model_kwargs["attention_mask"] = attention_mask
         if memory_attention_mask is not None:
-            # print(attention_mask)
-            model_kwargs["memory_attention_mask"] = memory_attention_mask.index_select(0, expanded_return_idx)
+            model_kwargs["memory_attention_mask"] = memory_attention_mask
 
         if is_encoder_decoder:
             if encoder_outputs is None:
                 raise ValueError("If `is_encoder_decoder` is True, make sure that `encoder_outputs` is defined.")
-            # encoder_outputs["last_hidden_state"] = encoder_outputs.last_hidden_state.index_select(
-            #     0, expanded_return_idx.to(encoder_outputs.last_hidden_state.device)
-            # )
-            encoder_outputs["src_last_hidden_state"] = encoder_outputs.src_last_hidden_state.index_select(
-                0, expanded_return_idx.to(encoder_outputs.src_last_hidden_state.device)
-            )
-            encoder_outputs["memory_last_hidden_state"] = encoder_outputs.memory_last_hidden_state.index_select(
-                0, expanded_return_idx.to(encoder_outputs.memory_last_hidden_state.device)
-            )
             model_kwargs["encoder_outputs"] = encoder_outputs
         return input_ids, model_kwargs
 
@@ -682,4 +695,14 @@ class DualEncoderPegasusForConditionalGeneration(PegasusForConditionalGeneration
             "cross_attn_head_mask": cross_attn_head_mask,
             "memory_attention_mask": memory_attention_mask,
             "use_cache": use_cache,  # change this to avoid caching (presumably for debugging)
-        }
\ No newline at end of file
+        }
+
+    @staticmethod
+    def _reorder_cache(past, beam_idx):
+        ## per decoder layer: self-attention K/V [:2], source cross-attention K/V [2:4] and memory
+        ## cross-attention K/V [4:6]. Only the self-attention cache follows the beams, the cross-attention
+        ## K/V are projected once per source/memory row and stay the same for all of its beams
+        return tuple(
+            tuple(past_state.index_select(0, beam_idx) for past_state in layer_past[:2]) + layer_past[2:]
+            for layer_past in past
+        )
\ No newline at end of file
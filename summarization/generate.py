@@ -34,6 +34,7 @@ from utils.utils import (
     
 )
 from transformers import set_seed
+from .lookup_decoding import lookup_generate
 from torch.nn.parallel import DistributedDataParallel as DDP
 import torch.multiprocessing as mp
 @dataclass
@@ -63,17 +64,35 @@ def generate(dataloader,model,trg_tokenizer,device,gen_args=None,progress_bar=Fa
         for batch in dataloader:
             batch = move_to_device(batch,device)
             with torch.no_grad():
-                output = model.generate(
-                        batch['input_ids'],
+                if gen_args.lookup_decoding and gen_args.num_beams in (None,1):
+                    ## greedy output, drafted from the memory (or the source) and verified in one forward pass
+                    draft_key = 'memory_input_ids' if 'memory_input_ids' in batch else 'input_ids'
+                    memory_kwargs = {k:batch[k] for k in ['memory_input_ids','memory_attention_mask'] if k in batch}
+                    output = lookup_generate(
+                        model,
+                        input_ids=batch['input_ids'],
+                        attention_mask=batch['attention_mask'],
+                        draft_ids=batch[draft_key],
+                        draft_attention_mask=batch[draft_key.replace('input_ids','attention_mask')],
                         max_length=gen_args.gen_max_len+2,
-                        num_beams=gen_args.num_beams,
                         min_length=gen_args.gen_min_len+1,
                         no_repeat_ngram_size=gen_args.no_repeat_ngram_size,
-                        early_stopping=gen_args.early_stopping,
-                        attention_mask = batch['attention_mask'],
-                        output_scores=True,
+                        num_draft_tokens=gen_args.num_draft_tokens or 10,
                         return_dict_in_generate=True,
-                        )
+                        **memory_kwargs,
+                    )
+                else:
+                    output = model.generate(
+                            batch['input_ids'],
+                            max_length=gen_args.gen_max_len+2,
+                            num_beams=gen_args.num_beams,
+                            min_length=gen_args.gen_min_len+1,
+                            no_repeat_ngram_size=gen_args.no_repeat_ngram_size,
+                            early_stopping=gen_args.early_stopping,
+                            attention_mask = batch['attention_mask'],
+                            output_scores=True,
+                            return_dict_in_generate=True,
+                            )
 
             scores.extend(output['sequences_scores'].cpu().tolist())
             generated_tokens = output['sequences'].cpu().tolist()
@@ -0,0 +1,107 @@
+"""
+Cross-attention shared by a group of decoder rows.
+
+BRIO scores every candidate of a source with the same encoder output, and group-by-source
+generation decodes every memory variant of a source against the same source states.
+Instead of repeat_interleave-ing the encoder (and memory) states once per row, the decoder
+gets them once per source: keys/values are projected once per source (and cached that way
+during generation), and the queries of all rows of that source are laid side by side along
+the query length, so one bmm scores the whole group. Only the decoder activations scale
+with the group size. Rows of a group have to be contiguous in the decoder batch.
+"""
+from transformers.models.bart.modeling_bart import BartAttention
+from transformers.models.pegasus.modeling_pegasus import PegasusAttention
+import torch
+from torch import nn
+
+class GroupedCrossAttentionMixin:
+
+    def forward(
+        self,
+        hidden_states,
+        key_value_states=None,
+        past_key_value=None,
+        attention_mask=None,
+        layer_head_mask=None,
+        output_attentions=False,
+    ):
+        ## self-attention or plain cross-attention: nothing to share
+        if key_value_states is not None:
+            kv_bsz = past_key_value[0].size(0) if past_key_value is not None else key_value_states.size(0)
+        if key_value_states is None or kv_bsz == hidden_states.size(0):
+            return super().forward(
+                hidden_states,
+                key_value_states=key_value_states,
+                past_key_value=past_key_value,
+                attention_mask=attention_mask,
+                layer_head_mask=layer_head_mask,
+                output_attentions=output_attentions,
+            )
+
+        bsz, tgt_len, _ = hidden_states.size()
+        group_size = bsz // kv_bsz
+        assert group_size * kv_bsz == bsz,(bsz,kv_bsz)
+
+        ## [kv_bsz, num_heads, src_len, head_dim], projected once per source, reused from the cache afterwards
+        if past_key_value is not None:
+            key_states, value_states = past_key_value[0], past_key_value[1]
+        else:
+            key_states = self._shape(self.k_proj(key_value_states), -1, kv_bsz)
+            value_states = self._shape(self.v_proj(key_value_states), -1, kv_bsz)
+        src_len = key_states.size(2)
+        past_key_value = (key_states, value_states) if self.is_decoder else None
+
+        ## [kv_bsz * num_heads, group_size * tgt_len, head_dim], the queries of a group side by side
+        query_states = (self.q_proj(hidden_states) * self.scaling).view(kv_bsz, group_size, tgt_len, self.num_heads, self.head_dim)
+        query_states = query_states.permute(0, 3, 1, 2, 4).reshape(kv_bsz * self.num_heads, group_size * tgt_len, self.head_dim)
+        key_states = key_states.reshape(kv_bsz * self.num_heads, src_len, self.head_dim)
+        value_states = value_states.reshape(kv_bsz * self.num_heads, src_len, self.head_dim)
+
+        attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
+        attn_weights = attn_weights.view(kv_bsz, self.num_heads, group_size, tgt_len, src_len)
+        if attention_mask is not None:
+            ## [kv_bsz, 1, tgt_len, src_len], broadcast over the group
+            attn_weights = attn_weights + attention_mask[:, :, None]
+        attn_weights = nn.functional.softmax(attn_weights, dim=-1)
+
+        if layer_head_mask is not None:
+            attn_weights = layer_head_mask.view(1, -1, 1, 1, 1) * attn_weights
+
+        if output_attentions:
+            attn_weights_reshaped = attn_weights.permute(0, 2, 1, 3, 4).reshape(bsz, self.num_heads, tgt_len, src_len)
+        else:
+            attn_weights_reshaped = None
+
+        attn_probs = nn.functional.dropout(attn_weights, p=self.dropout, training=self.training)
+        attn_output = torch.bmm(attn_probs.view(kv_bsz * self.num_heads, group_size * tgt_len, src_len), value_states)
+        attn_output = attn_output.view(kv_bsz, self.num_heads, group_size, tgt_len, self.head_dim)
+        attn_output = attn_output.permute(0, 2, 3, 1, 4).reshape(bsz, tgt_len, self.embed_dim)
+        attn_output = self.out_proj(attn_output)
+
+        return attn_output, attn_weights_reshaped, past_key_value
+
+class GroupedBartAttention(GroupedCrossAttentionMixin, BartAttention):
+    pass
+
+class GroupedPegasusAttention(GroupedCrossAttentionMixin, PegasusAttention):
+    pass
+
+def use_grouped_cross_attention(decoder, attention_cls):
+    """
+    swap encoder_attn (and memory_attn of the dual encoder layers) of every decoder layer
+    for attention_cls, parameter names stay the same so pretrained weights load as before
+    """
+    for layer in decoder.layers:
+        for name in ['encoder_attn','memory_attn']:
+            attn = getattr(layer, name, None)
+            if attn is None:
+                continue
+            grouped_attn = attention_cls(
+                attn.embed_dim,
+                attn.num_heads,
+                dropout=attn.dropout,
+                is_decoder=attn.is_decoder,
+                bias=attn.k_proj.bias is not None,
+            )
+            grouped_attn.load_state_dict(attn.state_dict())
+            setattr(layer, name, grouped_attn)
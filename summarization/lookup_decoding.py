@@ -0,0 +1,219 @@
+"""
+Lookup decoding: greedy decoding that drafts its next tokens from the memory.
+
+The memory is close to the target, so the continuation of a hypothesis can often be read off
+the memory: the last ngram of the hypothesis is looked up in the memory tokens and the tokens
+that follow it there are the draft. The decoder scores the last token plus the whole draft in
+one forward pass (on top of the usual cache). The greedy choice at every draft position is made
+with the logits processors generate() uses, on the prefix greedy decoding would have at that
+position, so every draft token that equals it is kept, plus the greedy token at the first
+mismatch: the output is the greedy output, a forward pass just yields one token more for every
+accepted draft token. The only differences come from floating point, the logits of a
+multi-token forward pass can differ from the single-token ones in the last bits.
+
+The batch is verified in one forward pass per step, but every row accepts as much of its own
+draft as it can, so rows grow at different speeds. The self-attention cache keeps the valid
+entries of every row right-aligned (left-padded, masked by the decoder attention mask), and the
+decoder positions are per row (see RowPositions) instead of following the cache length.
+"""
+import torch
+from transformers.generation_logits_process import LogitsProcessorList
+
+def find_draft(hyp,memory,ngram_size=3,num_draft_tokens=10):
+    """
+    hyp,memory: lists of token ids
+    return: the (at most num_draft_tokens) tokens that follow the first occurrence in memory
+    of the longest suffix of hyp, the suffix being at most ngram_size tokens
+    """
+    for n in range(min(ngram_size,len(hyp)),0,-1):
+        suffix = hyp[-n:]
+        for start in range(len(memory)-n):
+            if memory[start:start+n] == suffix:
+                return memory[start+n:start+n+num_draft_tokens]
+    return []
+
+def get_logits_processor(model,input_ids,max_length,min_length=None,no_repeat_ngram_size=None):
+    ## the processors generate() would build for greedy decoding with these arguments
+    return model._get_logits_processor(
+        repetition_penalty=None,
+        no_repeat_ngram_size=no_repeat_ngram_size,
+        encoder_no_repeat_ngram_size=None,
+        input_ids_seq_length=1,
+        encoder_input_ids=input_ids,
+        bad_words_ids=None,
+        min_length=min_length if min_length is not None else model.config.min_length,
+        max_length=max_length,
+        eos_token_id=None,
+        forced_bos_token_id=None,
+        forced_eos_token_id=None,
+        prefix_allowed_tokens_fn=None,
+        num_beams=1,
+        num_beam_groups=1,
+        diversity_penalty=None,
+        remove_invalid_values=None,
+        exponential_decay_length_penalty=None,
+        logits_processor=LogitsProcessorList(),
+        renormalize_logits=None,
+    )
+
+class RowPositions(torch.nn.Module):
+    """
+    stands in for decoder.embed_positions: the positions of the fed tokens are set per row
+    (self.positions, [bsz,seq_len]) instead of counting from the cache length shared by the batch
+    """
+    def __init__(self,embed_positions):
+        super().__init__()
+        self.embed_positions = embed_positions
+        self.positions = None
+
+    def forward(self,input,past_key_values_length=0):
+        ## the positional embeddings of 0..max position, called the way the decoder calls them
+        ## (input_ids for bart, input_shape for pegasus)
+        shape = (1,int(self.positions.max())+1)
+        table = self.embed_positions(input.new_zeros(shape) if torch.is_tensor(input) else torch.Size(shape))
+        return table.reshape(-1,table.shape[-1])[self.positions]
+
+@torch.no_grad()
+def lookup_generate(
+    model,
+    input_ids,
+    attention_mask,
+    draft_ids,
+    draft_attention_mask,
+    max_length,
+    min_length=None,
+    no_repeat_ngram_size=None,
+    encoder_outputs=None,
+    num_draft_tokens=10,
+    ngram_size=3,
+    length_penalty=1.0,
+    return_dict_in_generate=False,
+    **model_kwargs,
+):
+    """
+    same output as model.generate(...,num_beams=1,do_sample=False) with these arguments
+    draft_ids/draft_attention_mask: the tokens to draft from, one row per decoder row
+        (memory_input_ids for the dual encoders, the source with the memory for concate)
+    model_kwargs: memory_input_ids/memory_attention_mask of the dual encoders
+    return: sequences, or with return_dict_in_generate a dict with the sequences, sequences_scores
+        (sum of the log-probs over the length to the length_penalty, as beam search scores them)
+        and the number of decoder forward passes
+    """
+    config = model.config
+    pad_token_id,eos_token_id = config.pad_token_id,config.eos_token_id
+    if encoder_outputs is None:
+        encoder_outputs = model.get_encoder()(input_ids=input_ids,attention_mask=attention_mask,return_dict=True,**model_kwargs)
+    forward_kwargs = {}
+    if 'memory_attention_mask' in model_kwargs:
+        forward_kwargs['memory_attention_mask'] = model_kwargs['memory_attention_mask']
+    logits_processor = get_logits_processor(model,input_ids,max_length,min_length,no_repeat_ngram_size)
+
+    num_rows = draft_ids.shape[0]
+    device = draft_ids.device
+    rows = torch.arange(num_rows,device=device)
+    memory = [row[mask.bool()].tolist() for row,mask in zip(draft_ids,draft_attention_mask)]
+    sequences = torch.full((num_rows,max_length),pad_token_id,dtype=torch.long,device=device)
+    sequences[:,0] = config.decoder_start_token_id
+    seq_lens = torch.ones(num_rows,dtype=torch.long,device=device)
+    unfinished = torch.ones(num_rows,dtype=torch.bool,device=device)
+    sum_logprobs = torch.zeros(num_rows,device=device)
+    ## which self-attention cache entries of every row are real tokens
+    cache_mask = torch.zeros((num_rows,0),dtype=torch.bool,device=device)
+    past = None
+    num_forward = 0
+
+    decoder = model.get_decoder()
+    embed_positions = decoder.embed_positions
+    decoder.embed_positions = row_positions = RowPositions(embed_positions)
+    try:
+        while unfinished.any():
+            ## one token is always decoded on top of the draft
+            drafts = [
+                find_draft(sequences[idx,:seq_lens[idx]].tolist(),memory[idx],ngram_size,min(num_draft_tokens,max_length-int(seq_lens[idx])-1))
+                if unfinished[idx] else [] for idx in range(num_rows)
+            ]
+            draft_lens = torch.tensor([len(x) for x in drafts],dtype=torch.long,device=device)
+            draft = torch.full((num_rows,int(draft_lens.max())),pad_token_id,dtype=torch.long,device=device)
+            for idx,x in enumerate(drafts):
+                draft[idx,:len(x)] = torch.tensor(x,dtype=torch.long,device=device)
+            num_fed = draft.shape[1]+1
+
+            ## the cache holds every token but the last one of every row
+            last_tokens = sequences.gather(1,(seq_lens-1)[:,None])
+            row_positions.positions = (seq_lens-1)[:,None] + torch.arange(num_fed,device=device)
+            outputs = model(
+                encoder_outputs=encoder_outputs,
+                attention_mask=attention_mask,
+                decoder_input_ids=torch.cat((last_tokens,draft),dim=1),
+                decoder_attention_mask=torch.cat((cache_mask,torch.ones((num_rows,num_fed),dtype=torch.bool,device=device)),dim=1).long(),
+                past_key_values=past,
+                use_cache=True,
+                return_dict=True,
+                **forward_kwargs,
+            )
+            num_forward += 1
+
+            ## rows keep taking the greedy token while the token they were fed is that greedy token
+            accepted = torch.zeros(num_rows,dtype=torch.long,device=device)
+            active = unfinished.clone()
+            for pos in range(num_fed):
+                idx = rows[active]
+                if len(idx) == 0:
+                    break
+                logits = outputs.logits[idx,pos,:]
+                next_tokens,logprobs = choose_next_tokens(logits_processor,sequences[idx],seq_lens[idx],logits,return_dict_in_generate)
+                if logprobs is not None:
+                    sum_logprobs[idx] += logprobs
+                sequences[idx,seq_lens[idx]] = next_tokens
+                seq_lens[idx] += 1
+                accepted[idx] += 1
+                done = (next_tokens == eos_token_id) | (seq_lens[idx] >= max_length)
+                unfinished[idx[done]] = False
+                if pos == num_fed-1:
+                    break
+                ## the logits of the next position saw draft[:,pos]
+                active[idx] = ~done & (pos < draft_lens[idx]) & (draft[idx,pos] == next_tokens)
+
+            ## the cache entries of the accepted tokens are kept, the valid entries of every row are
+            ## moved to the right and the columns nobody needs any more are dropped
+            valid = torch.cat((cache_mask,torch.arange(num_fed,device=device)[None,:] < accepted[:,None]),dim=1)
+            num_kept = int(valid.sum(1).max())
+            order = torch.sort(valid.int(),dim=1,stable=True).indices[:,valid.shape[1]-num_kept:]
+            cache_mask = valid.gather(1,order)
+            past = tuple(
+                tuple(x.gather(2,order[:,None,:,None].expand(-1,x.shape[1],-1,x.shape[3])) for x in layer_past[:2]) + layer_past[2:]
+                for layer_past in outputs.past_key_values
+            )
+    finally:
+        decoder.embed_positions = embed_positions
+
+    sequences = sequences[:,:int(seq_lens.max())]
+    if not return_dict_in_generate:
+        return sequences
+    return {
+        "sequences":sequences,
+        "sequences_scores":sum_logprobs / (seq_lens.float() ** length_penalty),
+        "num_forward":num_forward,
+    }
+
+def choose_next_tokens(logits_processor,sequences,seq_lens,logits,return_logprobs=False):
+    """
+    greedy tokens of rows with prefixes of different lengths: the logits processors look at the
+    whole prefix (its length for min_length), so rows of the same length are processed together
+    sequences: [bsz,max_length] right-padded, seq_lens: [bsz], logits: [bsz,vocab_size]
+    return: next tokens, and their processed log-probs with return_logprobs (else None)
+    """
+    if len(logits_processor) == 0 and not return_logprobs:
+        return logits.argmax(-1),None
+    scores = torch.empty_like(logits)
+    logprobs = torch.empty_like(logits,dtype=torch.float) if return_logprobs else None
+    for length in seq_lens.unique().tolist():
+        group = (seq_lens == length).nonzero().squeeze(-1)
+        prefix = sequences[group,:length]
+        scores[group] = logits_processor(prefix,logits[group])
+        if return_logprobs:
+            logprobs[group] = logits_processor(prefix,torch.log_softmax(logits[group].float(),dim=-1))
+    next_tokens = scores.argmax(-1)
+    if return_logprobs:
+        logprobs = logprobs.gather(-1,next_tokens[:,None]).squeeze(-1)
+    return next_tokens,logprobs
@@ -34,9 +34,29 @@ from utils.metrics_utils import (
     get_nltk_bleu_score,
     get_distinct_score,
 )
+from utils.ddp_utils import (
+    LengthBucketBatchSampler,
+    get_eval_sampler,
+    gather_to_main,
+    broadcast_from_main,
+)
 from utils.optim_utils import (
     get_inverse_sqrt_schedule_with_warmup
 )
+from utils.memory_utils import (
+    load_memory,
+    get_memory_path,
+    memory_files,
+)
+from utils.data_utils import (
+    JsonlFile,
+    CandidateFile,
+    build_token_stores,
+    prepare_token_stores,
+    get_token_ids,
+    tokenize,
+    get_sample_lengths,
+)
 from brio import (
     RankingLoss,
     BrioBartForConditionalGeneration,
@@ -52,16 +72,28 @@ class MemoryDataset(torch.utils.data.Dataset):
         self,
         data,
         memory=None,
+        candidates=None,
+        token_ids=None,
         ):
         super().__init__()
         self.data = data
         if memory is not None:
             assert len(data)==len(memory),(len(data),len(memory))
-            for idx in range(len(data)):
-                self.data[idx]['memory']=memory[idx]
+        ## attached per item, so a lazy RetrievedMemory is only decoded when used
+        self.memory = memory
+        self.candidates = candidates
+        ## {key:TokenStore}, pre-tokenized ids attached per item under key
+        self.token_ids = token_ids if token_ids is not None else {}
     
     def __getitem__(self,index):
-        return self.data[index]
+        d = {**self.data[index]}
+        if self.memory is not None:
+            d['memory'] = self.memory[index]
+        if self.candidates is not None:
+            d['candidates'] = self.candidates[index]
+        for k,v in self.token_ids.items():
+            d[k] = v[index]
+        return d
 
     def __len__(self,):
         return len(self.data)
@@ -72,20 +104,26 @@ def collate_fct(samples,src_toker,trg_toker,max_src_len,max_trg_len,memory_encod
     src = [d[src] for d in samples]
     trg = [d[trg] for d in samples]
     candidates = [d['candidates'] for d in samples]
+    ## with pre-tokenized samples (src_ids/trg_ids/memory_ids, ids as 3rd field of every candidate) tokenize() only pads
+    trg_ids = get_token_ids(samples,'trg_ids')
+    trg_plus_candidates_ids = None if trg_ids is None else []
     for idx in range(len(candidates)):
         candidates[idx].sort(key=lambda x:x[1],reverse=True)
+        if trg_ids is not None:
+            trg_plus_candidates_ids.append(trg_ids[idx])
+            trg_plus_candidates_ids.extend(x[2] for x in candidates[idx])
         candidates[idx] = [x[0] for x in candidates[idx]]
         candidates[idx].insert(0,trg[idx])
     trg_plus_candidates = [x for y in candidates for x in y]
 
-    tokenized_trg = trg_toker(trg_plus_candidates,return_tensors='pt',padding=True,truncation=True,max_length=max_trg_len,return_attention_mask=False)
+    tokenized_trg = tokenize(trg_plus_candidates,trg_toker,max_trg_len,trg_plus_candidates_ids)
     tokenized_trg['input_ids'][tokenized_trg['input_ids']==trg_toker.pad_token_id]=-100
     
     
     has_memory = 'memory' in samples[0].keys()
     if not has_memory:
 
-        tokenized_src = src_toker(src,return_tensors='pt',padding=True,truncation=True,max_length=max_src_len,return_attention_mask=True)
+        tokenized_src = tokenize(src,src_toker,max_src_len,get_token_ids(samples,'src_ids'))
         return {
             "input_ids":tokenized_src['input_ids'],
             "attention_mask":tokenized_src['attention_mask'],
@@ -97,8 +135,8 @@ def collate_fct(samples,src_toker,trg_toker,max_src_len,max_trg_len,memory_encod
         memory_splitter = " <MEMORY_SPLITTER> "
         memory = [memory_splitter + d['memory'] for d in samples]
         if memory_encoding == 'concate':
-            tokenized_memory = src_toker(memory,return_tensors='pt',padding=True,truncation=True,max_length=max_trg_len+2,return_attention_mask=True)
-            tokenized_src = src_toker(memory,return_tensors='pt',padding=True,truncation=True,max_length=(max_src_len-max_trg_len-2),return_attention_mask=True)
+            tokenized_memory = tokenize(memory,src_toker,max_trg_len+2,get_token_ids(samples,'memory_ids'))
+            tokenized_src = tokenize(memory,src_toker,(max_src_len-max_trg_len-2),get_token_ids(samples,'src_ids'))
             return {
                 "input_ids":torch.cat((tokenized_src['input_ids'],tokenized_memory['input_ids']),dim=1),
                 "attention_mask":torch.cat((tokenized_src['attention_mask'],tokenized_memory['attention_mask']),dim=1),
@@ -107,8 +145,8 @@ def collate_fct(samples,src_toker,trg_toker,max_src_len,max_trg_len,memory_encod
                 }
 
         elif memory_encoding == 'separate':
-            tokenized_memory = trg_toker(memory,return_tensors='pt',padding=True,truncation=True,max_length=max_trg_len)
-            tokenized_src = trg_toker(src,return_tensors='pt',padding=True,truncation=True,max_length=max_src_len,return_attention_mask=True)
+            tokenized_memory = tokenize(memory,trg_toker,max_trg_len,get_token_ids(samples,'memory_ids'))
+            tokenized_src = tokenize(src,trg_toker,max_src_len,get_token_ids(samples,'src_ids'))
             return {
                 "input_ids":tokenized_src['input_ids'],
                 "attention_mask":tokenized_src['attention_mask'],
@@ -133,6 +171,7 @@ class BrioGenerator(LightningModule):
         parser.add_argument('--trg')
         parser.add_argument('--train_max_src_len',type=int)
         parser.add_argument('--train_max_trg_len',type=int)
+        parser.add_argument('--token_cache_dir',help='pre-tokenize every split once into this directory, collate_fct then only pads')
         ## model
         parser.add_argument('--pretrained_model_path')
         ## generation
@@ -160,7 +199,9 @@ class BrioGenerator(LightningModule):
         parser.add_argument('--weight_decay', type=float)
         parser.add_argument('--label_smoothing_factor', type=float)
         parser.add_argument('--per_device_train_batch_size',type=int)
+        parser.add_argument('--max_tokens',type=int,help='length-bucketed batches of at most max_tokens padded source tokens')
         parser.add_argument('--per_device_eval_batch_size',type=int)
+        parser.add_argument('--gather_dir',help='shared directory to collect the eval outputs of all ranks through files instead of the process group')
         parser.add_argument('--logging_steps',type=int)
         parser.add_argument('--eval_metrics')
         parser.add_argument('--cheat',type=bool)
@@ -224,29 +265,33 @@ class BrioGenerator(LightningModule):
         self.model.resize_token_embeddings(len(self.trg_toker))
 
     def eval_generation(self,hyps,refs,stage='valid'):
-        if stage == 'valid':
-            cnt = self.valid_data_cnt
-        elif stage == 'test':
-            cnt = self.test_data_cnt
-        hyps = hyps[:cnt]
-        refs = refs[:cnt]
-        r1,r2,rl = get_rouge_score(hyps,refs)
-        bleu = get_bleu_score(hyps,refs)
-        bleu_1,bleu_2,bleu_3,bleu_4 = get_nltk_bleu_score(hyps,refs)
-        distinct_1,distinct_2 = get_distinct_score(hyps)
-
-        metrics_dict = {
-                stage+"_rouge1":r1,
-                stage+"_rouge2":r2,
-                stage+"_rougeL":rl,
-                stage+"_bleu":bleu,
-                stage+"_bleu1":bleu_1,
-                stage+"_bleu2":bleu_2,
-                stage+"_bleu3":bleu_3,
-                stage+"_bleu4":bleu_4,
-                stage+"_distinct_1":distinct_1,
-                stage+"_distinct_2":distinct_2,
-            }
+        ## hyps and refs are only on the main process (see merge), every rank logs its metrics
+        metrics_dict = None
+        if self.trainer.is_global_zero:
+            if stage == 'valid':
+                cnt = self.valid_data_cnt
+            elif stage == 'test':
+                cnt = self.test_data_cnt
+            hyps = hyps[:cnt]
+            refs = refs[:cnt]
+            r1,r2,rl = get_rouge_score(hyps,refs)
+            bleu = get_bleu_score(hyps,refs)
+            bleu_1,bleu_2,bleu_3,bleu_4 = get_nltk_bleu_score(hyps,refs)
+            distinct_1,distinct_2 = get_distinct_score(hyps)
+
+            metrics_dict = {
+                    stage+"_rouge1":r1,
+                    stage+"_rouge2":r2,
+                    stage+"_rougeL":rl,
+                    stage+"_bleu":bleu,
+                    stage+"_bleu1":bleu_1,
+                    stage+"_bleu2":bleu_2,
+                    stage+"_bleu3":bleu_3,
+                    stage+"_bleu4":bleu_4,
+                    stage+"_distinct_1":distinct_1,
+                    stage+"_distinct_2":distinct_2,
+                }
+        metrics_dict = broadcast_from_main(metrics_dict)
         self.log_dict(metrics_dict)
         if stage=='valid':self.print(json.dumps(metrics_dict,indent=4))
 
@@ -306,12 +351,15 @@ class BrioGenerator(LightningModule):
         return hyps,batch['refs']
     
     def merge(self,outputs):
-
-        if dist.is_initialized():
-            all_rank_outputs = [None for _ in range(dist.get_world_size())]    
-            dist.all_gather_object(all_rank_outputs,outputs)
-            outputs = [x for y in all_rank_outputs for x in y] ## all_rank_output[i]: i-th batch output
+        """
+        the outputs of all ranks on the main process only, the other ranks get empty lists:
+        whatever is computed from them is sent back by broadcast_from_main
+        """
         single_batch_output_cnt = len(outputs[0])
+        all_rank_outputs = gather_to_main(outputs,self.hparams.get('gather_dir'))
+        if all_rank_outputs is None:
+            return [[] for _ in range(single_batch_output_cnt)]
+        outputs = [x for y in all_rank_outputs for x in y] ## all_rank_output[i]: i-th batch output
         ret = [[] for _ in range(single_batch_output_cnt)]
         for idx in range(single_batch_output_cnt):
             for batch in outputs:
@@ -422,33 +470,45 @@ class BrioGenerator(LightningModule):
     def load_data(self,_split):
 
         data_path = os.path.join(self.hparams.data_dir,_split+".jsonl")
-        data = [json.loads(x) for x in open(data_path).readlines()]
+        data = JsonlFile(data_path)
         data_cnt = len(data)
         memory = None
         if self.hparams.memory_dir is not None:
-            mem_path = os.path.join(self.hparams.memory_dir,_split+".txt")
-            memory = [x.strip() for x in open(mem_path).readlines()]
-        
-        candidate_path = os.path.join(self.hparams.candidate_dir,_split+".candidates")
-        candidates = [x.strip() for x in open(candidate_path).readlines()]
-        num_candidates = int(len(candidates)/len(data))
-        candidates = split_list(candidates,num_candidates)
+            mem_path = get_memory_path(self.hparams.memory_dir,_split)
+            memory = load_memory(mem_path)
         
-        score_path = os.path.join(self.hparams.candidate_dir,_split+".scores")
-        scores = [float(x.strip()) for x in open(score_path).readlines()]
-        scores = split_list(scores,num_candidates)
-
-        assert len(scores) == len(data) == len(candidates)
-        for idx in range(len(data)):
-            data[idx]['candidates'] = [
-                (candidate,score) for candidate,score in zip(candidates[idx],scores[idx])
-            ]
+        candidates = CandidateFile(
+            candidate_path = os.path.join(self.hparams.candidate_dir,_split+".candidates"),
+            score_path = os.path.join(self.hparams.candidate_dir,_split+".scores"),
+            num_samples = data_cnt,
+        )
+        assert len(candidates) == len(data)
+
+        token_ids = None
+        if self.hparams.get('token_cache_dir') is not None:
+            sources = [data_path,candidates.candidates.path]+([] if memory is None else memory_files(mem_path))
+            ## collate_fct puts the splitter before the memory for both encodings, and concate
+            ## takes the src part from the memory too
+            memory_text = lambda i:" <MEMORY_SPLITTER> "+memory[i]
+            token_ids = build_token_stores(
+                self.hparams,data,sources,
+                self.src_toker,self.trg_toker,self.hparams.train_max_src_len,self.hparams.train_max_trg_len,
+                memory = memory,
+                candidates = candidates,
+                src_text = memory_text if memory is not None and self.hparams.memory_encoding == 'concate' else None,
+                memory_text = memory_text,
+            )
 
         dataset = MemoryDataset(
             data = data,
             memory = memory,
+            candidates = candidates,
+            token_ids = token_ids,
         )
         return data_cnt,dataset
+
+    def prepare_data(self):
+        prepare_token_stores(self.hparams,self.load_data)
     
     def setup(self,stage):
         if stage == 'fit':
@@ -463,18 +523,34 @@ class BrioGenerator(LightningModule):
             self.test_data_cnt,self.test_dataset=self.load_data('test')
     
     def train_dataloader(self):
+        if self.hparams.get('max_tokens') is not None:
+            ## token-budget batches of similar length, per_device_train_batch_size caps the number of samples
+            batch_sampler = LengthBucketBatchSampler(
+                lengths = get_sample_lengths(self.train_dataset,self.hparams.train_max_src_len),
+                max_tokens = self.hparams.max_tokens,
+                max_batch_size = self.hparams.per_device_train_batch_size,
+                shuffle = True,
+                seed = self.hparams.seed,
+                num_replicas = self.trainer.world_size,
+                rank = self.global_rank,
+            )
+            return torch.utils.data.DataLoader(self.train_dataset, batch_sampler=batch_sampler,
+                                               collate_fn=self.collate_fct,
+                                               num_workers=8, pin_memory=True)
         return torch.utils.data.DataLoader(self.train_dataset, batch_size=self.hparams.per_device_train_batch_size,
                                            shuffle=True,collate_fn=self.collate_fct,
                                            num_workers=8, pin_memory=True)
     
     def val_dataloader(self):
+        sampler = get_eval_sampler(self.valid_dataset,self.hparams.per_device_eval_batch_size,self.trainer.world_size,self.global_rank,self.hparams.get('max_tokens'))
         return torch.utils.data.DataLoader(self.valid_dataset, batch_size=self.hparams.per_device_eval_batch_size,
-                                           shuffle=False,collate_fn=self.collate_fct,
+                                           shuffle=False,collate_fn=self.collate_fct,sampler=sampler,
                                            num_workers=8, pin_memory=True)
     
     def test_dataloader(self):
+        sampler = get_eval_sampler(self.test_dataset,self.hparams.per_device_eval_batch_size,self.trainer.world_size,self.global_rank,self.hparams.get('max_tokens'))
         return torch.utils.data.DataLoader(self.test_dataset, batch_size=self.hparams.per_device_eval_batch_size,
-                                           shuffle=False,collate_fn=self.collate_fct,
+                                           shuffle=False,collate_fn=self.collate_fct,sampler=sampler,
                                            num_workers=8, pin_memory=True)
 
 
@@ -521,6 +597,9 @@ if __name__ == "__main__":
         callbacks= callbacks,
         strategy = strategy,
         val_check_interval=args.val_check_interval,
+        ## the length-bucketed batch sampler already splits the batches across ranks, get_eval_sampler
+        ## splits the eval sets
+        replace_sampler_ddp = args.replace_sampler_ddp and args.max_tokens is None,
     )
 
     if args.zero_shot:
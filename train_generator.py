@@ -35,12 +35,32 @@ from utils.metrics_utils import (
     get_nltk_bleu_score,
     get_distinct_score,
 )
+from utils.ddp_utils import (
+    LengthBucketBatchSampler,
+    get_eval_sampler,
+    gather_to_main,
+    broadcast_from_main,
+)
 from utils.optim_utils import (
     get_inverse_sqrt_schedule_with_warmup
 )
+from utils.memory_utils import (
+    load_memory,
+    get_memory_path,
+    memory_files,
+)
+from utils.data_utils import (
+    JsonlFile,
+    build_token_stores,
+    prepare_token_stores,
+    get_token_ids,
+    tokenize,
+    get_sample_lengths,
+)
 from summarization import (
     DualEncoderPegasusForConditionalGeneration,
     DualEncoderBartForConditionalGeneration,
+    lookup_generate,
 )
 
 class MemoryDataset(torch.utils.data.Dataset):
@@ -49,16 +69,24 @@ class MemoryDataset(torch.utils.data.Dataset):
         self,
         data,
         memory=None,
+        token_ids=None,
         ):
         super().__init__()
         self.data = data
         if memory is not None:
             assert len(data)==len(memory),(len(data),len(memory))
-            for idx in range(len(data)):
-                self.data[idx]['memory']=memory[idx]
+        ## attached per item, so a lazy RetrievedMemory is only decoded when used
+        self.memory = memory
+        ## {key:TokenStore}, pre-tokenized ids attached per item under key
+        self.token_ids = token_ids if token_ids is not None else {}
     
     def __getitem__(self,index):
-        return self.data[index]
+        d = self.data[index]
+        if self.memory is not None:
+            d = {**d,'memory':self.memory[index]}
+        if self.token_ids:
+            d = {**d,**{k:v[index] for k,v in self.token_ids.items()}}
+        return d
 
     def __len__(self,):
         return len(self.data)
@@ -68,13 +96,14 @@ def collate_fct(samples,src_toker,trg_toker,max_src_len,max_trg_len,memory_encod
     src = [d[src] for d in samples]
     trg = [d[trg] for d in samples]
 
-    tokenized_trg = trg_toker(trg,return_tensors='pt',padding=True,truncation=True,max_length=max_trg_len,return_attention_mask=False)
+    ## with pre-tokenized samples (src_ids/trg_ids/memory_ids) tokenize() only pads
+    tokenized_trg = tokenize(trg,trg_toker,max_trg_len,get_token_ids(samples,'trg_ids'))
     tokenized_trg['input_ids'][tokenized_trg['input_ids']==trg_toker.pad_token_id]=-100
     
     has_memory = 'memory' in samples[0].keys()
     if not has_memory:
 
-        tokenized_src = src_toker(src,return_tensors='pt',padding=True,truncation=True,max_length=max_src_len,return_attention_mask=True)
+        tokenized_src = tokenize(src,src_toker,max_src_len,get_token_ids(samples,'src_ids'))
         return {
             "input_ids":tokenized_src['input_ids'],
             "attention_mask":tokenized_src['attention_mask'],
@@ -87,8 +116,8 @@ def collate_fct(samples,src_toker,trg_toker,max_src_len,max_trg_len,memory_encod
         if memory_encoding == 'concate':
             memory_splitter = " <MEMORY_SPLITTER> "
             memory = [memory_splitter + d['memory'] for d in samples]
-            tokenized_memory = src_toker(memory,return_tensors='pt',padding=True,truncation=True,max_length=max_trg_len+2,return_attention_mask=True)
-            tokenized_src = src_toker(src,return_tensors='pt',padding=True,truncation=True,max_length=(max_src_len-max_trg_len-2),return_attention_mask=True)
+            tokenized_memory = tokenize(memory,src_toker,max_trg_len+2,get_token_ids(samples,'memory_ids'))
+            tokenized_src = tokenize(src,src_toker,(max_src_len-max_trg_len-2),get_token_ids(samples,'src_ids'))
             return {
                 "input_ids":torch.cat((tokenized_src['input_ids'],tokenized_memory['input_ids']),dim=1),
                 "attention_mask":torch.cat((tokenized_src['attention_mask'],tokenized_memory['attention_mask']),dim=1),
@@ -98,8 +127,8 @@ def collate_fct(samples,src_toker,trg_toker,max_src_len,max_trg_len,memory_encod
 
         elif memory_encoding == 'separate':
             memory = [d['memory'] for d in samples]
-            tokenized_memory = trg_toker(memory,return_tensors='pt',padding=True,truncation=True,max_length=max_trg_len)
-            tokenized_src = trg_toker(src,return_tensors='pt',padding=True,truncation=True,max_length=max_src_len,return_attention_mask=True)
+            tokenized_memory = tokenize(memory,trg_toker,max_trg_len,get_token_ids(samples,'memory_ids'))
+            tokenized_src = tokenize(src,trg_toker,max_src_len,get_token_ids(samples,'src_ids'))
             return {
                 "input_ids":tokenized_src['input_ids'],
                 "attention_mask":tokenized_src['attention_mask'],
@@ -109,6 +138,14 @@ def collate_fct(samples,src_toker,trg_toker,max_src_len,max_trg_len,memory_encod
                 "refs":trg,
             }
 
+
+def join_dialog(d):
+    d['context'] = " [EOU] ".join(d['context'])
+    ## persona feature
+    if 'persona' in d:
+        persona = " [EOU] ".join(d['persona'])
+        d['context'] = persona + " [EOU] " + d['context']
+    return d
             
 Metric2Fct = {
     "rouge":get_rouge_score,
@@ -129,6 +166,7 @@ class ConditionalGenerator(LightningModule):
         parser.add_argument('--trg')
         parser.add_argument('--train_max_src_len',type=int)
         parser.add_argument('--train_max_trg_len',type=int)
+        parser.add_argument('--token_cache_dir',help='pre-tokenize every split once into this directory, collate_fct then only pads')
         ## model
         parser.add_argument('--pretrained_model_path')
         ## generation
@@ -144,13 +182,17 @@ class ConditionalGenerator(LightningModule):
         parser.add_argument('--top_p',type=float)
         parser.add_argument('--temperature',type=float)
         parser.add_argument('--do_sample',type=bool)
+        parser.add_argument('--lookup_decoding',action='store_true',help='greedy decoding that drafts tokens from the memory and verifies them in one forward pass, same output as greedy')
+        parser.add_argument('--num_draft_tokens',type=int,default=10)
         ## training_parameters
         parser.add_argument('--lr',type=float)
         parser.add_argument('--warmup_steps',type=int)
         parser.add_argument('--weight_decay',type=float)
         parser.add_argument('--label_smoothing_factor',type=float)
         parser.add_argument('--per_device_train_batch_size',type=int)
+        parser.add_argument('--max_tokens',type=int,help='length-bucketed batches of at most max_tokens padded source tokens')
         parser.add_argument('--per_device_eval_batch_size',type=int)
+        parser.add_argument('--gather_dir',help='shared directory to collect the eval outputs of all ranks through files instead of the process group')
         parser.add_argument('--logging_steps',type=int)
         parser.add_argument('--eval_metrics')
         parser.add_argument('--seed',type=int)
@@ -204,29 +246,33 @@ class ConditionalGenerator(LightningModule):
         self.model.resize_token_embeddings(len(self.trg_toker))
 
     def eval_generation(self,hyps,refs,stage='valid'):
-        if stage == 'valid':
-            cnt = self.valid_data_cnt
-        elif stage == 'test':
-            cnt = self.test_data_cnt
-        hyps = hyps[:cnt]
-        refs = refs[:cnt]
-        r1,r2,rl = get_rouge_score(hyps,refs)
-        bleu = get_bleu_score(hyps,refs)
-        bleu_1,bleu_2,bleu_3,bleu_4 = get_nltk_bleu_score(hyps,refs)
-        distinct_1,distinct_2 = get_distinct_score(hyps)
-
-        metrics_dict = {
-                stage+"_rouge1":r1,
-                stage+"_rouge2":r2,
-                stage+"_rougeL":rl,
-                stage+"_bleu":bleu,
-                stage+"_bleu1":bleu_1,
-                stage+"_bleu2":bleu_2,
-                stage+"_bleu3":bleu_3,
-                stage+"_bleu4":bleu_4,
-                stage+"_distinct_1":distinct_1,
-                stage+"_distinct_2":distinct_2,
-            }
+        ## hyps and refs are only on the main process (see merge), every rank logs its metrics
+        metrics_dict = None
+        if self.trainer.is_global_zero:
+            if stage == 'valid':
+                cnt = self.valid_data_cnt
+            elif stage == 'test':
+                cnt = self.test_data_cnt
+            hyps = hyps[:cnt]
+            refs = refs[:cnt]
+            r1,r2,rl = get_rouge_score(hyps,refs)
+            bleu = get_bleu_score(hyps,refs)
+            bleu_1,bleu_2,bleu_3,bleu_4 = get_nltk_bleu_score(hyps,refs)
+            distinct_1,distinct_2 = get_distinct_score(hyps)
+
+            metrics_dict = {
+                    stage+"_rouge1":r1,
+                    stage+"_rouge2":r2,
+                    stage+"_rougeL":rl,
+                    stage+"_bleu":bleu,
+                    stage+"_bleu1":bleu_1,
+                    stage+"_bleu2":bleu_2,
+                    stage+"_bleu3":bleu_3,
+                    stage+"_bleu4":bleu_4,
+                    stage+"_distinct_1":distinct_1,
+                    stage+"_distinct_2":distinct_2,
+                }
+        metrics_dict = broadcast_from_main(metrics_dict)
         self.log_dict(metrics_dict)
         if stage=='valid':self.print(json.dumps(metrics_dict,indent=4))
 
@@ -276,12 +322,15 @@ class ConditionalGenerator(LightningModule):
             return (mle_loss,)
     
     def merge(self,outputs):
-
-        if dist.is_initialized():
-            all_rank_outputs = [None for _ in range(dist.get_world_size())]    
-            dist.all_gather_object(all_rank_outputs,outputs)
-            outputs = [x for y in all_rank_outputs for x in y] ## all_rank_output[i]: i-th batch output
+        """
+        the outputs of all ranks on the main process only, the other ranks get empty lists:
+        whatever is computed from them is sent back by broadcast_from_main
+        """
         single_batch_output_cnt = len(outputs[0])
+        all_rank_outputs = gather_to_main(outputs,self.hparams.get('gather_dir'))
+        if all_rank_outputs is None:
+            return [[] for _ in range(single_batch_output_cnt)]
+        outputs = [x for y in all_rank_outputs for x in y] ## all_rank_output[i]: i-th batch output
         ret = [[] for _ in range(single_batch_output_cnt)]
         for idx in range(single_batch_output_cnt):
             for batch in outputs:
@@ -298,8 +347,9 @@ class ConditionalGenerator(LightningModule):
             self.eval_generation(hyps,refs,'test')
         else:
             loss = self.merge(outputs)
-        self.log("test_ppl",torch.mean(torch.exp(torch.tensor(loss))),sync_dist=False)
-        self.log("test_loss",torch.mean(torch.tensor(loss)),sync_dist=False)
+        ppl,loss = broadcast_from_main((torch.mean(torch.exp(torch.tensor(loss))).item(),torch.mean(torch.tensor(loss)).item()) if self.trainer.is_global_zero else None)
+        self.log("test_ppl",ppl,sync_dist=False)
+        self.log("test_loss",loss,sync_dist=False)
 
         if self.trainer.is_global_zero:
             if self.hparams.do_generation:
@@ -320,8 +370,9 @@ class ConditionalGenerator(LightningModule):
             self.eval_generation(hyps,refs,'valid')
         else:
             loss = self.merge(outputs)
-        self.log("valid_ppl",torch.mean(torch.exp(torch.tensor(loss))),sync_dist=False)
-        self.log("valid_loss",torch.mean(torch.tensor(loss)),sync_dist=False)
+        ppl,loss = broadcast_from_main((torch.mean(torch.exp(torch.tensor(loss))).item(),torch.mean(torch.tensor(loss)).item()) if self.trainer.is_global_zero else None)
+        self.log("valid_ppl",ppl,sync_dist=False)
+        self.log("valid_loss",loss,sync_dist=False)
         
     def on_train_start(self) -> None:
         self.train_start_time = time.time()
@@ -365,8 +416,30 @@ class ConditionalGenerator(LightningModule):
             else:
                 num_return_sequences=self.hparams.num_return_sequences * int(self.hparams.num_beams/self.hparams.num_beam_groups) if self.hparams.num_beam_groups is not None else self.hparams.num_return_sequences
             
+            input_kwargs = {'input_ids':batch['input_ids']}
+            encoder_outputs = self.get_encoder_outputs(batch)
+            if encoder_outputs is not None:
+                ## the decoder starts from decoder_start_token_id, one row per memory
+                input_kwargs = {'encoder_outputs':encoder_outputs}
+            if self.use_lookup_decoding():
+                ## draft from the memory, or from the source it was concatenated to
+                draft_key = 'memory_input_ids' if 'memory_input_ids' in batch.keys() else 'input_ids'
+                output = lookup_generate(
+                    self.model,
+                    input_ids=batch['input_ids'],
+                    attention_mask=batch['attention_mask'],
+                    draft_ids=batch[draft_key],
+                    draft_attention_mask=batch[draft_key.replace('input_ids','attention_mask')],
+                    max_length=self.hparams.gen_max_len+2,
+                    min_length=self.hparams.gen_min_len+1 if self.hparams.gen_min_len is not None else None,
+                    no_repeat_ngram_size=self.hparams.no_repeat_ngram_size,
+                    encoder_outputs=encoder_outputs,
+                    num_draft_tokens=self.hparams.get('num_draft_tokens',10),
+                    **additional_kwargs
+                )
+                return [self.trg_toker.decode(g, skip_special_tokens=True, clean_up_tokenization_spaces=False) for g in output]
             output = self.model.generate(
-                input_ids=batch['input_ids'],
+                **input_kwargs,
                 attention_mask=batch['attention_mask'],
                 max_length=self.hparams.gen_max_len+2,
                 min_length=self.hparams.gen_min_len+1 if self.hparams.gen_min_len is not None else None,
@@ -388,6 +461,28 @@ class ConditionalGenerator(LightningModule):
                 hyps = [hyps[i] for i in range(len(hyps)) if i % num_return_candidates == 0]
         return hyps
 
+    def use_lookup_decoding(self):
+        ## lookup decoding reproduces greedy decoding only, beam search and sampling keep generate()
+        if not self.hparams.get('lookup_decoding',False):
+            return False
+        return self.hparams.num_beams in (None,1) and not self.hparams.do_sample and self.hparams.num_return_sequences in (None,1)
+
+    def get_encoder_outputs(self,batch):
+        """
+        encoder outputs generate starts from, None lets generate run the encoder itself
+        """
+        if 'memory_input_ids' in batch.keys() and batch['memory_input_ids'].shape[0] != batch['input_ids'].shape[0]:
+            ## every source comes with a group of memories: the source is encoded once and
+            ## shared by the grouped cross-attention
+            return self.model.get_encoder()(
+                input_ids=batch['input_ids'],
+                attention_mask=batch['attention_mask'],
+                memory_input_ids=batch['memory_input_ids'],
+                memory_attention_mask=batch['memory_attention_mask'],
+                return_dict=True,
+            )
+        return None
+
     @staticmethod
     def reorder_ddp(all_rank_outputs):
         ## this function can only do with only 1 hyp
@@ -408,12 +503,12 @@ class ConditionalGenerator(LightningModule):
             -reference(for valid/test)
         """
         data_path = os.path.join(self.hparams.data_dir,_split+".jsonl")
-        data = [json.loads(x) for x in open(data_path).readlines()]
+        data = JsonlFile(data_path)
         data_cnt = len(data)
         memory = None
         if self.hparams.memory_dir is not None:
-            mem_path = os.path.join(self.hparams.memory_dir,_split+".txt")
-            memory = [x.strip() for x in open(mem_path).readlines()]
+            mem_path = get_memory_path(self.hparams.memory_dir,_split)
+            memory = load_memory(mem_path)
         
         ## dialog data
         if 'context' in data[0].keys():
@@ -421,20 +516,26 @@ class ConditionalGenerator(LightningModule):
             self.src_toker.add_special_tokens(special_tokens_dict)
             self.vocab_size = len(self.src_toker)
             self.model.resize_token_embeddings(len(self.src_toker))
-            for idx in range(len(data)):
-                data[idx]['context'] = " [EOU] ".join(data[idx]['context'])
-            
-            ## persona feature
-            if 'persona' in data[0].keys():
-                for idx in range(len(data)):
-                    persona = " [EOU] ".join(data[idx]['persona'])
-                    data[idx]['context'] = persona + " [EOU] " + data[idx]['context']
+            ## joined per item when the sample is read
+            data.transform = join_dialog
+
+        token_ids = None
+        if self.hparams.get('token_cache_dir') is not None:
+            token_ids = build_token_stores(
+                self.hparams,data,[data_path]+([] if memory is None else memory_files(mem_path)),
+                self.src_toker,self.trg_toker,self.hparams.train_max_src_len,self.hparams.train_max_trg_len,
+                memory = memory,
+            )
 
         dataset = MemoryDataset(
             data = data,
             memory = memory,
+            token_ids = token_ids,
         )
         return data_cnt,dataset
+
+    def prepare_data(self):
+        prepare_token_stores(self.hparams,self.load_data)
     
     def setup(self,stage):
         if stage == 'fit':
@@ -445,18 +546,34 @@ class ConditionalGenerator(LightningModule):
             self.test_data_cnt,self.test_dataset=self.load_data('test')
     
     def train_dataloader(self):
+        if self.hparams.get('max_tokens') is not None:
+            ## token-budget batches of similar length, per_device_train_batch_size caps the number of samples
+            batch_sampler = LengthBucketBatchSampler(
+                lengths = get_sample_lengths(self.train_dataset,self.hparams.train_max_src_len),
+                max_tokens = self.hparams.max_tokens,
+                max_batch_size = self.hparams.per_device_train_batch_size,
+                shuffle = True,
+                seed = self.hparams.seed,
+                num_replicas = self.trainer.world_size,
+                rank = self.global_rank,
+            )
+            return torch.utils.data.DataLoader(self.train_dataset, batch_sampler=batch_sampler,
+                                               collate_fn=self.collate_fct,
+                                               num_workers=4, pin_memory=True)
         return torch.utils.data.DataLoader(self.train_dataset, batch_size=self.hparams.per_device_train_batch_size,
                                            shuffle=True,collate_fn=self.collate_fct,
                                            num_workers=4, pin_memory=True)
     
     def val_dataloader(self):
+        sampler = get_eval_sampler(self.valid_dataset,self.hparams.per_device_eval_batch_size,self.trainer.world_size,self.global_rank,self.hparams.get('max_tokens'))
         return torch.utils.data.DataLoader(self.valid_dataset, batch_size=self.hparams.per_device_eval_batch_size,
-                                           shuffle=False,collate_fn=self.collate_fct,
+                                           shuffle=False,collate_fn=self.collate_fct,sampler=sampler,
                                            num_workers=4, pin_memory=True)
     
     def test_dataloader(self):
+        sampler = get_eval_sampler(self.test_dataset,self.hparams.per_device_eval_batch_size,self.trainer.world_size,self.global_rank,self.hparams.get('max_tokens'))
         return torch.utils.data.DataLoader(self.test_dataset, batch_size=self.hparams.per_device_eval_batch_size,
-                                           shuffle=False,collate_fn=self.collate_fct,
+                                           shuffle=False,collate_fn=self.collate_fct,sampler=sampler,
                                            num_workers=4, pin_memory=True)
 
 
@@ -502,6 +619,9 @@ if __name__ == "__main__":
         callbacks= callbacks,
         strategy = strategy,
         val_check_interval=args.val_check_interval,
+        ## the length-bucketed batch sampler already splits the batches across ranks, get_eval_sampler
+        ## splits the eval sets
+        replace_sampler_ddp = args.replace_sampler_ddp and args.max_tokens is None,
     )
 
     if args.zero_shot:
@@ -36,22 +36,50 @@ from utils.metrics_utils import (
     get_nltk_bleu_score,
     get_distinct_score,
 )
+from utils.data_utils import (
+    JsonlFile,
+    CandidateFile,
+    build_token_stores,
+    prepare_token_stores,
+    get_token_ids,
+    tokenize,
+    get_sample_lengths,
+)
+from utils.ddp_utils import (
+    LengthBucketBatchSampler,
+    get_eval_sampler,
+    gather_to_main,
+    broadcast_from_main,
+)
+from brio.loss import (
+    RankingLoss,
+)
 from utils.optim_utils import (
     get_inverse_sqrt_schedule_with_warmup
 )
 
 class MemoryDataset(torch.utils.data.Dataset):
 
-    def __init__(self,data,memory=None,):
+    def __init__(self,data,memory=None,candidates=None,token_ids=None):
         super().__init__()
         self.data = data
         if memory is not None:
             assert len(data)==len(memory),(len(data),len(memory))
-            for idx in range(len(data)):
-                self.data[idx]['memory']=memory[idx]
+        ## attached per item, nothing is decoded before it is used
+        self.memory = memory
+        self.candidates = candidates
+        ## {key:TokenStore}, pre-tokenized ids attached per item under key
+        self.token_ids = token_ids if token_ids is not None else {}
     
     def __getitem__(self,index):
-        return self.data[index]
+        d = {**self.data[index]}
+        if self.memory is not None:
+            d['memory'] = self.memory[index]
+        if self.candidates is not None:
+            d['candidates'] = self.candidates[index]
+        for k,v in self.token_ids.items():
+            d[k] = v[index]
+        return d
 
     def __len__(self,):
         return len(self.data)
@@ -63,6 +91,10 @@ def collate_fct(samples,toker,max_src_len,max_trg_len,src='document',trg='summar
     src = [d[src] for d in samples]
     trg = [d[trg] for d in samples]
     candidates = [d['candidates'] for d in samples]
+    ## with pre-tokenized samples (src_ids/trg_ids, ids as 3rd field of every candidate) tokenize() only pads
+    src_ids = get_token_ids(samples,'src_ids')
+    trg_ids = get_token_ids(samples,'trg_ids')
+    candidate_ids = None if src_ids is None else []
     labels = []
     for idx in range(len(candidates)):
         if num_candidates is not None:
@@ -74,17 +106,22 @@ def collate_fct(samples,toker,max_src_len,max_trg_len,src='document',trg='summar
                 candidates[idx].sort(key=lambda x:x[1],reverse=True)
                 candidates[idx] = candidates[idx][:1] + candidates[idx][-(num_candidates-1):]
         candidates[idx].sort(key=lambda x:x[1],reverse=True)    
+        if candidate_ids is not None:
+            candidate_ids.append([x[2] for x in candidates[idx]])
         candidates[idx] = [x[0] for x in candidates[idx]]
         labels.append([x[1] for x in candidates[idx]])
         if is_training:
             candidates[idx].insert(0,trg[idx])
             labels[idx].insert(0,1)
+            if candidate_ids is not None:
+                candidate_ids[idx].insert(0,trg_ids[idx])
     
     flattened_candidates = [x for y in candidates for x in y]
     flattened_labels = [x for y in labels for x in y]
+    flattened_candidate_ids = None if candidate_ids is None else [x for y in candidate_ids for x in y]
 
-    tokenized_src = toker(src,return_tensors='pt',padding=True,truncation=True,max_length=max_src_len)
-    tokenized_candidates = toker(flattened_candidates,return_tensors='pt',padding=True,truncation=True,max_length=max_trg_len)
+    tokenized_src = tokenize(src,toker,max_src_len,src_ids)
+    tokenized_candidates = tokenize(flattened_candidates,toker,max_trg_len,flattened_candidate_ids)
 
     return {
         "src_input_ids":tokenized_src['input_ids'],
@@ -109,14 +146,17 @@ class RankingModel(LightningModule):
         parser.add_argument('--trg')
         parser.add_argument('--max_trg_len', type=int)
         parser.add_argument('--max_src_len', type=int)
+        parser.add_argument('--token_cache_dir',help='pre-tokenize every split once into this directory, collate_fct then only pads')
         parser.add_argument('--pretrained_model_path')
         parser.add_argument("--temperature",type=float)
         parser.add_argument('--lr',type=float)
         parser.add_argument('--warmup_steps',type=int)
         parser.add_argument('--weight_decay',type=float)
         parser.add_argument('--per_device_train_batch_size',type=int)
+        parser.add_argument('--max_tokens',type=int,help='length-bucketed batches of at most max_tokens padded source tokens')
         parser.add_argument("--num_candidates",type=int)
         parser.add_argument('--per_device_eval_batch_size',type=int)
+        parser.add_argument('--gather_dir',help='shared directory to collect the eval outputs of all ranks through files instead of the process group')
         parser.add_argument('--logging_steps',type=int)
         parser.add_argument('--eval_metrics')
         parser.add_argument('--seed',type=int)
@@ -161,29 +201,33 @@ class RankingModel(LightningModule):
             self.model = AutoModel.from_pretrained(self.hparams.pretrained_model_path,num_labels=1)
 
     def eval_generation(self,hyps,refs,stage='valid'):
-        if stage == 'valid':
-            cnt = self.valid_data_cnt
-        elif stage == 'test':
-            cnt = self.test_data_cnt
-        hyps = hyps[:cnt]
-        refs = refs[:cnt]
-        r1,r2,rl = get_rouge_score(hyps,refs)
-        bleu = get_bleu_score(hyps,refs)
-        bleu_1,bleu_2,bleu_3,bleu_4 = get_nltk_bleu_score(hyps,refs)
-        distinct_1,distinct_2 = get_distinct_score(hyps)
-
-        metrics_dict = {
-                stage+"_rouge1":r1,
-                stage+"_rouge2":r2,
-                stage+"_rougeL":rl,
-                stage+"_bleu":bleu,
-                stage+"_bleu1":bleu_1,
-                stage+"_bleu2":bleu_2,
-                stage+"_bleu3":bleu_3,
-                stage+"_bleu4":bleu_4,
-                stage+"_distinct_1":distinct_1,
-                stage+"_distinct_2":distinct_2,
-            }
+        ## hyps and refs are only on the main process (see merge), every rank logs its metrics
+        metrics_dict = None
+        if self.trainer.is_global_zero:
+            if stage == 'valid':
+                cnt = self.valid_data_cnt
+            elif stage == 'test':
+                cnt = self.test_data_cnt
+            hyps = hyps[:cnt]
+            refs = refs[:cnt]
+            r1,r2,rl = get_rouge_score(hyps,refs)
+            bleu = get_bleu_score(hyps,refs)
+            bleu_1,bleu_2,bleu_3,bleu_4 = get_nltk_bleu_score(hyps,refs)
+            distinct_1,distinct_2 = get_distinct_score(hyps)
+
+            metrics_dict = {
+                    stage+"_rouge1":r1,
+                    stage+"_rouge2":r2,
+                    stage+"_rougeL":rl,
+                    stage+"_bleu":bleu,
+                    stage+"_bleu1":bleu_1,
+                    stage+"_bleu2":bleu_2,
+                    stage+"_bleu3":bleu_3,
+                    stage+"_bleu4":bleu_4,
+                    stage+"_distinct_1":distinct_1,
+                    stage+"_distinct_2":distinct_2,
+                }
+        metrics_dict = broadcast_from_main(metrics_dict)
         self.log_dict(metrics_dict)
         self.print(json.dumps(metrics_dict,indent=4))
 
@@ -214,32 +258,13 @@ class RankingModel(LightningModule):
         logits = torch.nn.functional.normalize(logits,dim=1)
         refs_scores = logits[:,0]
         candidates_scores = logits[:,1:]
-        
-        ones = torch.ones_like(candidates_scores)
-        loss_func = torch.nn.MarginRankingLoss(0.0)
-        TotalLoss = loss_func(candidates_scores, candidates_scores, ones)
-        # candidate loss
-        n = candidates_scores.size(1)
-        for i in range(1, n):
-            pos_score = candidates_scores[:, :-i]
-            neg_score = candidates_scores[:, i:]
-            pos_score = pos_score.contiguous().view(-1)
-            neg_score = neg_score.contiguous().view(-1)
-            ones = torch.ones_like(pos_score)
-            loss_func = torch.nn.MarginRankingLoss(self.hparams.margin * i)
-            loss = loss_func(pos_score, neg_score, ones)
-            TotalLoss += loss
-        if self.hparams.no_gold:
-            return TotalLoss
-        # gold summary loss
-        pos_score = refs_scores.unsqueeze(-1).expand_as(candidates_scores)
-        neg_score = candidates_scores
-        pos_score = pos_score.contiguous().view(-1)
-        neg_score = neg_score.contiguous().view(-1)
-        ones = torch.ones_like(pos_score)
-        loss_func = torch.nn.MarginRankingLoss(self.hparams.gold_margin)
-        TotalLoss += self.hparams.gold_weight * loss_func(pos_score, neg_score, ones)
-        return TotalLoss
+        ranking_loss = RankingLoss(
+            margin = self.hparams.margin,
+            gold_margin = self.hparams.gold_margin,
+            gold_weight = self.hparams.gold_weight,
+            no_gold = self.hparams.no_gold,
+        )
+        return ranking_loss(candidates_scores,refs_scores)
 
     def get_logits(self,batch):
         
@@ -331,12 +356,15 @@ class RankingModel(LightningModule):
         return hyps,ranking
 
     def merge(self,outputs):
-
-        if dist.is_initialized():
-            all_rank_outputs = [None for _ in range(dist.get_world_size())]    
-            dist.all_gather_object(all_rank_outputs,outputs)
-            outputs = [x for y in all_rank_outputs for x in y] ## all_rank_output[i]: i-th batch output
+        """
+        the outputs of all ranks on the main process only, the other ranks get empty lists:
+        whatever is computed from them is sent back by broadcast_from_main
+        """
         single_batch_output_cnt = len(outputs[0])
+        all_rank_outputs = gather_to_main(outputs,self.hparams.get('gather_dir'))
+        if all_rank_outputs is None:
+            return [[] for _ in range(single_batch_output_cnt)]
+        outputs = [x for y in all_rank_outputs for x in y] ## all_rank_output[i]: i-th batch output
         ret = [[] for _ in range(single_batch_output_cnt)]
         for idx in range(single_batch_output_cnt):
             for batch in outputs:
@@ -350,7 +378,7 @@ class RankingModel(LightningModule):
         hyps = [x for y in hyps for x in y]
         refs = [x for y in refs for x in y]
         rankings = [x for y in rankings for x in y]
-        self.print('avg_ranking:',sum(rankings)/len(rankings))
+        if rankings:self.print('avg_ranking:',sum(rankings)/len(rankings))
         self.eval_generation(hyps,refs,'test')
 
         if self.trainer.is_global_zero:
@@ -367,7 +395,7 @@ class RankingModel(LightningModule):
         hyps = [x for y in hyps for x in y]
         refs = [x for y in refs for x in y]
         rankings = [x for y in rankings for x in y]
-        self.print('avg_ranking:',sum(rankings)/len(rankings))
+        if rankings:self.print('avg_ranking:',sum(rankings)/len(rankings))
         self.eval_generation(hyps,refs,'valid')
 
     def on_train_start(self) -> None:
@@ -419,28 +447,36 @@ class RankingModel(LightningModule):
     def load_data(self,_split):
 
         data_path = os.path.join(self.hparams.data_dir,_split+".jsonl")
-        data = [json.loads(x) for x in open(data_path).readlines()]
+        data = JsonlFile(data_path)
         data_cnt = len(data)
         
-        candidate_path = os.path.join(self.hparams.candidate_dir,_split+".candidates")
-        candidates = [x.strip() for x in open(candidate_path).readlines()]
-        num_candidates = int(len(candidates)/len(data))
-        candidates = split_list(candidates,num_candidates)
-        
-        score_path = os.path.join(self.hparams.candidate_dir,_split+".scores")
-        scores = [float(x.strip()) for x in open(score_path).readlines()]
-        scores = split_list(scores,num_candidates)
-
-        assert len(scores) == len(data) == len(candidates)
-        for idx in range(len(data)):
-            data[idx]['candidates'] = [
-                [candidate,score] for candidate,score in zip(candidates[idx],scores[idx])
-            ]
+        candidates = CandidateFile(
+            candidate_path = os.path.join(self.hparams.candidate_dir,_split+".candidates"),
+            score_path = os.path.join(self.hparams.candidate_dir,_split+".scores"),
+            num_samples = data_cnt,
+        )
+        assert len(candidates) == len(data)
+
+        token_ids = None
+        if self.hparams.get('token_cache_dir') is not None:
+            is_training = _split == 'train'
+            ## one tokenizer for everything, collate_fct truncates candidates to max_src_len outside of training
+            token_ids = build_token_stores(
+                self.hparams,data,[data_path,candidates.candidates.path],
+                self.toker,self.toker,self.hparams.max_src_len,self.hparams.max_trg_len if is_training else self.hparams.max_src_len,
+                candidates = candidates,
+                with_trg = is_training,
+            )
 
         dataset = MemoryDataset(
             data = data,
+            candidates = candidates,
+            token_ids = token_ids,
         )
         return data_cnt,dataset
+
+    def prepare_data(self):
+        prepare_token_stores(self.hparams,self.load_data)
     
     def setup(self,stage):
         if stage == 'fit':
@@ -455,18 +491,34 @@ class RankingModel(LightningModule):
             self.test_data_cnt,self.test_dataset=self.load_data('test')
     
     def train_dataloader(self):
+        if self.hparams.get('max_tokens') is not None:
+            ## token-budget batches of similar length, per_device_train_batch_size caps the number of samples
+            batch_sampler = LengthBucketBatchSampler(
+                lengths = get_sample_lengths(self.train_dataset,self.hparams.max_src_len),
+                max_tokens = self.hparams.max_tokens,
+                max_batch_size = self.hparams.per_device_train_batch_size,
+                shuffle = True,
+                seed = self.hparams.seed,
+                num_replicas = self.trainer.world_size,
+                rank = self.global_rank,
+            )
+            return torch.utils.data.DataLoader(self.train_dataset, batch_sampler=batch_sampler,
+                                               collate_fn=self.train_collate_fct,
+                                               num_workers=8, pin_memory=True)
         return torch.utils.data.DataLoader(self.train_dataset, batch_size=self.hparams.per_device_train_batch_size,
                                            shuffle=True,collate_fn=self.train_collate_fct,
                                            num_workers=8, pin_memory=True)
     
     def val_dataloader(self):
+        sampler = get_eval_sampler(self.valid_dataset,self.hparams.per_device_eval_batch_size,self.trainer.world_size,self.global_rank,self.hparams.get('max_tokens'))
         return torch.utils.data.DataLoader(self.valid_dataset, batch_size=self.hparams.per_device_eval_batch_size,
-                                           shuffle=False,collate_fn=self.test_collate_fct,
+                                           shuffle=False,collate_fn=self.test_collate_fct,sampler=sampler,
                                            num_workers=8, pin_memory=True)
     
     def test_dataloader(self):
+        sampler = get_eval_sampler(self.test_dataset,self.hparams.per_device_eval_batch_size,self.trainer.world_size,self.global_rank,self.hparams.get('max_tokens'))
         return torch.utils.data.DataLoader(self.test_dataset, batch_size=self.hparams.per_device_eval_batch_size,
-                                           shuffle=False,collate_fn=self.test_collate_fct,
+                                           shuffle=False,collate_fn=self.test_collate_fct,sampler=sampler,
                                            num_workers=8, pin_memory=True)
 
 
@@ -513,6 +565,9 @@ if __name__ == "__main__":
         callbacks= callbacks,
         strategy = strategy,
         val_check_interval=args.val_check_interval,
+        ## the length-bucketed batch sampler already splits the batches across ranks, get_eval_sampler
+        ## splits the eval sets
+        replace_sampler_ddp = args.replace_sampler_ddp and args.max_tokens is None,
     )
 
     if args.zero_shot:
@@ -0,0 +1,148 @@
+"""
+Content-keyed caches.
+
+ArtifactCache: retrieval artifacts (index, per-split id arrays, memory files). A cache.json
+manifest next to the artifacts records the key every artifact was built with. Keys hash the
+content of the input files together with the settings that change the output, so a re-run
+skips every artifact whose key still matches. File digests are memoized by size and mtime,
+an unchanged file is hashed only once.
+
+EncoderStateCache: source encoder states of a frozen generator, kept across self-memory
+iterations so that only the memory side is encoded again.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+
+def hash_key(*parts):
+    return hashlib.sha1(json.dumps(parts,sort_keys=True,default=str).encode()).hexdigest()
+
+def atomic_save(path,array):
+    ## write then rename, an interrupted run never leaves a truncated artifact behind
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path,'wb') as f:
+        np.save(f,array)
+    os.replace(tmp_path,path)
+
+class ArtifactCache:
+    """
+    root: directory of the artifacts, the manifest is {root}/cache.json
+    enabled: False never reports an artifact as fresh, i.e. everything is rebuilt
+    """
+    def __init__(self,root,enabled=True):
+        self.root = root
+        self.enabled = enabled
+        self.manifest_path = os.path.join(root,'cache.json')
+        self.manifest = {'digests':{},'artifacts':{}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def digest(self,path,chunk_size=1<<24):
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        entry = self.manifest['digests'].get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['digest']
+        h = hashlib.sha1()
+        with open(path,'rb') as f:
+            for chunk in iter(lambda:f.read(chunk_size),b''):
+                h.update(chunk)
+        self.manifest['digests'][path] = {'size':stat.st_size,'mtime':stat.st_mtime,'digest':h.hexdigest()}
+        self.save()
+        return h.hexdigest()
+
+    def is_fresh(self,name,key,paths=()):
+        """
+        the artifact was built with key and all of its files are still there
+        """
+        return self.enabled and self.manifest['artifacts'].get(name) == key and all(os.path.exists(p) for p in paths)
+
+    def update(self,name,key):
+        self.manifest['artifacts'][name] = key
+        self.save()
+
+    def save(self):
+        os.makedirs(self.root,exist_ok=True)
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path,'w') as f:
+            json.dump(self.manifest,f,indent=1)
+        os.replace(tmp_path,self.manifest_path)
+
+class EncoderStateCache:
+    """
+    Per-sample encoder states (the non-padding rows only) under {root}, root being specific
+    to one model and one data file:
+        meta.json                  hidden size
+        {part}.bin                 float16 [rows,hidden] states appended back to back
+        {part}.index.npy           int64 [n,3]: sample id, first row, number of rows
+    Every process appends to its own part, a part becomes visible to later runs once flush()
+    wrote its index, so an interrupted run only loses its unflushed part.
+    """
+    def __init__(self,root,rank=0):
+        import glob
+        self.root = root
+        os.makedirs(root,exist_ok=True)
+        self.hidden_size = None
+        if os.path.exists(os.path.join(root,'meta.json')):
+            with open(os.path.join(root,'meta.json')) as f:
+                self.hidden_size = json.load(f)['hidden_size']
+        ## sample id -> (part,first row,number of rows)
+        self.entries = {}
+        parts = sorted(x[:-len('.index.npy')] for x in glob.glob(os.path.join(root,'*.index.npy')))
+        for part in parts:
+            for sample_id,start,length in np.load(part+'.index.npy'):
+                self.entries[int(sample_id)] = (part,int(start),int(length))
+        self._states = {}
+        self.part = os.path.join(root,f"part{len(parts)}-rank{rank}-{os.getpid()}")
+        self._file = None
+        self._rows = 0
+        self._index = []
+
+    def states(self,part):
+        ## the part this process is writing grows, it is mapped again when a row is beyond the mapping
+        num_rows = os.path.getsize(part+'.bin') // (2 * self.hidden_size)
+        if part not in self._states or self._states[part].shape[0] < num_rows:
+            self._states[part] = np.memmap(part+'.bin',dtype=np.float16,mode='r',shape=(num_rows,self.hidden_size))
+        return self._states[part]
+
+    def get(self,sample_id):
+        """
+        float16 [length,hidden] or None when the sample was never cached
+        """
+        entry = self.entries.get(sample_id)
+        if entry is None:
+            return None
+        part,start,length = entry
+        return np.asarray(self.states(part)[start:start+length])
+
+    def put(self,sample_id,states):
+        """
+        states: [length,hidden] states of the non-padding positions of the sample
+        """
+        if sample_id in self.entries:
+            return
+        states = np.ascontiguousarray(states,dtype=np.float16)
+        if self.hidden_size is None:
+            self.hidden_size = states.shape[1]
+            tmp_path = os.path.join(self.root,f"meta.json.{os.getpid()}.tmp")
+            with open(tmp_path,'w') as f:
+                json.dump({'hidden_size':self.hidden_size},f)
+            os.replace(tmp_path,os.path.join(self.root,'meta.json'))
+        assert states.shape[1] == self.hidden_size,(states.shape,self.hidden_size)
+        if self._file is None:
+            self._file = open(self.part+'.bin','ab')
+        self._file.write(states.tobytes())
+        ## readable through states() right away
+        self._file.flush()
+        self.entries[sample_id] = (self.part,self._rows,len(states))
+        self._index.append((sample_id,self._rows,len(states)))
+        self._rows += len(states)
+
+    def flush(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        atomic_save(self.part+'.index.npy',np.asarray(self._index,dtype=np.int64).reshape(-1,3))
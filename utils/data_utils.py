@@ -0,0 +1,298 @@
+"""
+Lazy, line-indexed views over .jsonl/.txt data files.
+
+The byte offset of every line is computed once with a vectorized newline scan and cached
+next to the file as {path}.offsets.npy (rebuilt when the file is newer). The file itself is
+memory-mapped and a line is only decoded when it is indexed, so DataLoader workers and DDP
+ranks share the page cache instead of each holding a copy-on-write list of dicts, and every
+rank only ever touches the lines its sampler hands out.
+
+TokenStore keeps the output of the tokenizer the same way (offsets + one int32 id array), so
+the collate_fcts of a pre-tokenized run only pad instead of re-tokenizing every epoch.
+"""
+import os
+import json
+import numpy as np
+
+def build_line_offsets(path,chunk_size=1<<26):
+    """
+    int64 [num_lines+1], line i is data[offsets[i]:offsets[i+1]] (newline included)
+    same line count as open(path).readlines()
+    """
+    offsets = [np.zeros(1,dtype=np.int64)]
+    size = 0
+    with open(path,'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk,dtype=np.uint8) == ord('\n'))
+            offsets.append(newlines.astype(np.int64) + size + 1)
+            size += len(chunk)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != size:
+        ## last line without trailing newline
+        offsets = np.append(offsets,size)
+    return offsets
+
+def load_line_offsets(path):
+    cache_path = path+'.offsets.npy'
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        return np.load(cache_path)
+    offsets = build_line_offsets(path)
+    try:
+        ## write then rename, so concurrent ranks never read a half-written cache
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path,'wb') as f:
+            np.save(f,offsets)
+        os.replace(tmp_path,cache_path)
+    except OSError:
+        pass
+    return offsets
+
+class LineFile:
+    """
+    Read-only list of the lines of a text file, without the trailing newline.
+    strip: also strip surrounding whitespace, like [x.strip() for x in open(path).readlines()]
+    """
+    def __init__(self,path,offsets=None,strip=False):
+        self.path = path
+        self.strip = strip
+        self.offsets = offsets if offsets is not None else load_line_offsets(path)
+        self._data = None
+
+    @property
+    def data(self):
+        ## opened lazily so that the view can be pickled into DataLoader workers
+        if self._data is None:
+            if self.offsets[-1] == 0:
+                self._data = np.zeros(0,dtype=np.uint8)
+            else:
+                self._data = np.memmap(self.path,dtype=np.uint8,mode='r')
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def get_bytes(self,index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.data[self.offsets[index]:self.offsets[index+1]].tobytes()
+
+    def __getitem__(self,index):
+        line = self.get_bytes(index).decode('utf-8')
+        return line.strip() if self.strip else line.rstrip('\r\n')
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+class JsonlFile(LineFile):
+    """
+    Read-only list of the json objects of a .jsonl file, decoded on access.
+    transform: optional picklable function applied to every decoded object
+    """
+    def __init__(self,path,transform=None,offsets=None):
+        super().__init__(path,offsets)
+        self.transform = transform
+
+    def __getitem__(self,index):
+        d = json.loads(self.get_bytes(index))
+        if self.transform is not None:
+            d = self.transform(d)
+        return d
+
+class CandidateFile:
+    """
+    i-th item: [[candidate,score],...] for the num_candidates lines that belong to the i-th sample
+    token_ids: optional TokenStore over the candidate lines, then every entry is [candidate,score,ids]
+    """
+    def __init__(self,candidate_path,score_path,num_samples,token_ids=None):
+        self.candidates = LineFile(candidate_path,strip=True)
+        assert len(self.candidates) % num_samples == 0,(len(self.candidates),num_samples)
+        self.num_candidates = int(len(self.candidates)/num_samples)
+        self.scores = np.loadtxt(score_path,dtype=np.float64,ndmin=1)
+        assert len(self.scores) == len(self.candidates),(len(self.scores),len(self.candidates))
+        self.token_ids = token_ids
+
+    def __getitem__(self,index):
+        start = index * self.num_candidates
+        if self.token_ids is not None:
+            return [
+                [self.candidates[idx],float(self.scores[idx]),self.token_ids[idx]] for idx in range(start,start+self.num_candidates)
+            ]
+        return [
+            [self.candidates[idx],float(self.scores[idx])] for idx in range(start,start+self.num_candidates)
+        ]
+
+    def __len__(self):
+        return int(len(self.candidates)/self.num_candidates)
+
+class TokenStore:
+    """
+    Pre-tokenized, truncated token ids of a list of texts:
+        {prefix}.offsets.npy  int64 [N+1]
+        {prefix}.ids.npy      int32, all ids back to back
+    both memory-mapped, i-th item is an int32 array
+    """
+    def __init__(self,prefix):
+        self.prefix = prefix
+        self.offsets = np.load(prefix+'.offsets.npy',mmap_mode='r')
+        self.ids = np.load(prefix+'.ids.npy',mmap_mode='r')
+
+    def __getstate__(self):
+        return {'prefix':self.prefix}
+
+    def __setstate__(self,state):
+        self.__init__(state['prefix'])
+
+    def __getitem__(self,index):
+        return np.asarray(self.ids[self.offsets[index]:self.offsets[index+1]])
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+def build_token_store(prefix,texts,toker,max_length,batch_size=1000):
+    """
+    texts: iterable of str, tokenized exactly like toker(texts,truncation=True,max_length=max_length) in the collate_fct
+    """
+    from itertools import islice
+    texts = iter(texts)
+    offsets = [0]
+    ids = []
+    while True:
+        batch = list(islice(texts,batch_size))
+        if not batch:
+            break
+        for x in toker(batch,truncation=True,max_length=max_length,return_attention_mask=False)['input_ids']:
+            ids.append(np.asarray(x,dtype=np.int32))
+            offsets.append(offsets[-1]+len(x))
+    ids = np.concatenate(ids) if ids else np.zeros(0,dtype=np.int32)
+    ## write then rename, the store is only visible once complete
+    for suffix,array in [('.ids.npy',ids),('.offsets.npy',np.asarray(offsets,dtype=np.int64))]:
+        tmp_path = f"{prefix}{suffix}.{os.getpid()}.tmp"
+        with open(tmp_path,'wb') as f:
+            np.save(f,array)
+        os.replace(tmp_path,prefix+suffix)
+
+def get_token_stores(cache_dir,sources,fields):
+    """
+    cache_dir: where the stores live
+    sources: the files the texts are read from, their size/mtime are part of the cache key
+    fields: {name:(toker,max_length,texts_fn)}, texts_fn is only called when the store has to be built
+    return: {name:TokenStore}
+    """
+    import hashlib
+    os.makedirs(cache_dir,exist_ok=True)
+    source_key = "|".join(f"{os.path.abspath(p)}:{os.path.getsize(p)}:{os.path.getmtime(p)}" for p in sources)
+    stores = {}
+    for name,(toker,max_length,texts_fn) in fields.items():
+        toker_key = f"{toker.name_or_path}:{len(toker)}"
+        key = hashlib.md5(f"{source_key}|{toker_key}|{name}|{max_length}".encode()).hexdigest()[:16]
+        prefix = os.path.join(cache_dir,f"{name}.{key}")
+        if not os.path.exists(prefix+'.offsets.npy'):
+            build_token_store(prefix,texts_fn(),toker,max_length)
+        stores[name] = TokenStore(prefix)
+    return stores
+
+def build_token_stores(hparams,data,sources,src_toker,trg_toker,max_src_len,max_trg_len,
+                       memory=None,candidates=None,with_trg=True,src_text=None,memory_text=None):
+    """
+    every text a collate_fct tokenizes, with the tokenizer and max_length it uses there,
+    tokenized once into hparams.token_cache_dir:
+        trg_ids        data[i][trg], trg_toker, max_trg_len (with_trg)
+        candidate_ids  candidate lines, trg_toker, max_trg_len, attached to candidates
+        src_ids        without memory: src_toker, max_src_len
+        src_ids        with memory, by hparams.memory_encoding:
+        memory_ids        concate: src_toker, max_src_len-max_trg_len-2 for src, max_trg_len+2 for memory
+                          separate: trg_toker, max_src_len for src, max_trg_len for memory
+    src_text/memory_text: index -> text, by default data[i][src] and memory[i]
+        (after the memory splitter for concate)
+    return: {key:TokenStore} of the fields attached per item
+    """
+    src,trg = hparams.src,hparams.trg
+    if src_text is None:
+        src_text = lambda i:data[i][src]
+    if memory_text is None:
+        memory_text = (lambda i:" <MEMORY_SPLITTER> "+memory[i]) if hparams.get('memory_encoding') == 'concate' else (lambda i:memory[i])
+    fields = {}
+    if with_trg:
+        fields['trg_ids'] = (trg_toker,max_trg_len,lambda:(data[i][trg] for i in range(len(data))))
+    if candidates is not None:
+        fields['candidate_ids'] = (trg_toker,max_trg_len,lambda:(candidates.candidates[i] for i in range(len(candidates.candidates))))
+    if memory is None:
+        fields['src_ids'] = (src_toker,max_src_len,lambda:(src_text(i) for i in range(len(data))))
+    elif hparams.memory_encoding == 'concate':
+        fields['src_ids'] = (src_toker,max_src_len-max_trg_len-2,lambda:(src_text(i) for i in range(len(data))))
+        fields['memory_ids'] = (src_toker,max_trg_len+2,lambda:(memory_text(i) for i in range(len(memory))))
+    elif hparams.memory_encoding == 'separate':
+        fields['src_ids'] = (trg_toker,max_src_len,lambda:(src_text(i) for i in range(len(data))))
+        fields['memory_ids'] = (trg_toker,max_trg_len,lambda:(memory_text(i) for i in range(len(memory))))
+    token_ids = get_token_stores(hparams.token_cache_dir,sources,fields)
+    if candidates is not None:
+        candidates.token_ids = token_ids.pop('candidate_ids')
+    return token_ids
+
+def prepare_token_stores(hparams,load_data,splits=('train','dev','test')):
+    """
+    for LightningModule.prepare_data: runs on local rank 0 before setup(), so that the other
+    ranks only memory-map the finished stores
+    """
+    if hparams.get('token_cache_dir') is not None:
+        for _split in splits:
+            load_data(_split)
+
+def pad_token_ids(seqs,pad_token_id):
+    import torch
+    max_len = max(len(x) for x in seqs)
+    input_ids = torch.full((len(seqs),max_len),pad_token_id,dtype=torch.long)
+    attention_mask = torch.zeros((len(seqs),max_len),dtype=torch.long)
+    for idx,x in enumerate(seqs):
+        input_ids[idx,:len(x)] = torch.from_numpy(np.asarray(x,dtype=np.int64))
+        attention_mask[idx,:len(x)] = 1
+    return {"input_ids":input_ids,"attention_mask":attention_mask}
+
+def get_token_ids(samples,key):
+    """
+    the pre-tokenized ids of a batch, None when the samples were not pre-tokenized
+    """
+    if key in samples[0]:
+        return [d[key] for d in samples]
+    return None
+
+def tokenize(texts,toker,max_length,token_ids=None):
+    """
+    toker(texts,...) as the collate_fcts call it, or, when the pre-tokenized token_ids are given, only pad them
+    """
+    if token_ids is not None:
+        return pad_token_ids(token_ids,toker.pad_token_id)
+    return toker(texts,return_tensors='pt',padding=True,truncation=True,max_length=max_length,return_attention_mask=True)
+
+def estimate_lengths(lines,max_length=None,bytes_per_token=4):
+    """
+    per-line token count estimated from the byte length, nothing is decoded:
+    a LineFile/JsonlFile, or anything with get_byte_lengths() such as RetrievedMemory
+    """
+    if hasattr(lines,'get_byte_lengths'):
+        lengths = lines.get_byte_lengths()
+    else:
+        lengths = np.diff(np.asarray(lines.offsets))
+    lengths = lengths // bytes_per_token
+    if max_length is not None:
+        lengths = np.minimum(lengths,max_length)
+    return lengths
+
+def get_sample_lengths(dataset,max_length=None,keys=('src_ids','memory_ids'),bytes_per_token=4):
+    """
+    per-sample source length for length bucketing, read without decoding any sample:
+    exact token counts from the pre-tokenized stores under keys when the dataset has them,
+    otherwise estimated from the byte length of the jsonl line
+    """
+    token_ids = getattr(dataset,'token_ids',None) or {}
+    stores = [token_ids[k] for k in keys if k in token_ids]
+    if stores:
+        return sum(np.diff(np.asarray(x.offsets)) for x in stores)
+    return estimate_lengths(dataset.data,max_length,bytes_per_token)
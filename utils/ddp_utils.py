@@ -77,14 +77,26 @@ class PadSequentialDistributedSampler(torch.utils.data.sampler.Sampler):
     def __len__(self):
         return self.num_samples
 
+def get_eval_sampler(dataset, batch_size, num_replicas, rank, max_tokens=None):
+    """
+    --max_tokens turns replace_sampler_ddp off for its batch sampler, so Lightning no longer splits
+    the eval sets across ranks: the sequential shards of PadSequentialDistributedSampler keep every
+    sample on one rank and the outputs gathered rank by rank in dataset order (cut with [:cnt])
+    None when Lightning inserts its own sampler or on a single process
+    """
+    if max_tokens is None or num_replicas <= 1:
+        return None
+    return PadSequentialDistributedSampler(dataset, batch_size, rank=rank, num_replicas=num_replicas)
+
 class UnevenSequentialDistributedSampler(torch.utils.data.sampler.Sampler):
     """
     This is slightly different version of SequentialDistrbitedSample from 
     https://github.com/huggingface/transformers/blob/81ac45f85c35244831f11f73c09ea10eee4f953a/src/transformers/trainer_pt_utils.py
     In thie version, the datset is not evenly split. Since we don't need tensors of same shape to reduce or gather
+    indices: only split these dataset indices, e.g. the samples a resumed run has not done yet
     """
 
-    def __init__(self, dataset, num_replicas=None, rank=None):
+    def __init__(self, dataset, num_replicas=None, rank=None, indices=None):
         import math
         if num_replicas is None:
             if not torch.distributed.is_available():
@@ -97,9 +109,10 @@ class UnevenSequentialDistributedSampler(torch.utils.data.sampler.Sampler):
         self.dataset = dataset
         self.num_replicas = num_replicas
         self.rank = rank
-        self.num_samples = int(math.ceil(len(self.dataset) * 1.0 / self.num_replicas))
+        if indices is None:
+            indices = list(range(len(self.dataset)))
+        self.num_samples = int(math.ceil(len(indices) * 1.0 / self.num_replicas))
         self.total_size = self.num_samples * self.num_replicas 
-        indices = list(range(len(self.dataset)))
         self.indices = indices[self.rank * self.num_samples : (self.rank + 1) * self.num_samples] ## a trick for python list ls[:infinity]
 
     def __iter__(self):
@@ -108,6 +121,234 @@ class UnevenSequentialDistributedSampler(torch.utils.data.sampler.Sampler):
     def __len__(self):
         return len(self.indices)
 
+class LengthBucketBatchSampler(torch.utils.data.sampler.Sampler):
+    """
+    Token-budget batch sampler: indices are shuffled, cut into buckets of bucket_size,
+    sorted by length inside every bucket and packed greedily into batches whose padded
+    size (batch_size * longest item) stays within max_tokens. The batch order is shuffled
+    again, so every epoch still mixes all lengths while padding stays small.
+
+    lengths: per-sample token count (an estimate is fine)
+    sampler: optional index source such as UnevenSequentialDistributedSampler or
+             PadSequentialDistributedSampler, only its indices are packed
+    num_replicas/rank: for DDP training every rank builds the same batches from the same
+             seed and takes every num_replicas-th, the batch list is padded so that every
+             rank runs the same number of steps
+    like DistributedSampler, set_epoch(epoch) reshuffles (Lightning calls it every epoch)
+
+    for inference, shuffle=False with a single bucket (bucket_size=len(lengths)) sorts the
+    sampler's indices by length; restore_order puts the outputs back in dataset order
+    """
+
+    def __init__(self, lengths, max_tokens, max_batch_size=None, sampler=None, shuffle=True, seed=0,
+                 bucket_size=1000, num_replicas=1, rank=0):
+        import numpy as np
+        self.lengths = np.asarray(lengths,dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.sampler = sampler
+        self.shuffle = shuffle
+        self.seed = seed if seed is not None else 0
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = None
+
+    def pack(self, indices):
+        batches = []
+        batch,max_len = [],0
+        for idx in indices:
+            length = max(int(self.lengths[idx]),1)
+            full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (full or (len(batch)+1) * max(max_len,length) > self.max_tokens):
+                batches.append(batch)
+                batch,max_len = [],0
+            batch.append(idx)
+            max_len = max(max_len,length)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def get_batches(self):
+        import numpy as np
+        if self._batches is not None:
+            return self._batches
+        indices = np.asarray(list(self.sampler) if self.sampler is not None else range(len(self.lengths)),dtype=np.int64)
+        rng = np.random.default_rng(self.seed + self.epoch)
+        if self.shuffle:
+            indices = indices[rng.permutation(len(indices))]
+        batches = []
+        for start in range(0,len(indices),self.bucket_size):
+            bucket = indices[start:start+self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket],kind='stable')]
+            batches.extend(self.pack(bucket.tolist()))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            ## same number of steps on every rank, otherwise DDP hangs on the missing all-reduce
+            num_batches = int(math.ceil(len(batches) / self.num_replicas)) * self.num_replicas
+            batches += batches[:num_batches-len(batches)]
+            batches = batches[self.rank:num_batches:self.num_replicas]
+        self._batches = batches
+        return batches
+
+    def __iter__(self):
+        return iter(self.get_batches())
+
+    def __len__(self):
+        return len(self.get_batches())
+
+def restore_order(outputs,indices):
+    """
+    outputs: per-batch lists of outputs, every item owning an equal, contiguous share of its batch
+    indices: per-batch lists of the dataset indices of the items
+    return: flat list of all outputs in dataset order
+    """
+    items = []
+    for batch_outputs,batch_indices in zip(outputs,indices):
+        assert len(batch_outputs) % len(batch_indices) == 0,(len(batch_outputs),len(batch_indices))
+        size = len(batch_outputs) // len(batch_indices)
+        items.extend((index,batch_outputs[idx*size:(idx+1)*size]) for idx,index in enumerate(batch_indices))
+    items.sort(key=lambda x:x[0])
+    return [x for _,y in items for x in y]
+
+class OutputShards:
+    """
+    Crash-safe per-rank output of an inference run under {root}:
+        {part}.jsonl            one {"index":..,"output":..} line per dataset item, appended per batch
+        {part}.progress.json    number of committed bytes of {part}.jsonl
+    write() appends a batch, fsyncs it and only then moves the committed size forward, so a
+    killed run leaves at most an uncommitted tail that is never read. A restarted run opens
+    new parts and skips every item in done; merge() writes all committed items in index order.
+    All ranks must build their OutputShards before any of them writes (wait_for_everyone),
+    otherwise they could see different done sets and split the remaining items differently.
+    """
+    def __init__(self, root, rank=0):
+        import os
+        import glob
+        import time
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.parts = sorted(x[:-len('.progress.json')] for x in glob.glob(os.path.join(root, '*.progress.json')))
+        self.done = set(index for _, index, _, _ in self.scan())
+        self.part = os.path.join(root, f"part-{time.time_ns()}-rank{rank}-{os.getpid()}")
+        self._file = None
+        self._committed = 0
+
+    def scan(self):
+        """
+        yield (part, index, offset, length) of every committed line
+        """
+        import json
+        for part in self.parts:
+            with open(part+'.progress.json') as f:
+                committed = json.load(f)['bytes']
+            offset = 0
+            with open(part+'.jsonl', 'rb') as f:
+                for line in f:
+                    if offset + len(line) > committed:
+                        break
+                    yield part, json.loads(line)['index'], offset, len(line)
+                    offset += len(line)
+
+    def write(self, indices, outputs):
+        import os
+        import json
+        if self._file is None:
+            ## a new part every run, never appended after an uncommitted tail
+            self._file = open(self.part+'.jsonl', 'xb')
+        for index, output in zip(indices, outputs):
+            self._file.write((json.dumps({"index": int(index), "output": output})+'\n').encode('utf-8'))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._committed = self._file.tell()
+        tmp_path = f"{self.part}.progress.json.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"bytes": self._committed}, f)
+        os.replace(tmp_path, self.part+'.progress.json')
+        self.done.update(int(x) for x in indices)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def merge(self, path, num_items, to_lines=lambda output: [output]):
+        """
+        write to_lines(output) of items 0..num_items-1 in order to path, reading one item at a time
+        """
+        import os
+        import glob
+        import json
+        import numpy as np
+        self.close()
+        self.parts = sorted(x[:-len('.progress.json')] for x in glob.glob(os.path.join(self.root, '*.progress.json')))
+        entries = list(self.scan())
+        part_ids = {part: idx for idx, part in enumerate(self.parts)}
+        index = np.asarray([(i, part_ids[p], o, l) for p, i, o, l in entries], dtype=np.int64).reshape(-1, 4)
+        index = index[np.argsort(index[:, 0], kind='stable')]
+        assert index[:, 0].tolist() == list(range(num_items)), f"{len(index)} items in {self.root}, expected {num_items} distinct ones"
+        files = [open(part+'.jsonl', 'rb') for part in self.parts]
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            for _, part_id, offset, length in index:
+                files[part_id].seek(offset)
+                for line in to_lines(json.loads(files[part_id].read(length))['output']):
+                    f.write(line+'\n')
+        for x in files:
+            x.close()
+        os.replace(tmp_path, path)
+
+def gather_to_main(obj, tmp_dir=None):
+    """
+    obj of every rank, in rank order, on the main process and None on the other ranks.
+    Unlike all_gather_object no rank receives outputs it never uses, and every rank sends
+    exactly its own obj, so per-rank outputs may differ in size without padding.
+    tmp_dir: directory shared by all ranks; every rank pickles obj to a file there and only
+             the file paths go through the process group (large outputs then never pass
+             through the pickled tensors gather_object puts on the GPU)
+    """
+    import os
+    import pickle
+    import torch.distributed as dist
+    if not (dist.is_available() and dist.is_initialized()):
+        return [obj]
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    if tmp_dir is not None:
+        import uuid
+        os.makedirs(tmp_dir, exist_ok=True)
+        path = os.path.join(tmp_dir, f"gather-rank{rank}-{uuid.uuid4().hex}.pkl")
+        with open(path, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        obj = path
+    ret = [None for _ in range(world_size)] if rank == 0 else None
+    dist.gather_object(obj, ret, dst=0)
+    if tmp_dir is not None and rank == 0:
+        ## every path is unique, the files can go as soon as they are read
+        paths, ret = ret, []
+        for path in paths:
+            with open(path, 'rb') as f:
+                ret.append(pickle.load(f))
+            os.remove(path)
+    return ret
+
+def broadcast_from_main(obj):
+    """
+    obj of the main process on every rank, for the small results computed from gather_to_main
+    """
+    import torch.distributed as dist
+    if not (dist.is_available() and dist.is_initialized()):
+        return obj
+    ret = [obj]
+    dist.broadcast_object_list(ret, src=0)
+    return ret[0]
+
 def wait_for_everyone():
     import torch.distributed as dist
     if dist.is_available() and dist.is_initialized():
@@ -0,0 +1,119 @@
+"""
+Memory bank on disk:
+    {prefix}.offsets.npy  int64 [N+1], byte offsets of every entry in the blob
+    {prefix}.bin          all entries as one contiguous utf-8 blob
+Retrieval output:
+    {split}.ids.npy       int32 [num_queries, k], ids into the memory bank, -1 for padding
+Both are memory-mapped, so datasets only decode the memory they actually use.
+"""
+import os
+import numpy as np
+from .data_utils import LineFile
+
+def write_memory_bank(texts,prefix):
+    """
+    texts: iterable of str, streamed to disk one by one
+    return: number of entries
+    """
+    offsets = [0]
+    with open(prefix+'.bin','wb') as f:
+        for text in texts:
+            b = text.encode('utf-8')
+            f.write(b)
+            offsets.append(offsets[-1]+len(b))
+    np.save(prefix+'.offsets.npy',np.asarray(offsets,dtype=np.int64))
+    return len(offsets)-1
+
+class MemoryBank:
+
+    def __init__(self,prefix):
+        self.prefix = prefix
+        self.offsets = np.load(prefix+'.offsets.npy',mmap_mode='r')
+        self._blob = None
+
+    @property
+    def blob(self):
+        ## opened lazily so that the bank can be pickled into DataLoader workers
+        if self._blob is None:
+            if self.offsets[-1] == 0:
+                self._blob = np.zeros(0,dtype=np.uint8)
+            else:
+                self._blob = np.memmap(self.prefix+'.bin',dtype=np.uint8,mode='r')
+        return self._blob
+
+    def __getstate__(self):
+        return {'prefix':self.prefix}
+
+    def __setstate__(self,state):
+        self.__init__(state['prefix'])
+
+    def __getitem__(self,index):
+        if index < 0:
+            raise IndexError(f"memory id {index} is padding, not an entry of {self.prefix}")
+        start,end = int(self.offsets[index]),int(self.offsets[index+1])
+        return self.blob[start:end].tobytes().decode('utf-8')
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+def ids_to_array(ids,k=None,fill=-1):
+    """
+    list of list of ids (as pickled by bm25.py) -> int32 [N,k], short rows padded with fill
+    """
+    if k is None:
+        k = max([len(x) for x in ids],default=0)
+    ret = np.full((len(ids),k),fill,dtype=np.int32)
+    for idx,row in enumerate(ids):
+        row = row[:k]
+        ret[idx,:len(row)] = row
+    return ret
+
+class RetrievedMemory:
+    """
+    Lazy list of memory strings: the rank-th retrieved entry of every query, decoded on access.
+    """
+    def __init__(self,ids,bank,rank=0):
+        self.ids = ids
+        self.bank = bank
+        self.rank = rank
+
+    def __getitem__(self,index):
+        memory = self.bank[int(self.ids[index,self.rank])]
+        return memory.replace("\r\n"," ").replace('\n'," ").strip()
+
+    def get_byte_lengths(self):
+        offsets = np.asarray(self.bank.offsets)
+        ids = np.asarray(self.ids[:,self.rank],dtype=np.int64)
+        if len(ids) and ids.min() < 0:
+            raise IndexError(f"{int((ids < 0).sum())} queries have no memory at rank {self.rank}")
+        return offsets[ids+1] - offsets[ids]
+
+    def __len__(self):
+        return len(self.ids)
+
+def load_memory(path):
+    """
+    path:
+        -{split}.txt: one memory per line, read lazily
+        -{split}.ids.npy: retrieval ids, resolved lazily against the `bank` memory bank in the same directory
+    """
+    if path.endswith('.npy'):
+        ids = np.load(path,mmap_mode='r')
+        bank = MemoryBank(os.path.join(os.path.dirname(path),'bank'))
+        return RetrievedMemory(ids,bank)
+    return LineFile(path,strip=True)
+
+def memory_files(path):
+    """
+    every file the memory at path is read from
+    """
+    if path.endswith('.npy'):
+        prefix = os.path.join(os.path.dirname(path),'bank')
+        return [path,prefix+'.offsets.npy',prefix+'.bin']
+    return [path]
+
+def get_memory_path(memory_dir,_split):
+    ids_path = os.path.join(memory_dir,_split+'.ids.npy')
+    if os.path.exists(ids_path):
+        return ids_path
+    return os.path.join(memory_dir,_split+'.txt')
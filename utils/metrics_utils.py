@@ -1,14 +1,114 @@
+class BatchRougeScorer:
+    """
+    Same scores as compare_mt RougeScorer(rouge_types,use_stemmer=True), built for scoring
+    many candidates against the same reference:
+        -the Porter stem of every word is computed once and cached
+        -prepare(ref) tokenizes/stems a text once and keeps its n-gram counts and sentence tokens
+        -score(ref,hyp) takes prepared texts, so a reference is processed once for all of its candidates
+    """
+    def __init__(self,rouge_types=('rouge1','rouge2','rougeLsum')):
+        import re
+        from nltk.stem import porter
+        self.rouge_types = tuple(rouge_types)
+        self.stemmer = porter.PorterStemmer()
+        self.stem_cache = {}
+        self.non_alnum = re.compile(r"[^a-z0-9]+")
+        self.alnum = re.compile(r"^[a-z0-9]+$")
+
+    def tokenize(self,text):
+        tokens = []
+        for x in self.non_alnum.sub(" ",text.lower()).split():
+            if len(x) > 3:
+                stem = self.stem_cache.get(x)
+                if stem is None:
+                    stem = self.stemmer.stem(x)
+                    self.stem_cache[x] = stem
+                x = stem
+            if self.alnum.match(x):
+                tokens.append(x)
+        return tokens
+
+    def prepare(self,text):
+        from compare_mt.rouge.rouge_scorer import _create_ngrams
+        ret = {}
+        tokens = self.tokenize(text)
+        for rouge_type in self.rouge_types:
+            if rouge_type == 'rougeLsum':
+                ## sentences are separated by newline
+                ret[rouge_type] = [self.tokenize(x) for x in text.split("\n") if len(x)]
+            elif rouge_type == 'rougeL':
+                ret[rouge_type] = tokens
+            else:
+                ret[rouge_type] = _create_ngrams(tokens,int(rouge_type[5:]))
+        return ret
+
+    def score(self,ref,hyp):
+        """
+        ref,hyp: prepared texts
+        return: tuple of fmeasure, in rouge_types order
+        """
+        from compare_mt.rouge.rouge_scorer import _score_ngrams,_score_lcs,_summary_level_lcs
+        ret = []
+        for rouge_type in self.rouge_types:
+            if rouge_type == 'rougeLsum':
+                score = _summary_level_lcs(ref[rouge_type],hyp[rouge_type])
+            elif rouge_type == 'rougeL':
+                score = _score_lcs(ref[rouge_type],hyp[rouge_type])
+            else:
+                score = _score_ngrams(ref[rouge_type],hyp[rouge_type])
+            ret.append(score.fmeasure)
+        return tuple(ret)
+
+    def score_candidates(self,ref,hyps):
+        ref = self.prepare(ref)
+        return [self.score(ref,self.prepare(hyp)) for hyp in hyps]
+
+## one scorer per process and rouge_types, so the stem cache lives across calls and pool chunks
+_batch_rouge_scorers = {}
+
+def get_batch_rouge_scorer(rouge_types=('rouge1','rouge2','rougeLsum')):
+    rouge_types = tuple(rouge_types)
+    if rouge_types not in _batch_rouge_scorers:
+        _batch_rouge_scorers[rouge_types] = BatchRougeScorer(rouge_types)
+    return _batch_rouge_scorers[rouge_types]
+
+def _score_rouge_chunk(chunk):
+    rouge_types,refs,hyps = chunk
+    scorer = get_batch_rouge_scorer(rouge_types)
+    return [scorer.score_candidates(ref,_hyps) for ref,_hyps in zip(refs,hyps)]
+
+def get_candidates_rouge_scores(hyps,refs,rouge_types=('rouge1','rouge2','rougeLsum'),num_workers=1,chunk_size=64,verbose=False):
+    """
+    hyps: list of list of str, hyps[i] are the candidates of refs[i]
+    refs: list of str
+    return: list of list of tuple of fmeasure (rouge_types order), nested like hyps
+    every reference is tokenized and stemmed once, chunks of chunk_size references are spread over num_workers processes
+    """
+    assert len(hyps) == len(refs),(len(hyps),len(refs))
+    rouge_types = tuple(rouge_types)
+    chunks = [(rouge_types,refs[idx:idx+chunk_size],hyps[idx:idx+chunk_size]) for idx in range(0,len(refs),chunk_size)]
+    if num_workers > 1 and len(chunks) > 1:
+        from multiprocessing import Pool
+        with Pool(num_workers) as p:
+            outputs = p.imap(_score_rouge_chunk,chunks)
+            if verbose:
+                from tqdm import tqdm
+                outputs = tqdm(outputs,total=len(chunks))
+            outputs = list(outputs)
+    else:
+        outputs = [_score_rouge_chunk(chunk) for chunk in chunks]
+    return [x for y in outputs for x in y]
+
 def get_rouge_score(hyps,refs):
-    from compare_mt.rouge.rouge_scorer import RougeScorer
     assert len(hyps)==len(refs)
     lens = len(hyps)    
-    rouge_scorer = RougeScorer(['rouge1', 'rouge2', 'rougeLsum'], use_stemmer=True)    
+    rouge_scorer = get_batch_rouge_scorer(['rouge1', 'rouge2', 'rougeLsum'])
     rouge1 = rouge2 = rougel = 0.0
     for hyp,ref in zip(hyps,refs):
-        score = rouge_scorer.score(ref,hyp)
-        rouge1 += score['rouge1'].fmeasure
-        rouge2 += score['rouge2'].fmeasure
-        rougel += score['rougeLsum'].fmeasure
+        r1,r2,rl = rouge_scorer.score(rouge_scorer.prepare(ref),rouge_scorer.prepare(hyp))
+        rouge1 += r1
+        rouge2 += r2
+        rougel += rl
     rouge1 = rouge1 / lens
     rouge2 = rouge2 / lens
     rougel = rougel / lens
@@ -132,13 +232,47 @@ def get_edit_distance(x,y,len_split=False):
     # Here first sentence is the edited sentence and the second sentence is the target sentence
     # If src_sent is the first sentence, then insertion and deletion should be reversed.
     """ Dynamic Programming Version of edit distance and finding unedited words."""
-    import editdistance
-    edit_distance = editdistance.eval(x.split(), y.split())
+    return float(get_batch_edit_distance(y,[x],len_split=len_split)[0])
+
+def get_batch_edit_distance(x,ys,len_split=False,workers=-1):
+    """
+    Same score as get_edit_distance(y,x) for every y in ys.
+    x is split once and the token-level Levenshtein distances to all of ys come from a
+    single rapidfuzz cdist call (native, multi-threaded over workers), the normalization
+    is vectorized.
+    x:str
+    ys:list of str
+    return: np.ndarray of shape [len(ys)]
+    """
+    import numpy as np
+    from rapidfuzz.process import cdist
+    from rapidfuzz.distance import Levenshtein
+    x_tokens = x.split()
+    ys_tokens = [y.split() for y in ys]
+    if not ys:
+        return np.zeros(0,dtype=np.float64)
+    distance = cdist([x_tokens],ys_tokens,scorer=Levenshtein.distance,dtype=np.int32,workers=workers)[0]
     if len_split:
-        edit_distance = 1 - edit_distance / max(len(y.split()), len(x.split()))
+        norm = np.maximum(np.fromiter((len(t) for t in ys_tokens),dtype=np.int64,count=len(ys)),len(x_tokens))
     else:
-        edit_distance = 1 - edit_distance / max(len(y), len(x))
-    return edit_distance
+        norm = np.maximum(np.fromiter((len(y) for y in ys),dtype=np.int64,count=len(ys)),len(x))
+    return 1 - distance / np.maximum(norm,1)
+
+def get_topk_by_edit_distance(x,ys,k,len_split=False):
+    """
+    indices of the k candidates in ys most similar to x, best first (ties keep the input order)
+    """
+    import numpy as np
+    scores = get_batch_edit_distance(x,ys,len_split=len_split)
+    k = min(k,len(ys))
+    if k == 0:
+        return []
+    ## argpartition picks arbitrarily among ties at the k-th score, every candidate of that score
+    ## is kept before the final sort so that ties go to the earlier candidate
+    kth = scores[np.argpartition(-scores,k-1)[k-1]]
+    top = np.flatnonzero(scores >= kth)
+    top = top[np.lexsort((top,-scores[top]))][:k]
+    return top.tolist()
 
 def get_ndcg_score(relevance_score,true_relevance):
     from sklearn.metrics import ndcg_score
@@ -350,7 +350,7 @@ def get_json_dir(file_dir):
 
 
 def evaluate_candidates(candidates,refs):
-    from .metrics_utils import get_rouge_score
+    from .metrics_utils import get_rouge_score,get_candidates_rouge_scores
     assert len(candidates) % len(refs) == 0
     num_candidates = int(len(candidates)/len(refs))
     candidates = split_list(candidates,num_candidates)
@@ -366,8 +366,9 @@ def evaluate_candidates(candidates,refs):
     ## best and worst
     best_hyps = []
     worst_hyps = []
-    for ref,candidate_ls in zip(refs,candidates):
-        candidate_ls = [[candidate,get_rouge_score([candidate],[ref])[0]] for candidate in candidate_ls]
+    r1_scores = get_candidates_rouge_scores(candidates,refs,['rouge1'])
+    for candidate_ls,scores in zip(candidates,r1_scores):
+        candidate_ls = [[candidate,score[0]] for candidate,score in zip(candidate_ls,scores)]
         candidate_ls.sort(key=lambda x:float(x[1]))
         best_hyps.append(candidate_ls[-1][0])
         worst_hyps.append(candidate_ls[0][0])